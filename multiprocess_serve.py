@@ -0,0 +1,13 @@
+"""
+	Serves the project via WSGI using several waitress worker processes, so requests can use more than one core -
+	see npsat_backend/server.py. Set up to run on boot by a Windows scheduled task the same way as waitress_serve.py.
+	Touch SERVER_RELOAD_FILE (reload.txt by default) to reload the workers after deploying new code.
+"""
+
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'npsat_backend.settings')
+
+if __name__ == "__main__":  # worker processes import this module on Windows - only the parent should serve
+	from npsat_backend import server
+	server.main()
@@ -0,0 +1,18 @@
+"""
+ASGI config for npsat_web_backend project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. Serve it with an ASGI server, for
+example ``uvicorn npsat_backend.asgi:application --port 8010``, so that requests waiting on
+/api/model_run/<id>/status/ are held by the event loop rather than each tying up a server thread.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'npsat_backend.settings')
+
+application = get_asgi_application()
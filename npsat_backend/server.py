@@ -0,0 +1,270 @@
+"""
+	Multi-process production server. waitress_serve.py runs the site in a single process, so every request shares
+	one GIL and CPU-bound work (serializing region geometry and results, percentile math) can't use more than one
+	core. This binds the listening socket once, then runs settings.SERVER_WORKERS waitress processes that all accept
+	from it, each with settings.SERVER_THREADS threads.
+
+	Where processes can be forked (Linux, macOS), the Django app is loaded in the parent before the workers start,
+	so they come up immediately and share its memory. On Windows each worker starts a fresh interpreter and loads
+	the app itself - it still runs as a scheduled task, just like waitress_serve.py, via multiprocess_serve.py.
+
+	Reloading is graceful: a new set of workers starts accepting, and the old ones stop accepting, finish the
+	requests they have in flight (for up to settings.SERVER_DRAIN_SECONDS) and exit. Trigger a reload by sending
+	SIGHUP, or - on any platform - by touching settings.SERVER_RELOAD_FILE. Reloaded workers always load the app
+	fresh, so a reload picks up new code too. Workers that die are replaced, and workers exit on their own if the
+	parent goes away, so ending the scheduled task doesn't leave orphans serving requests.
+
+	Each worker writes its metrics to settings.SERVER_METRICS_FOLDER, so /metrics reports the whole server whichever
+	worker answers the scrape - see support.metrics. Query profiles (/api/query_profiles/) stay in the worker that
+	recorded them.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from npsat_backend import settings
+from npsat_manager.support import metrics
+
+log = logging.getLogger("npsat.server")
+
+CHECK_INTERVAL = 1  # seconds between the parent's checks on its workers and the reload file
+METRICS_WRITE_INTERVAL = 5  # seconds between each worker's writes of its metrics for the others to render
+
+
+def worker_count(configured=None):
+	"""
+	:param configured: number of workers, or None to use one per core
+	:return: number of worker processes to run
+	"""
+	if configured:
+		return configured
+	return os.cpu_count() or 1
+
+
+def parse_address(address):
+	"""
+	:param address: "host:port" as in SERVE_ADDRESS - "*" or an empty host listens on every interface
+	:return: (host, port)
+	"""
+	host, port = address.rsplit(":", 1)
+	if host in ("*", ""):
+		host = "0.0.0.0"
+	return host.strip("[]"), int(port)
+
+
+def bind(address):
+	host, port = parse_address(address)
+	listener = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET, backlog=2048)
+	listener.set_inheritable(True)
+	return listener
+
+
+def load_application():
+	from npsat_backend.wsgi import application
+	return application
+
+
+def _active_channels(server):
+	from waitress.channel import HTTPChannel
+	return [channel for channel in list(server._map.values()) if isinstance(channel, HTTPChannel)]
+
+
+def run_worker(listener, threads, stop, drain_seconds, metrics_folder=None):
+	"""
+		Runs one waitress server on the shared socket until told to stop, then drains and exits. Runs in the
+		worker process
+	:param listener: bound, listening socket shared by every worker
+	:param threads: waitress threads for this worker
+	:param stop: multiprocessing Event - set by the parent when this worker should drain and exit
+	:param drain_seconds: how long to wait for in-flight requests once stopped
+	:param metrics_folder: folder to write this worker's metrics to, or None to keep them to itself
+	"""
+	from waitress.server import create_server
+
+	signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C goes to the whole group - let the parent decide
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)  # forked workers inherit the parent's handlers
+	if hasattr(signal, "SIGHUP"):
+		signal.signal(signal.SIGHUP, signal.SIG_DFL)
+	metrics.MULTIPROCESS_FOLDER = metrics_folder
+	application = load_application()
+	server = create_server(application, sockets=[listener], threads=threads)
+	parent = multiprocessing.parent_process()
+	log.info("Worker {} serving {} with {} threads".format(os.getpid(), listener.getsockname()[:2], threads))
+
+	drain_until = None
+	next_metrics_write = time.monotonic()
+	while True:
+		server.asyncore.loop(timeout=CHECK_INTERVAL, map=server._map, use_poll=server.adj.asyncore_use_poll, count=1)
+		if metrics_folder and time.monotonic() >= next_metrics_write:
+			metrics.write_snapshot(metrics_folder)
+			next_metrics_write = time.monotonic() + METRICS_WRITE_INTERVAL
+		if drain_until is None and (stop.is_set() or (parent is not None and not parent.is_alive())):
+			server.accepting = False  # the other workers pick up new connections from here on
+			drain_until = time.monotonic() + drain_seconds
+		if drain_until is not None and (len(_active_channels(server)) == 0 or time.monotonic() > drain_until):
+			break
+
+	server.task_dispatcher.shutdown()
+	if metrics_folder:
+		metrics.write_snapshot(metrics_folder)
+	log.info("Worker {} stopped".format(os.getpid()))
+
+
+class Generation(object):
+	"""
+		A set of workers started together, which are reloaded together
+	"""
+
+	def __init__(self, context, listener, size, threads, drain_seconds, metrics_folder=None):
+		self.context = context
+		self.listener = listener
+		self.size = size
+		self.threads = threads
+		self.drain_seconds = drain_seconds
+		self.metrics_folder = metrics_folder
+		self.stop_event = context.Event()
+		self.workers = []
+
+	def start_worker(self):
+		worker = self.context.Process(target=run_worker, args=(self.listener, self.threads, self.stop_event, self.drain_seconds, self.metrics_folder),
+									  name="npsat-worker", daemon=False)
+		worker.start()
+		self.workers.append(worker)
+
+	def start(self):
+		for index in range(self.size):
+			self.start_worker()
+
+	def replace_dead(self):
+		for worker in [worker for worker in self.workers if not worker.is_alive()]:
+			log.warning("Worker {} exited with code {} - replacing it".format(worker.pid, worker.exitcode))
+			self.workers.remove(worker)
+			self._exited(worker)
+			self.start_worker()
+
+	def _exited(self, worker):
+		if self.metrics_folder:
+			metrics.mark_process_dead(worker.pid, self.metrics_folder)
+
+	def stop(self):
+		self.stop_event.set()
+
+	def join(self, timeout):
+		deadline = time.monotonic() + timeout
+		for worker in self.workers:
+			worker.join(max(0, deadline - time.monotonic()))
+			if worker.is_alive():
+				worker.terminate()
+				worker.join(CHECK_INTERVAL)
+			self._exited(worker)
+
+
+class Supervisor(object):
+
+	def __init__(self, address, workers=None, threads=4, drain_seconds=30, reload_file=None, preload=True, metrics_folder=None):
+		"""
+		:param address: "host:port" to listen on
+		:param workers: number of worker processes - one per core if None
+		:param threads: waitress threads per worker
+		:param drain_seconds: how long stopping workers get to finish their requests
+		:param reload_file: optional path - touching it reloads the workers
+		:param preload: fork the first workers from this process, which has already loaded the app. Ignored where
+					fork isn't available
+		:param metrics_folder: optional folder where the workers share their metrics, so /metrics covers all of them.
+					It's emptied on start
+		"""
+		self.address = address
+		self.size = worker_count(workers)
+		self.threads = threads
+		self.drain_seconds = drain_seconds
+		self.reload_file = reload_file
+		self.preload = preload and "fork" in multiprocessing.get_all_start_methods()
+		self.metrics_folder = metrics_folder
+		self.listener = None
+		self.generation = None
+		self._reload_requested = threading.Event()
+		self._stop_requested = threading.Event()
+		self._reload_file_mtime = self._file_mtime()
+
+	def _file_mtime(self):
+		if self.reload_file and os.path.exists(self.reload_file):
+			return os.path.getmtime(self.reload_file)
+		return None
+
+	def _install_signal_handlers(self):
+		signal.signal(signal.SIGINT, lambda *args: self._stop_requested.set())
+		signal.signal(signal.SIGTERM, lambda *args: self._stop_requested.set())
+		if hasattr(signal, "SIGHUP"):  # not on Windows - use the reload file there
+			signal.signal(signal.SIGHUP, lambda *args: self._reload_requested.set())
+
+	def request_reload(self):
+		self._reload_requested.set()
+
+	def request_stop(self):
+		self._stop_requested.set()
+
+	def _new_generation(self, context):
+		generation = Generation(context, self.listener, self.size, self.threads, self.drain_seconds, self.metrics_folder)
+		generation.start()
+		return generation
+
+	def start(self):
+		self.listener = bind(self.address)
+		if self.metrics_folder:
+			metrics.clear_folder(self.metrics_folder)
+		load_application()  # configures logging, and fails here rather than in every worker if the app is broken
+		if self.preload:
+			from django.db import connections
+			connections.close_all()  # forked workers must each open their own database connections
+			context = multiprocessing.get_context("fork")
+		else:
+			context = multiprocessing.get_context("spawn")
+		self.generation = self._new_generation(context)
+		log.info("Serving {} with {} workers of {} threads".format(self.address, self.size, self.threads))
+
+	def reload(self):
+		log.info("Reloading workers")
+		old_generation = self.generation
+		self.generation = self._new_generation(multiprocessing.get_context("spawn"))  # fresh interpreters pick up new code
+		old_generation.stop()
+		old_generation.join(self.drain_seconds + CHECK_INTERVAL * 2)
+
+	def stop(self):
+		log.info("Stopping")
+		self.generation.stop()
+		self.generation.join(self.drain_seconds + CHECK_INTERVAL * 2)
+		self.listener.close()
+
+	def supervise(self):
+		"""
+			Keeps the workers running until asked to stop
+		"""
+		while not self._stop_requested.wait(CHECK_INTERVAL):
+			reload_file_mtime = self._file_mtime()
+			if reload_file_mtime != self._reload_file_mtime:
+				self._reload_file_mtime = reload_file_mtime
+				self._reload_requested.set()
+			if self._reload_requested.is_set():
+				self._reload_requested.clear()
+				self.reload()
+			self.generation.replace_dead()
+		self.stop()
+
+	def serve_forever(self):
+		self._install_signal_handlers()
+		self.start()
+		self.supervise()
+
+
+def main():
+	Supervisor(settings.SERVE_ADDRESS,
+			   workers=settings.SERVER_WORKERS,
+			   threads=settings.SERVER_THREADS,
+			   drain_seconds=settings.SERVER_DRAIN_SECONDS,
+			   reload_file=settings.SERVER_RELOAD_FILE,
+			   metrics_folder=settings.SERVER_METRICS_FOLDER).serve_forever()
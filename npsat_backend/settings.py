@@ -14,6 +14,146 @@ from npsat_backend.local_settings import *
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
 
 PERCENTILE_CALCULATIONS = (1,2,3,4,5,10,15,20,25,50,75,80,85,90,95,96,97,98,99)
+# "exact" reads the whole Mantis response and computes exact percentiles. "sketch" computes them while the
+# response streams in, in bounded memory, within a reported rank error - use it for very large well sets
+PERCENTILE_MODE = "exact"
+PERCENTILE_SKETCH_CAPACITY = 512  # larger is more accurate and uses more memory
+
+# Region masks let the in-process model read and convolve only the cells inside the selected regions.
+# Rebuild the index with `python manage.py build_region_masks` whenever regions are reloaded
+REGION_MASK_INDEX = os.path.join(DataFolder, "region_masks.npz")
+REGION_MASK_REFERENCE_RASTER = NgwRasters[min(NgwRasters)]  # all of the model rasters share this grid
+
+# how much of each region lies in each region of the other types, served at /api/region_overlap/. Computed by
+# `python manage.py build_region_overlaps` on a lon/lat grid of REGION_OVERLAP_CELL_SIZE degrees (about 500 m) -
+# fractions under REGION_OVERLAP_MIN_FRACTION are slivers along shared borders and aren't stored
+REGION_OVERLAP_CELL_SIZE = 0.005
+REGION_OVERLAP_MIN_FRACTION = 0.001
+
+# rows read from the database and written out at a time by /api/model_run/export/ - see npsat_manager/exports.py
+EXPORT_CHUNK_ROWS = 1000
+
+# truncated, sparse unit response function stores, one folder per scenario - build them from dense multiband
+# URF rasters with `python manage.py build_urf_store`
+URF_STORE_FOLDER = os.path.join(DataFolder, "urfs")
+URF_STORE_TOLERANCE = 1e-4  # URFs are cut off once they drop below this fraction of their peak
+
+# precomputed base curves and per-crop responses used to answer runs without Mantis when only crop loadings
+# change. Compute them with `python manage.py precompute_response_basis`
+RESPONSE_BASIS_ENABLED = True
+RESPONSE_BASIS_FOLDER = os.path.join(DataFolder, "response_basis")
+RESPONSE_BASIS_LOADED_LIMIT = 32  # bases kept memory mapped by each dispatcher worker, most recently used first
+
+# each region's well results, kept so runs that share regions only send Mantis the ones that haven't been run with
+# the same scenarios and modifications before - see npsat_manager/region_results.py. Runs with none of their
+# regions cached go to Mantis in one command as usual. When some are, up to REGION_RESULT_CACHE_MAX_SPLIT missing
+# regions are sent one command each so they can be cached - more go in one command. The least recently used are
+# removed once the folder is over REGION_RESULT_CACHE_MAX_BYTES
+REGION_RESULT_CACHE_ENABLED = False
+REGION_RESULT_CACHE_FOLDER = os.path.join(DataFolder, "region_results")
+REGION_RESULT_CACHE_MAX_BYTES = 10 * 1024 ** 3
+REGION_RESULT_CACHE_MAX_SPLIT = 10
+
+# dtype of the in-process model's arrays, "float32" or "float64". Per-year sums always accumulate in float64.
+# Check the error on real data with `python manage.py mantis_precision_report` before switching to float32
+MANTIS_PRECISION = "float64"
+
+# results of `python manage.py benchmark_kernels` - each run is compared against the last one from the same machine
+KERNEL_BENCHMARK_HISTORY = os.path.join(DataFolder, "benchmarks", "kernel_history.json")
+
+# metrics in the Prometheus text format. The web app serves its own at /metrics to these addresses (and to logged
+# in staff), and process_runs serves the dispatcher's on DISPATCHER_METRICS_PORT - set it to None to turn that off
+METRICS_ALLOWED_ADDRESSES = ("127.0.0.1", "::1")
+DISPATCHER_METRICS_HOST = "127.0.0.1"
+DISPATCHER_METRICS_PORT = 9108
+
+# multi-process server (multiprocess_serve.py - see npsat_backend/server.py). Listens on SERVE_ADDRESS from local_settings
+SERVER_WORKERS = None  # worker processes - None runs one per core
+SERVER_THREADS = 4  # waitress threads in each worker
+SERVER_DRAIN_SECONDS = 30  # how long workers get to finish their requests when reloading or stopping
+SERVER_RELOAD_FILE = os.path.join(BASE_DIR, "reload.txt")  # touch this file to reload the workers gracefully
+SERVER_METRICS_FOLDER = os.path.join(BASE_DIR, "cache", "metrics")  # where workers share their metrics for /metrics
+
+# region, crop and scenario API responses are cached here, where every server worker can share them. Each is dropped
+# when its model changes, but the timeout bounds staleness if something edits the tables without sending signals
+REFERENCE_CACHE_SECONDS = 60 * 60
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reference': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, "cache", "reference"),
+        'TIMEOUT': REFERENCE_CACHE_SECONDS,
+    },
+    'throttle': {  # API rate limit counts, shared between server workers
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, "cache", "throttle"),
+    },
+    'results': {  # downsampled result series for plots - see npsat_manager/downsampling.py
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, "cache", "results"),
+    },
+}
+
+# runs the tests against in-memory copies of the caches above - see npsat_manager/tests/runner.py
+TEST_RUNNER = "npsat_manager.tests.runner.LocalCacheRunner"
+
+# result endpoints and the dashboard's plot data downsample each series to ?points=<n> years when asked. Rerunning a
+# model gives its results new keys, so the timeout only bounds the cache's size
+DOWNSAMPLE_CACHE_SECONDS = 24 * 60 * 60
+
+# clients can wait for a run's status to change at /api/model_run/<id>/status/?since=<status> - see run_status. The
+# dispatcher pokes the web server at RUN_STATUS_NOTIFY_ADDRESSES whenever it changes a run's status, and the web
+# server listens at RUN_STATUS_LISTEN_ADDRESS (None to only poll). Web processes that don't get the pokes check on
+# every run that has waiters once every RUN_STATUS_POLL_SECONDS
+RUN_STATUS_LISTEN_ADDRESS = ("127.0.0.1", 8011)
+RUN_STATUS_NOTIFY_ADDRESSES = [("127.0.0.1", 8011)]
+RUN_STATUS_POLL_SECONDS = 2
+RUN_STATUS_MAX_WAIT = 60  # seconds a status request can be held for - keep it under any proxy's read timeout
+
+# crop codes and region mantis_ids are cached in the dispatcher for building commands - see command_builder. Changes
+# made in another process (the admin, load_data) are seen once the cached copy is older than this many seconds
+LOOKUP_CACHE_SECONDS = 300
+
+# the dispatcher leases each run it works on and renews the lease every RUN_HEARTBEAT_SECONDS - see run_queue. If a
+# dispatcher dies or hangs, the run goes back in the queue once its lease runs out. Failed attempts are retried with
+# exponential backoff (RUN_RETRY_BACKOFF_SECONDS, doubling) until a run has had RUN_MAX_ATTEMPTS, then it's an error
+RUN_LEASE_SECONDS = 120
+RUN_HEARTBEAT_SECONDS = 30
+RUN_ATTEMPT_TIMEOUT_SECONDS = 60 * 60  # attempts stop renewing their lease after this long, so stuck runs get requeued
+RUN_MAX_ATTEMPTS = 3
+RUN_RETRY_BACKOFF_SECONDS = 30
+RUN_RETRY_MAX_BACKOFF_SECONDS = 15 * 60
+RUN_SWEEP_SECONDS = 30  # how often the dispatcher looks for expired leases
+MANTIS_TIMEOUT_SECONDS = 20 * 60  # give up on a Mantis server that sends nothing for this long
+MANTIS_SERVER_RETRY_SECONDS = 30  # how long a worker waits after failing to reach its Mantis server
+
+# waiting runs are ordered by weighted fair share between users rather than by when they were submitted - see scheduler
+SCHEDULER_USAGE_WINDOW_SECONDS = 60 * 60  # runs a user had within this long count against their share
+SCHEDULER_STAFF_WEIGHT = 2  # staff get this many times the share of other users
+SCHEDULER_BASE_WEIGHT = 4  # and base runs this many times the share of their user's other runs
+SCHEDULER_AGING_SECONDS = 60 * 60  # waiting this long counts as much as one run of usage - keeps low shares from starving
+SCHEDULER_MAX_RUNNING_PER_USER = 2  # runs of a user that can be in flight at once, across every Mantis server
+# Mantis servers switch scenarios slowly, so a worker can take a run that's up to SCHEDULER_AFFINITY_WINDOW places
+# behind its fair turn if its server has that run's scenarios loaded, or was among the MANTIS_RECENT_SCENARIOS used
+SCHEDULER_AFFINITY_WINDOW = 10
+MANTIS_RECENT_SCENARIOS = 3
+
+# each user can submit model runs (or sweeps of runs - see sweeps) at MODEL_RUN_SUBMIT_RATE (a DRF throttle rate) and
+# have at most MODEL_RUN_MAX_QUEUED of them waiting or running at once
+MODEL_RUN_SUBMIT_RATE = "120/hour"
+MODEL_RUN_MAX_QUEUED = 250
+RUN_SWEEP_MAX_RUNS = 200  # runs a single sweep can have
+
+# per-request SQL profiling (query counts, SQL time, repeated statements and the slowest ones). Staff can read the
+# most recent profiles from /api/query_profiles/. Sampling keeps the overhead low enough to leave on in production
+QUERY_PROFILING_ENABLED = False
+QUERY_PROFILING_SAMPLE_RATE = 0.05  # fraction of requests to profile, 0-1
+QUERY_PROFILING_BUFFER_SIZE = 200  # profiles to keep, per web server process
+QUERY_PROFILING_SLOWEST = 5  # slowest statements to keep per request
+QUERY_PROFILING_DUPLICATE_THRESHOLD = 3  # statements repeated this many times in a request are reported
+QUERY_PROFILING_WARN_QUERIES = 100  # log a warning for requests that run more queries than this
 
 
 # Application definition
@@ -66,11 +206,13 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    'npsat_manager.middleware.MetricsMiddleware',  # first, so its timing covers the rest
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'npsat_manager.middleware.QueryProfilingMiddleware',  # only active when QUERY_PROFILING_ENABLED
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
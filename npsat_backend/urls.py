@@ -22,44 +22,58 @@ from npsat_manager import views
 
 from rest_framework import permissions
 from rest_framework.schemas import get_schema_view as drf_get_schema_view
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
 
-schema_view = get_schema_view(
-   openapi.Info(
-      title="NPSAT/Mantis API",
-      default_version='v1',
-      description="Test description",
-      terms_of_service="ToDo! ",
-      contact=openapi.Contact(email="contact@snippets.local"),
-      license=openapi.License(name="MIT License"),
-   ),
-   public=True,
-   permission_classes=(permissions.IsAuthenticatedOrReadOnly,),
-)
+
+def yasg_schema_view():
+   """
+      drf-yasg's schema view, for the swagger/redoc URLs below. Built on demand - drf-yasg is slow to import and the
+      URLs are switched off, so importing it here would only slow down every start of the site
+   """
+   from drf_yasg.views import get_schema_view
+   from drf_yasg import openapi
+
+   return get_schema_view(
+      openapi.Info(
+         title="NPSAT/Mantis API",
+         default_version='v1',
+         description="Test description",
+         terms_of_service="ToDo! ",
+         contact=openapi.Contact(email="contact@snippets.local"),
+         license=openapi.License(name="MIT License"),
+      ),
+      public=True,
+      permission_classes=(permissions.IsAuthenticatedOrReadOnly,),
+   )
+
 
 # set up DRF
 router = routers.DefaultRouter()
 router.register(r'crops', views.CropViewSet)
 router.register(r'region', views.RegionViewSet, basename="Region")
+router.register(r'region_overlap', views.RegionOverlapViewSet, basename="RegionOverlap")
 router.register(r'model_run', views.ModelRunViewSet, basename="ModelRun")
+router.register(r'run_sweep', views.RunSweepViewSet, basename="RunSweep")
 router.register(r'modification', views.ModificationViewSet, basename="Modification")
 router.register(r'scenario', views.ScenarioViewSet, basename="Scenario")
 router.register(r'model_results', views.ResultPercentileViewSet, basename="ResultPercentile")
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/model_run/<int:run_id>/status/', views.model_run_status),  # long-polls - see views.model_run_status
     url(r'^api/', include(router.urls)),
     url(r'^api-token-auth/', views.CustomAuthToken.as_view()),  # POST a username and password here, get a token back
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 
     # dashboard fee
     url(r'^api/feed/', views.FeedOnDashboard.as_view()),
+    url(r'^api/run_timing_summary/', views.RunTimingSummary.as_view()),
+    url(r'^api/query_profiles/', views.QueryProfiles.as_view()),
+    path('metrics', views.prometheus_metrics),
 
     # DRF docs from drf-yasg
-    #url(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-    #url(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    #url(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    #url(r'^swagger(?P<format>\.json|\.yaml)$', yasg_schema_view().without_ui(cache_timeout=0), name='schema-json'),
+    #url(r'^swagger/$', yasg_schema_view().with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    #url(r'^redoc/$', yasg_schema_view().with_ui('redoc', cache_timeout=0), name='schema-redoc'),
 
     # DRF schema directly from DRF
     path('openapi', drf_get_schema_view(
@@ -8,14 +8,30 @@ admin.site.register(models.Region)
 admin.site.register(models.Crop)
 admin.site.register(models.CropGroup)
 admin.site.register(models.MantisServer)
+admin.site.register(models.ResponseBasis)
+admin.site.register(models.RunSweep)
 
 
 class ModelRunModificationInline(admin.TabularInline):
     model = models.Modification
 
 
+class ModelRunTimingInline(admin.StackedInline):
+    model = models.RunTiming
+    readonly_fields = models.RunTiming.STAGES + ("total", "date_recorded")
+    can_delete = False
+
+
+class ModelRunAttemptInline(admin.TabularInline):
+    model = models.RunAttempt
+    fields = ("number", "status", "server", "worker", "date_started", "date_finished", "lease_expires", "error")
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+
+
 class ModelRunAdmin(admin.ModelAdmin):
-    inlines = [ModelRunModificationInline]
+    inlines = [ModelRunModificationInline, ModelRunTimingInline, ModelRunAttemptInline]
 
 
 admin.site.register(models.ModelRun, ModelRunAdmin)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class NpsatManagerConfig(AppConfig):
     name = 'npsat_manager'
+
+    def ready(self):
+        from npsat_manager import reference_cache  # connects the signals that keep the shared API cache current
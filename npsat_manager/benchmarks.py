@@ -0,0 +1,295 @@
+"""
+	Benchmarks for the in-process model engines, run on synthetic rasters so they don't need the real data or
+	GDAL. Each engine provides the same steps - weighting land use, interpolating between the years we have
+	rasters for, building the annual loadings and convolving - and each step is timed at several grid sizes and
+	year counts. Results are appended to a JSON history file so that a slowdown shows up as a regression
+	against the previous run on the same machine.
+
+	To benchmark a new engine, write a function that returns its Cases (see numpy_cases) and add it to ENGINES.
+	Run it all with `python manage.py benchmark_kernels`.
+"""
+
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy
+
+from npsat_manager import kernels, mantis, mantis_numba, urf_store
+from npsat_manager.support import compatibility
+
+try:
+	import resource  # not available on Windows
+except ImportError:
+	resource = None
+
+log = logging.getLogger("npsat.benchmarks")
+
+FIRST_YEAR = 1945
+KNOWN_YEAR_STEP = 15  # the NGw rasters are every 15 years
+CROP_CODES = (400, 606, 1000, 2200)
+
+
+class SyntheticInputs(object):
+
+	def __init__(self, rows, cols, n_years, seed=0):
+		"""
+			Random rasters shaped like the real ones - NGw and land use rasters every 15 years, and unit response
+			functions that decay at a different rate in each cell
+		:param rows: grid rows
+		:param cols: grid columns
+		:param n_years: number of years the annual loadings should cover
+		:param seed: seed for the random values
+		"""
+		random = numpy.random.default_rng(seed)
+		self.rows = rows
+		self.cols = cols
+		self.n_years = n_years
+
+		known_years = list(range(FIRST_YEAR, FIRST_YEAR + n_years, KNOWN_YEAR_STEP)) + [FIRST_YEAR + n_years]
+		self.ngw_rasters = {year: random.random((rows, cols)) for year in known_years}
+		self.land_use_rasters = {year: random.choice(CROP_CODES, size=(rows, cols)).astype(numpy.int64) for year in known_years}
+		self.modifications = [SimpleNamespace(crop=SimpleNamespace(caml_code=code), proportion=0.25) for code in CROP_CODES[:2]]
+
+		lags = numpy.arange(n_years)[None, :]
+		rates = random.uniform(0.05, 0.5, size=(rows * cols, 1))
+		self.urfs = numpy.exp(-rates * lags)  # (cells, lags)
+
+	@property
+	def cells(self):
+		return self.rows * self.cols
+
+	@property
+	def first_interval(self):
+		years = sorted(self.ngw_rasters)
+		return years[0], years[1]
+
+
+class Case(object):
+
+	def __init__(self, engine, step, run, cell_years, prepare=None):
+		"""
+		:param engine: name of the engine
+		:param step: name of the step being timed
+		:param run: function to time - gets whatever prepare returns
+		:param cell_years: amount of work the step does, for throughput
+		:param prepare: optional function that makes the inputs for each repeat. Not timed
+		"""
+		self.engine = engine
+		self.step = step
+		self.run = run
+		self.cell_years = cell_years
+		self.prepare = prepare or (lambda: None)
+
+
+def numpy_cases(inputs, dtype):
+	"""
+		The original numpy implementation in mantis
+	"""
+	start_year, end_year = inputs.first_interval
+	start = inputs.ngw_rasters[start_year].astype(dtype)
+	stop = inputs.ngw_rasters[end_year].astype(dtype)
+	last_year = max(inputs.land_use_rasters)
+
+	def loadings():
+		return mantis.make_annual_loadings(inputs.modifications, dtype=dtype, ngw_rasters=inputs.ngw_rasters,
+										   land_use_rasters=inputs.land_use_rasters)
+
+	# mantis.convolve_and_sum works on the transposed loadings, (years, x, y), and convolves in place
+	urfs = inputs.urfs.astype(dtype).reshape(inputs.rows, inputs.cols, inputs.n_years).T
+	return [
+		Case("numpy", "make_weight_raster", lambda _: mantis.make_weight_raster(inputs.land_use_rasters[last_year], inputs.modifications, dtype=dtype),
+			 inputs.cells),
+		Case("numpy", "create_ranges_nd", lambda _: mantis.create_ranges_nd(start, stop, end_year - start_year),
+			 inputs.cells * (end_year - start_year)),
+		Case("numpy", "make_annual_loadings", lambda _: loadings(), inputs.cells * inputs.n_years),
+		Case("numpy", "convolve_and_sum", lambda prepared: mantis.convolve_and_sum(prepared, urfs),
+			 inputs.cells * inputs.n_years, prepare=loadings),
+	]
+
+
+def numba_cases(inputs, dtype):
+	"""
+		mantis_numba, which runs the compiled kernels
+	"""
+	years = sorted(inputs.ngw_rasters)
+	known_values = numpy.stack([inputs.ngw_rasters[year].ravel() for year in years], axis=1).astype(dtype)
+	known_years = numpy.array(years, dtype=numpy.int64)
+	last_year = years[-1]
+
+	def loadings():
+		return mantis_numba.make_annual_loadings(inputs.modifications, dtype=dtype, ngw_rasters=inputs.ngw_rasters,
+												 land_use_rasters=inputs.land_use_rasters)
+
+	urfs = inputs.urfs.astype(dtype)
+	return [
+		Case("numba", "make_weight_raster", lambda _: mantis_numba.make_weight_raster(inputs.land_use_rasters[last_year], inputs.modifications, dtype=dtype),
+			 inputs.cells),
+		Case("numba", "interpolate_years", lambda _: kernels.interpolate_years(known_values, known_years, years[0], inputs.n_years),
+			 inputs.cells * inputs.n_years),
+		Case("numba", "make_annual_loadings", lambda _: loadings(), inputs.cells * inputs.n_years),
+		Case("numba", "convolve_and_sum", lambda prepared: mantis_numba.convolve_and_sum(prepared, urfs),
+			 inputs.cells * inputs.n_years, prepare=loadings),
+	]
+
+
+def numba_sparse_cases(inputs, dtype):
+	"""
+		The compiled kernels reading URFs out of a truncated urf_store.URFStore
+	"""
+	store = urf_store.URFStore.from_dense(inputs.urfs.T.reshape(inputs.n_years, inputs.rows, inputs.cols))
+
+	def loadings():
+		return mantis_numba.make_annual_loadings(inputs.modifications, dtype=dtype, ngw_rasters=inputs.ngw_rasters,
+												 land_use_rasters=inputs.land_use_rasters)
+
+	return [
+		Case("numba_sparse", "convolve_and_sum", lambda prepared: mantis_numba.convolve_and_sum(prepared, store),
+			 inputs.cells * inputs.n_years, prepare=loadings),
+	]
+
+
+ENGINES = {
+	"numpy": numpy_cases,
+	"numba": numba_cases,
+	"numba_sparse": numba_sparse_cases,
+}
+
+
+def max_rss_mb():
+	"""
+		Peak resident memory of this process so far, or None where the resource module isn't available
+	"""
+	if resource is None:
+		return None
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return max_rss / 2 ** 20 if platform.system() == "Darwin" else max_rss / 1024  # bytes on macOS, kilobytes elsewhere
+
+
+def measure(case, repeats=3):
+	"""
+		Times a case. It's run once first, untimed, so compilation and caches don't count against it
+	:return: dict of timings, throughput and memory
+	"""
+	case.run(case.prepare())
+
+	timings = []
+	peak_traced = 0
+	for repeat in range(repeats):
+		prepared = case.prepare()
+		tracemalloc.start()
+		start_time = time.perf_counter()
+		case.run(prepared)
+		timings.append(time.perf_counter() - start_time)
+		peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+
+	best = min(timings)
+	return {
+		"best_seconds": best,
+		"median_seconds": float(numpy.median(timings)),
+		"cell_years_per_second": case.cell_years / best if best > 0 else None,
+		"peak_traced_mb": peak_traced / 2 ** 20,
+		"max_rss_mb": max_rss_mb(),
+	}
+
+
+def run_suite(grid_sizes, year_counts, engines=None, precision="float64", repeats=3):
+	"""
+	:param grid_sizes: iterable of (rows, cols)
+	:param year_counts: iterable of year counts
+	:param engines: names of the engines in ENGINES to run - all of them by default
+	:param precision: "float32" or "float64"
+	:param repeats: timed runs of each case
+	:return: list of result dicts, one per engine, step, grid size and year count
+	"""
+	dtype = kernels.dtype_for(precision)
+	results = []
+	for rows, cols in grid_sizes:
+		for n_years in year_counts:
+			inputs = SyntheticInputs(rows, cols, n_years)
+			for engine in (engines or ENGINES):
+				for case in ENGINES[engine](inputs, dtype):
+					result = {"engine": case.engine, "step": case.step, "rows": rows, "cols": cols,
+							  "years": n_years, "precision": precision}
+					result.update(measure(case, repeats))
+					log.info("{engine} {step} {rows}x{cols} {years} years: {best_seconds:.4f}s".format(**result))
+					results.append(result)
+	return results
+
+
+def _git_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+									   cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def make_entry(results):
+	"""
+		Wraps a suite's results with what's needed to compare them later - when and where they were run
+	"""
+	return {
+		"date": datetime.datetime.utcnow().isoformat(),
+		"commit": _git_commit(),
+		"machine": platform.node(),
+		"processor": platform.processor(),
+		"cpu_count": os.cpu_count(),
+		"python": platform.python_version(),
+		"numpy": numpy.__version__,
+		"numba": __import__("numba").__version__ if compatibility.NUMBA else None,
+		"results": results,
+	}
+
+
+def load_history(path):
+	if not os.path.exists(path):
+		return []
+	with open(path, 'r') as history_file:
+		return json.load(history_file)
+
+
+def save_history(path, history):
+	folder = os.path.dirname(path)
+	if folder:
+		os.makedirs(folder, exist_ok=True)
+	with open(path, 'w') as history_file:
+		json.dump(history, history_file, indent=1)
+
+
+def _result_key(result):
+	return result["engine"], result["step"], result["rows"], result["cols"], result["years"], result["precision"]
+
+
+def find_regressions(history, entry, threshold=0.2):
+	"""
+		Compares an entry against the most recent earlier entry from the same machine
+	:param history: list of earlier entries
+	:param entry: entry from make_entry
+	:param threshold: fraction slower (on best time) that counts as a regression
+	:return: list of dicts describing each regression - empty if there are none or nothing to compare with
+	"""
+	previous = next((earlier for earlier in reversed(history) if earlier.get("machine") == entry["machine"]), None)
+	if previous is None:
+		return []
+
+	previous_results = {_result_key(result): result for result in previous["results"]}
+	regressions = []
+	for result in entry["results"]:
+		earlier = previous_results.get(_result_key(result))
+		if earlier is None or earlier["best_seconds"] <= 0:
+			continue
+		slowdown = result["best_seconds"] / earlier["best_seconds"] - 1
+		if slowdown > threshold:
+			regressions.append({"engine": result["engine"], "step": result["step"], "rows": result["rows"],
+								"cols": result["cols"], "years": result["years"], "precision": result["precision"],
+								"previous_seconds": earlier["best_seconds"], "seconds": result["best_seconds"],
+								"previous_commit": previous.get("commit"), "slowdown": slowdown})
+	return regressions
@@ -0,0 +1,126 @@
+"""
+	Gathers what a model run needs to be sent to Mantis (or answered from a response basis) with a fixed number of
+	queries. The lookup tables - every crop's caml code and every region's type and mantis_id - hardly ever change,
+	so they're kept in a process-level cache instead of being queried for each run, and the run itself only costs
+	a query for its regions and one for its modifications (none if the caller prefetched them, as process_runs
+	does). That keeps command build time flat no matter how many crops or regions a run has.
+
+	The caches are dropped whenever a Crop or Region is saved or deleted in this process. Changes made from
+	another process - editing crops in the admin while the dispatcher runs, or queryset updates, which don't send
+	signals - are picked up once the cached copy is older than settings.LOOKUP_CACHE_SECONDS.
+"""
+
+import threading
+import time
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from npsat_backend import settings
+from npsat_manager import mantis_protocol, models
+
+
+class LookupCache(object):
+	"""
+		Holds the result of a loader function until it's invalidated or older than settings.LOOKUP_CACHE_SECONDS
+	"""
+
+	def __init__(self, load):
+		self._load = load
+		self._lock = threading.Lock()
+		self._value = None
+		self._loaded_at = None
+
+	def get(self):
+		with self._lock:
+			if self._value is None or time.monotonic() - self._loaded_at > settings.LOOKUP_CACHE_SECONDS:
+				self._value = self._load()
+				self._loaded_at = time.monotonic()
+			return self._value
+
+	def invalidate(self):
+		with self._lock:
+			self._value = None
+
+
+def _load_crop_codes():
+	return dict(models.Crop.objects.order_by('id').values_list('id', 'caml_code'))
+
+
+def _load_regions():
+	return {region_id: (region_type, mantis_id) for region_id, region_type, mantis_id
+			in models.Region.objects.values_list('id', 'region_type', 'mantis_id')}
+
+
+CROP_CODES = LookupCache(_load_crop_codes)  # crop id: caml code
+REGIONS = LookupCache(_load_regions)  # region id: (region_type, mantis_id)
+
+
+@receiver([post_save, post_delete], sender=models.Crop)
+def _crops_changed(sender, **kwargs):
+	CROP_CODES.invalidate()
+
+
+@receiver([post_save, post_delete], sender=models.Region)
+def _regions_changed(sender, **kwargs):
+	REGIONS.invalidate()
+
+
+class RunInputs(object):
+
+	def __init__(self, region_ids, region_type, mantis_ids, modifications, crop_codes):
+		"""
+		:param region_ids: ids of the run's regions
+		:param region_type: region_type of the run's first region - Mantis runs one kind of region at a time
+		:param mantis_ids: mantis_id of each region, in the same order as region_ids
+		:param modifications: list of (caml_code, proportion) pairs
+		:param crop_codes: caml codes of every crop, all of which get sent to Mantis
+		"""
+		self.region_ids = region_ids
+		self.region_type = region_type
+		self.mantis_ids = mantis_ids
+		self.modifications = modifications
+		self.crop_codes = crop_codes
+
+
+def run_inputs(model_run):
+	"""
+	:param model_run: ModelRun - prefetch its modifications and select its scenarios to save the queries
+	:return: RunInputs, or None if the run has no regions
+	"""
+	region_ids = list(model_run.regions.values_list('id', flat=True))
+	if len(region_ids) == 0:
+		return None
+
+	regions = REGIONS.get()
+	if any(region_id not in regions for region_id in region_ids):  # created elsewhere since we loaded them
+		REGIONS.invalidate()
+		regions = REGIONS.get()
+
+	modifications = list(model_run.modifications.all())
+	crop_codes = CROP_CODES.get()
+	if any(modification.crop_id not in crop_codes for modification in modifications):
+		CROP_CODES.invalidate()
+		crop_codes = CROP_CODES.get()
+
+	return RunInputs(
+		region_ids=region_ids,
+		region_type=regions[region_ids[0]][0],
+		mantis_ids=[regions[region_id][1] for region_id in region_ids],
+		modifications=[(crop_codes[modification.crop_id], modification.proportion) for modification in modifications],
+		crop_codes=[code for code in crop_codes.values() if code is not None],
+	)
+
+
+def build(model_run):
+	"""
+		Builds the Mantis command for a run
+	:param model_run: ModelRun
+	:return: command string, or None if the run has no regions
+	"""
+	inputs = run_inputs(model_run)
+	if inputs is None:
+		return None
+	# enable all crops, for those that are not explicitly selected, use data in All other crops
+	weights = mantis_protocol.crop_weights(inputs.modifications, inputs.crop_codes)
+	return mantis_protocol.build_command(model_run, inputs.region_type, inputs.mantis_ids, weights)
@@ -0,0 +1,104 @@
+"""
+	Downsamples stored result series for plotting, so the dashboard's sparklines and other small charts don't need
+	every year of every run. Two methods pick which years to keep:
+		lttb - Largest-Triangle-Three-Buckets: splits the series into buckets and keeps the year in each bucket
+				that makes the largest triangle with the year kept before it and the average of the next bucket,
+				so the line keeps its visual shape
+		minmax - keeps the lowest and highest year of each bucket, so no peak or trough is lost
+
+	The first and last years are always kept, and series that already fit in the requested number of points are
+	returned whole. Downsampled series are cached in the "results" cache from settings.CACHES per (run, percentile,
+	method, points), keyed on the ResultPercentile's id too, since rerunning a model replaces its result rows.
+
+	This is plain Python rather than numpy - the series are a value per year, and the web app shouldn't import
+	numpy to serve them.
+"""
+
+from django.core.cache import caches
+
+from npsat_backend import settings
+
+CACHE_ALIAS = "results"
+METHODS = ("lttb", "minmax")
+MIN_POINTS = 4  # the first year, the last one and a bucket's lowest and highest between them
+
+
+def lttb(values, points):
+	"""
+	:param values: list of numbers, one a year
+	:param points: number of years to keep, at least MIN_POINTS
+	:return: list of the indices of the years to keep, in order
+	"""
+	n_values = len(values)
+	if n_values <= points:
+		return list(range(n_values))
+
+	bucket_size = (n_values - 2) / (points - 2)  # the first and last values get buckets of their own
+	indices = [0]
+	previous = 0
+	for bucket in range(points - 2):
+		start = int(bucket * bucket_size) + 1
+		end = int((bucket + 1) * bucket_size) + 1
+		next_end = min(int((bucket + 2) * bucket_size) + 1, n_values)
+		next_x = (end + next_end - 1) / 2
+		next_y = sum(values[end:next_end]) / (next_end - end)
+
+		previous_y = values[previous]
+		best, best_area = start, -1
+		for index in range(start, end):  # twice the triangle's area - only the comparison matters
+			area = abs((previous - next_x) * (values[index] - previous_y) - (previous - index) * (next_y - previous_y))
+			if area > best_area:
+				best, best_area = index, area
+		indices.append(best)
+		previous = best
+	indices.append(n_values - 1)
+	return indices
+
+
+def min_max(values, points):
+	"""
+	:param values: list of numbers, one a year
+	:param points: most years to keep, at least MIN_POINTS
+	:return: list of the indices of the years to keep, in order
+	"""
+	n_values = len(values)
+	if n_values <= points:
+		return list(range(n_values))
+
+	n_buckets = (points - 2) // 2  # two values a bucket, plus the first and last values
+	bucket_size = (n_values - 2) / n_buckets
+	indices = [0]
+	for bucket in range(n_buckets):
+		start = int(bucket * bucket_size) + 1
+		end = int((bucket + 1) * bucket_size) + 1
+		lowest = min(range(start, end), key=values.__getitem__)
+		highest = max(range(start, end), key=values.__getitem__)
+		indices.extend(sorted({lowest, highest}))
+	indices.append(n_values - 1)
+	return indices
+
+
+def downsample(values, points, method="lttb"):
+	"""
+	:param values: list of numbers, one a year
+	:param points: number of years to keep, at least MIN_POINTS
+	:param method: one of METHODS
+	:return: (list of the kept years' indices, list of their values)
+	"""
+	indices = lttb(values, points) if method == "lttb" else min_max(values, points)
+	return indices, [values[index] for index in indices]
+
+
+def cached_downsample(result, points, method="lttb"):
+	"""
+		downsample() for a stored ResultPercentile, cached
+	:param result: ResultPercentile
+	:return: (list of the kept years' indices, list of their values)
+	"""
+	key = "downsampled:{}:{}:{}:{}:{}".format(result.model_id, result.percentile, method, points, result.id)
+	cache = caches[CACHE_ALIAS]
+	series = cache.get(key)
+	if series is None:
+		series = downsample(result.values, points, method)
+		cache.set(key, series, timeout=settings.DOWNSAMPLE_CACHE_SECONDS)
+	return series
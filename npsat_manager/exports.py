@@ -0,0 +1,173 @@
+"""
+	Streams model run results out as CSV or Parquet, for analysis outside the site. The results are read from the
+	database in chunks and written out as they're read, so memory stays flat however many runs are exported, and
+	the response starts straight away and keeps sending - long exports don't sit silent until a worker times out.
+
+	Two sets of data can be exported:
+		percentiles - the stored percentiles of each run, from ResultPercentile
+		wells - each well's values, for the regions of each run whose results are in the region result cache
+				(see region_results). Regions that aren't cached are left out - their wells were never kept
+
+	in one of two layouts:
+		long - one row per value: the row's labels, then year_index and value
+		wide - one row per percentile or well: the row's labels, then a year_<n> column for each year. Runs with
+				fewer years than the longest one leave the rest empty
+
+	year_index counts years from the start of the run, 0 first.
+"""
+
+import csv
+import io
+
+from django.db.models import Max
+
+from npsat_backend import settings
+from npsat_manager import models
+
+FORMATS = ("csv", "parquet")
+CONTENT_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+LAYOUTS = ("long", "wide")
+DATA = ("percentiles", "wells")
+LABELS = {"percentiles": ("run_id", "run_name", "percentile"), "wells": ("run_id", "run_name", "region_id", "well")}
+
+
+def percentile_rows(runs):
+	"""
+	:param runs: queryset of ModelRuns
+	:return: generator of (labels, values) - one for each stored percentile of each run
+	"""
+	results = models.ResultPercentile.objects.filter(model__in=runs.values('id')).order_by('model_id', 'percentile')\
+		.values_list('model_id', 'model__name', 'percentile', 'values')
+	for run_id, run_name, percentile, values in results.iterator(chunk_size=settings.EXPORT_CHUNK_ROWS):
+		yield (run_id, run_name, percentile), values
+
+
+def well_rows(runs):
+	"""
+	:param runs: queryset of ModelRuns
+	:return: generator of (labels, values) - one for each well of each of the runs' cached regions
+	"""
+	from npsat_manager import region_results  # numpy
+
+	for model_run in runs.select_related(None).order_by('id').iterator(chunk_size=settings.EXPORT_CHUNK_ROWS):
+		for region_id, results in region_results.cached(model_run):
+			for well, values in enumerate(results):
+				yield (model_run.id, model_run.name, region_id, well), values.tolist()
+
+
+def columns(data, layout, n_years):
+	if layout == "long":
+		return LABELS[data] + ("year_index", "value")
+	return LABELS[data] + tuple("year_{}".format(year) for year in range(n_years))
+
+
+def table_rows(rows, layout, n_years):
+	"""
+		Lays (labels, values) rows out in the long or wide layout
+	:return: generator of tuples matching columns()
+	"""
+	for labels, values in rows:
+		if layout == "long":
+			for year, value in enumerate(values):
+				yield labels + (year, value)
+		else:
+			yield labels + tuple(values) + (None,) * (n_years - len(values))
+
+
+def _batches(rows, size):
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) == size:
+			yield batch
+			batch = []
+	if len(batch) > 0:
+		yield batch
+
+
+def write_csv(header, rows):
+	"""
+	:return: generator of CSV text, a batch of rows at a time
+	"""
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(header)
+	for batch in _batches(rows, settings.EXPORT_CHUNK_ROWS):
+		writer.writerows(batch)
+		yield buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate()
+	if buffer.tell() > 0:  # the header of an empty export
+		yield buffer.getvalue()
+
+
+class _ChunkSink(object):
+	"""
+		A write-only file for the Parquet writer that holds what's written until it's taken with take()
+	"""
+
+	def __init__(self):
+		self.closed = False
+		self._chunks = []
+		self._position = 0
+
+	def write(self, data):
+		self._chunks.append(bytes(data))
+		self._position += len(data)
+		return len(data)
+
+	def tell(self):
+		return self._position
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.closed = True
+
+	def take(self):
+		data = b"".join(self._chunks)
+		self._chunks = []
+		return data
+
+
+def write_parquet(header, rows, data):
+	"""
+	:return: generator of Parquet file bytes - a row group for each batch of rows
+	"""
+	import pyarrow  # optional - the caller checks compatibility.PYARROW first
+	import pyarrow.parquet
+
+	labels = LABELS[data]
+	fields = [pyarrow.field(name, pyarrow.string() if name == "run_name" else pyarrow.int64()) for name in labels]
+	fields += [pyarrow.field(name, pyarrow.int64() if name == "year_index" else pyarrow.float64()) for name in header[len(labels):]]
+	schema = pyarrow.schema(fields)
+
+	sink = _ChunkSink()
+	writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode="w"), schema)
+	for batch in _batches(rows, settings.EXPORT_CHUNK_ROWS):
+		batch_columns = zip(*batch)
+		writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(batch_columns, schema)],
+													 schema=schema))
+		yield sink.take()
+	writer.close()
+	yield sink.take()
+
+
+def export(runs, file_format="csv", layout="long", data="percentiles"):
+	"""
+	:param runs: queryset of the ModelRuns to export - only completed runs are included
+	:param file_format: "csv" or "parquet" - Parquet needs pyarrow
+	:param layout: "long" or "wide" - see the module docstring
+	:param data: "percentiles" or "wells" - see the module docstring
+	:return: generator of the export's bytes or text, for a StreamingHttpResponse
+	"""
+	runs = runs.filter(status=models.ModelRun.COMPLETED)
+	n_years = None
+	if layout == "wide":
+		n_years = runs.aggregate(n_years=Max('n_years'))['n_years'] or 0
+	header = columns(data, layout, n_years)
+	rows = table_rows(percentile_rows(runs) if data == "percentiles" else well_rows(runs), layout, n_years)
+	if file_format == "parquet":
+		return write_parquet(header, rows, data)
+	return write_csv(header, rows)
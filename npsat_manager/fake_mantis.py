@@ -0,0 +1,170 @@
+"""
+	A stand-in for the Mantis server, for exercising MantisServer.send_command, process_results and the
+	process_runs loop without the real Mantis binary. It speaks the same text protocol (see mantis_protocol) -
+	it reads a command up to ENDofMSG and sends back a synthetic (wells, years) matrix ending in EndOfMsg - and
+	can be told how big the response should be, how long to take, how to chunk it, and how often to fail.
+
+	Run it on its own with the fake_mantis management command, or in a background thread with start_in_thread,
+	which is what the benchmark_dispatcher command and the tests do.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+
+import numpy
+
+from npsat_manager import mantis_protocol
+
+log = logging.getLogger("npsat.fake_mantis")
+
+
+class FakeMantisConfig(object):
+
+	def __init__(self, n_wells=1000, latency=0.0, jitter=0.0, chunk_size=mantis_protocol.RECEIVE_SIZE,
+				 chunk_delay=0.0, error_rate=0.0, seed=None):
+		"""
+		:param n_wells: number of wells in every response
+		:param latency: seconds to wait before responding, standing in for Mantis's run time
+		:param jitter: up to this many seconds are added to the latency at random
+		:param chunk_size: bytes written at a time
+		:param chunk_delay: seconds to wait between chunks, standing in for a slow network
+		:param error_rate: fraction of commands, 0-1, that get a Mantis failure response instead of results
+		:param seed: seed for the jitter, errors and well values, for repeatable runs
+		"""
+		self.n_wells = n_wells
+		self.latency = latency
+		self.jitter = jitter
+		self.chunk_size = chunk_size
+		self.chunk_delay = chunk_delay
+		self.error_rate = error_rate
+		self.seed = seed
+
+
+def synthetic_results(n_wells, n_years, random_state):
+	"""
+		Well curves that look vaguely like Mantis output - concentrations that rise toward a plateau at a
+		different rate and level for each well
+	:return: 2D array of (n_wells, n_years)
+	"""
+	years = numpy.arange(n_years)[None, :]
+	plateaus = random_state.lognormal(mean=2, sigma=0.5, size=(n_wells, 1))
+	rates = random_state.uniform(0.01, 0.2, size=(n_wells, 1))
+	return plateaus * (1 - numpy.exp(-rates * years))
+
+
+def format_response(results):
+	"""
+	:param results: 2D array of (wells, years)
+	:return: response bytes, as Mantis would send them
+	"""
+	values = " ".join("{:.6g}".format(value) for value in results.ravel())
+	return "1 {} {} {}\n".format(results.shape[0], values, mantis_protocol.END_OF_RESPONSE).encode("utf-8")
+
+
+class FakeMantis(object):
+
+	def __init__(self, config=None):
+		self.config = config or FakeMantisConfig()
+		self.commands_received = 0
+		self._random = random.Random(self.config.seed)
+		self._numpy_random = numpy.random.default_rng(self.config.seed)
+
+	async def handle_connection(self, reader, writer):
+		try:
+			command = await reader.readuntil(mantis_protocol.END_OF_COMMAND.encode("utf-8"))
+		except asyncio.IncompleteReadError:
+			writer.close()
+			return
+
+		self.commands_received += 1
+		response = self.respond(command.decode("utf-8"))
+		await asyncio.sleep(self.config.latency + self._random.uniform(0, self.config.jitter))
+
+		for start in range(0, len(response), self.config.chunk_size):
+			writer.write(response[start:start + self.config.chunk_size])
+			await writer.drain()
+			if self.config.chunk_delay:
+				await asyncio.sleep(self.config.chunk_delay)
+
+		writer.close()
+
+	def respond(self, command):
+		"""
+		:param command: command text - the first value is the number of years
+		:return: response bytes
+		"""
+		try:
+			n_years = int(command.split()[0])
+		except (IndexError, ValueError):
+			return "0 Could not read the number of years {}\n".format(mantis_protocol.END_OF_RESPONSE).encode("utf-8")
+
+		if self._random.random() < self.config.error_rate:
+			return "0 Simulated Mantis failure {}\n".format(mantis_protocol.END_OF_RESPONSE).encode("utf-8")
+
+		return format_response(synthetic_results(self.config.n_wells, n_years, self._numpy_random))
+
+	async def serve(self, host="127.0.0.1", port=1234, started=None):
+		"""
+			Serves until cancelled
+		:param started: optional callback that gets the port once the server is listening - useful with port 0
+		"""
+		server = await asyncio.start_server(self.handle_connection, host, port)
+		port = server.sockets[0].getsockname()[1]
+		log.info("Fake Mantis listening on {}:{}".format(host, port))
+		if started:
+			started(port)
+		async with server:
+			await server.serve_forever()
+
+
+class FakeMantisThread(threading.Thread):
+	"""
+		Runs a FakeMantis in its own event loop on a daemon thread
+	"""
+
+	def __init__(self, fake_mantis, host="127.0.0.1", port=0):
+		super().__init__(daemon=True)
+		self.fake_mantis = fake_mantis
+		self.host = host
+		self.port = port
+		self._ready = threading.Event()
+		self._loop = None
+		self._task = None
+
+	def run(self):
+		self._loop = asyncio.new_event_loop()
+		self._task = self._loop.create_task(self.fake_mantis.serve(self.host, self.port, started=self._listening))
+		try:
+			self._loop.run_until_complete(self._task)
+		except asyncio.CancelledError:
+			pass
+		finally:
+			self._loop.close()
+
+	def _listening(self, port):
+		self.port = port
+		self._ready.set()
+
+	def wait_until_ready(self, timeout=10):
+		if not self._ready.wait(timeout):
+			raise RuntimeError("Fake Mantis didn't start listening within {} seconds".format(timeout))
+
+	def stop(self):
+		if self._loop is not None and self._task is not None:
+			self._loop.call_soon_threadsafe(self._task.cancel)
+		self.join(timeout=10)
+
+
+def start_in_thread(config=None, host="127.0.0.1", port=0):
+	"""
+		Starts a fake Mantis server in the background
+	:param config: FakeMantisConfig
+	:param port: port to listen on - 0 picks a free one
+	:return: FakeMantisThread - its port attribute is the port it's listening on. Call stop() when done
+	"""
+	thread = FakeMantisThread(FakeMantis(config), host, port)
+	thread.start()
+	thread.wait_until_ready()
+	return thread
@@ -0,0 +1,187 @@
+"""
+	Compiled kernels for the in-process model. Everything in here takes and returns plain numpy arrays - no
+	GDAL, Django, or printing - so that Numba can compile them in nopython mode, run the cell loops in parallel,
+	and cache the machine code on disk between processes. The I/O around them lives in mantis_numba.
+
+	Arrays are laid out as (cells, years) so that each cell's time series is contiguous in memory. Loadings
+	should have no NaNs (fill nodata with 0 first) since the kernels are compiled with fastmath.
+
+	If Numba isn't installed, the same functions run as (slow) plain Python so results stay available.
+"""
+
+import logging
+import time
+
+import numpy
+
+from npsat_manager.support import compatibility
+
+log = logging.getLogger("npsat.kernels")
+
+if compatibility.NUMBA:
+	from numba import njit, prange, get_num_threads
+else:
+	def njit(*args, **kwargs):
+		if len(args) == 1 and callable(args[0]):
+			return args[0]
+		return lambda function: function
+
+	prange = range
+
+	def get_num_threads():
+		return 1
+
+
+PRECISIONS = {
+	"float32": numpy.float32,
+	"float64": numpy.float64,
+}
+
+
+def dtype_for(precision):
+	"""
+		Maps a precision setting (settings.MANTIS_PRECISION) to the numpy dtype the model arrays should use.
+		Either way, the per-year sums are accumulated in float64.
+	:param precision: "float32" or "float64"
+	:return: numpy dtype class
+	"""
+	try:
+		return PRECISIONS[precision]
+	except KeyError:
+		raise ValueError("Unknown precision {} - must be one of {}".format(precision, ", ".join(PRECISIONS)))
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def reclassify(land_use, codes, weights, default_weight):
+	"""
+		Turns land use codes into loading weights.
+	:param land_use: 1D int64 array of land use codes, one per cell
+	:param codes: 1D int64 array of the land use (caml) codes that have weights
+	:param weights: 1D float array of weights matching codes
+	:param default_weight: weight for cells whose code isn't in codes, same dtype as weights
+	:return: 1D array of weights, one per cell
+	"""
+	output = numpy.empty(land_use.shape[0], dtype=weights.dtype)
+	for cell in prange(land_use.shape[0]):
+		value = default_weight
+		for index in range(codes.shape[0]):
+			if land_use[cell] == codes[index]:
+				value = weights[index]
+				break
+		output[cell] = value
+	return output
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def interpolate_years(known_values, known_years, first_year, n_years):
+	"""
+		Linearly interpolates each cell's loading between the years we have rasters for.
+	:param known_values: 2D array of (cells, known years) loadings
+	:param known_years: 1D int64 array of the years in known_values, ascending, at least two of them
+	:param first_year: first year of the output
+	:param n_years: number of years in the output
+	:return: 2D array of (cells, n_years) loadings
+	"""
+	n_cells = known_values.shape[0]
+	last_segment = known_years.shape[0] - 2
+	output = numpy.empty((n_cells, n_years), dtype=known_values.dtype)
+	for cell in prange(n_cells):
+		segment = 0
+		for offset in range(n_years):
+			year = first_year + offset
+			while segment < last_segment and year >= known_years[segment + 1]:
+				segment += 1
+			fraction = (year - known_years[segment]) / (known_years[segment + 1] - known_years[segment])
+			start = known_values[cell, segment]
+			output[cell, offset] = start + fraction * (known_values[cell, segment + 1] - start)
+	return output
+
+
+def convolve_and_sum(loadings, unit_response_functions):
+	"""
+		Convolves each cell's loading with its unit response function and sums across cells, giving the
+		total response for each year. The convolution is causal - loading in a year only affects that year and
+		later ones. Sums are accumulated in float64 regardless of the input dtype.
+	:param loadings: 2D array of (cells, years)
+	:param unit_response_functions: 2D array of (cells, years into the future) - can be shorter than the loadings
+	:return: 1D float64 array with one value per year
+	"""
+	# the thread count is looked up out here - reading it inside the kernel stops Numba from caching it
+	n_chunks = max(1, min(get_num_threads(), loadings.shape[0]))
+	return _convolve_and_sum(loadings, unit_response_functions, n_chunks)
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _convolve_and_sum(loadings, unit_response_functions, n_chunks):
+	n_cells, n_years = loadings.shape
+	urf_length = min(unit_response_functions.shape[1], n_years)
+	chunk_size = (n_cells + n_chunks - 1) // n_chunks
+
+	partial_sums = numpy.zeros((n_chunks, n_years), dtype=numpy.float64)  # one row per thread, so no write races
+	for chunk in prange(n_chunks):
+		for cell in range(chunk * chunk_size, min(n_cells, (chunk + 1) * chunk_size)):
+			for year in range(n_years):
+				loading = loadings[cell, year]
+				if loading == 0:
+					continue
+				for lag in range(min(urf_length, n_years - year)):
+					partial_sums[chunk, year + lag] += loading * unit_response_functions[cell, lag]
+
+	return partial_sums.sum(axis=0)
+
+
+def convolve_sparse_and_sum(loadings, urf_rows, offsets, values):
+	"""
+		Same as convolve_and_sum, but reads each cell's unit response function out of the truncated CSR layout
+		of a urf_store.URFStore instead of a dense array.
+	:param loadings: 2D array of (cells, years)
+	:param urf_rows: 1D int64 array with, for each cell in loadings, its row in the store - -1 when the cell has
+					no unit response function (no wells), in which case it's skipped
+	:param offsets: URFStore.offsets - values[offsets[row]:offsets[row + 1]] is the response for lags 0, 1, ...
+	:param values: URFStore.values
+	:return: 1D float64 array with one value per year
+	"""
+	n_chunks = max(1, min(get_num_threads(), loadings.shape[0]))
+	return _convolve_sparse_and_sum(loadings, urf_rows, offsets, values, n_chunks)
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _convolve_sparse_and_sum(loadings, urf_rows, offsets, values, n_chunks):
+	n_cells, n_years = loadings.shape
+	chunk_size = (n_cells + n_chunks - 1) // n_chunks
+
+	partial_sums = numpy.zeros((n_chunks, n_years), dtype=numpy.float64)
+	for chunk in prange(n_chunks):
+		for cell in range(chunk * chunk_size, min(n_cells, (chunk + 1) * chunk_size)):
+			row = urf_rows[cell]
+			if row < 0:
+				continue
+			start = offsets[row]
+			urf_length = min(offsets[row + 1] - start, n_years)
+			for year in range(n_years):
+				loading = loadings[cell, year]
+				if loading == 0:
+					continue
+				for lag in range(min(urf_length, n_years - year)):
+					partial_sums[chunk, year + lag] += loading * values[start + lag]
+
+	return partial_sums.sum(axis=0)
+
+
+def warm_up():
+	"""
+		Compiles every kernel for float32 and float64 inputs - or, when the on-disk cache is already populated,
+		just loads it. Call this when a worker starts so the first user's run doesn't pay for compilation.
+	"""
+	start_time = time.time()
+	for dtype in (numpy.float32, numpy.float64):
+		land_use = numpy.array([1, 2, 3, 4], dtype=numpy.int64)
+		weights = reclassify(land_use, numpy.array([2], dtype=numpy.int64), numpy.array([0.5], dtype=dtype), dtype(1))
+		known_values = numpy.ones((4, 2), dtype=dtype) * weights[:, None]
+		loadings = interpolate_years(known_values, numpy.array([1945, 1950], dtype=numpy.int64), 1945, 5)
+		convolve_and_sum(loadings, numpy.ones((4, 5), dtype=dtype))
+		convolve_sparse_and_sum(loadings, numpy.array([0, -1, 0, 0], dtype=numpy.int64),
+								numpy.array([0, 3], dtype=numpy.int64), numpy.ones(3, dtype=numpy.float32))
+
+	log.info("Kernels ready in {:.2f} seconds (numba {})".format(time.time() - start_time,
+																	 "enabled" if compatibility.NUMBA else "unavailable"))
@@ -11,6 +11,9 @@ def load_all():
 	load_crops()
 	load_regions()
 
+	from npsat_manager import region_overlap  # numpy - only needed once the regions are in
+	region_overlap.build()
+
 
 def load_regions():
 	load_counties()
@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+import numpy
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+
+from npsat_backend import settings
+from npsat_manager import fake_mantis, models
+from npsat_manager.management.commands import process_runs
+from npsat_manager.management.commands.fake_mantis import add_fake_mantis_arguments, config_from_options
+
+try:
+	import resource  # not available on Windows
+except ImportError:
+	resource = None
+
+log = logging.getLogger("npsat.commands.benchmark_dispatcher")
+
+RUN_NAME = "dispatcher benchmark"
+SUBMIT_ATTEMPTS = 5  # SQLite refuses writes while another thread holds its lock - retry a submission this many times
+
+
+class TimedDispatcher(process_runs.Command):
+	"""
+		The real dispatcher, recording when each run was picked up and how long it took
+	"""
+
+	def __init__(self, mantis_server):
+		super().__init__()
+		self.mantis_server = mantis_server
+		self.started = {}
+		self.service_times = []
+
+	def dispatch(self, run, attempt, mantis_server):
+		self.started[run.id] = time.time()
+		super().dispatch(run, attempt, mantis_server)
+		self.service_times.append(time.time() - self.started[run.id])
+
+
+def summarize(values):
+	if len(values) == 0:
+		return None
+	return {"p50": float(numpy.percentile(values, 50)), "p95": float(numpy.percentile(values, 95)),
+			"p99": float(numpy.percentile(values, 99)), "max": float(numpy.max(values))}
+
+
+class Command(BaseCommand):
+	help = 'Measures dispatcher throughput, queue latency and memory against a fake Mantis server under concurrent submissions'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--runs', type=int, default=50, help="Total runs to submit")
+		parser.add_argument('--submitters', type=int, default=4, help="Threads submitting runs at the same time")
+		parser.add_argument('--interval', type=float, default=0.0, help="Seconds each submitter waits between runs")
+		parser.add_argument('--years', type=int, default=100, help="n_years for each run")
+		parser.add_argument('--username', type=str, default=None, help="User to submit as - defaults to the first superuser")
+		parser.add_argument('--mantis-host', type=str, default=None,
+							help="Benchmark against a Mantis server (real or fake) that's already running instead of starting a fake one")
+		parser.add_argument('--mantis-port', type=int, default=1234)
+		parser.add_argument('--timeout', type=float, default=600, help="Give up after this many seconds")
+		parser.add_argument('--keep', action='store_true', help="Keep the benchmark runs instead of deleting them afterward")
+		add_fake_mantis_arguments(parser)
+
+	def handle(self, *args, **options):
+		user, region, scenarios, crop = self._fixtures(options['username'])
+
+		fake_server = None
+		if options['mantis_host'] is None:
+			fake_server = fake_mantis.start_in_thread(config_from_options(options))
+			host, port = fake_server.host, fake_server.port
+		else:
+			host, port = options['mantis_host'], options['mantis_port']
+		mantis_server = models.MantisServer.objects.create(host=host, port=port, online=True)
+
+		# the benchmark is of the Mantis path, so don't let precomputed responses or cached regions short circuit it
+		response_basis_enabled = settings.RESPONSE_BASIS_ENABLED
+		region_result_cache_enabled = settings.REGION_RESULT_CACHE_ENABLED
+		settings.RESPONSE_BASIS_ENABLED = False
+		settings.REGION_RESULT_CACHE_ENABLED = False
+
+		submitted = []
+		self.submission_errors = 0
+		self.lock_retries = 0
+		submitters = [threading.Thread(target=self._submit, args=(count, options, user, region, scenarios, crop, submitted))
+					  for count in self._split(options['runs'], options['submitters'])]
+		dispatcher = TimedDispatcher(mantis_server)
+
+		tracemalloc.start()
+		start_time = time.time()
+		try:
+			for submitter in submitters:
+				submitter.start()
+
+			while time.time() - start_time < options['timeout']:
+				try:
+					dispatcher.process_waiting_runs()
+					if not any(submitter.is_alive() for submitter in submitters) and \
+							not models.ModelRun.objects.filter(id__in=list(submitted), status__in=(models.ModelRun.READY, models.ModelRun.RUNNING)).exists():
+						break
+				except DatabaseError:  # SQLite locks readers out while a submitter writes - look again shortly
+					self.lock_retries += 1
+				time.sleep(0.01)
+			elapsed = time.time() - start_time
+			_, peak_memory = tracemalloc.get_traced_memory()
+		finally:
+			tracemalloc.stop()
+			settings.RESPONSE_BASIS_ENABLED = response_basis_enabled
+			settings.REGION_RESULT_CACHE_ENABLED = region_result_cache_enabled
+			for submitter in submitters:
+				submitter.join()
+			if fake_server is not None:
+				fake_server.stop()
+
+		report = self._report(submitted, dispatcher, elapsed, peak_memory, options)
+		report["submission_errors"] = self.submission_errors
+		report["dispatcher_lock_retries"] = self.lock_retries
+
+		mantis_server.delete()
+		if not options['keep']:
+			models.ModelRun.objects.filter(id__in=list(submitted)).delete()
+
+		self.stdout.write(json.dumps(report, indent=4))
+		if self.submission_errors > 0:  # fewer runs competed for the dispatcher than asked for, so the numbers mislead
+			raise CommandError("{} of {} runs couldn't be submitted - the report above doesn't measure the requested load. "
+							   "Use fewer submitters, or benchmark against PostgreSQL".format(self.submission_errors, options['runs']))
+
+	@staticmethod
+	def _split(total, parts):
+		return [total // parts + (1 if index < total % parts else 0) for index in range(parts)]
+
+	def _fixtures(self, username):
+		if username:
+			user = User.objects.filter(username=username).first()
+		else:
+			user = User.objects.filter(is_superuser=True).order_by('id').first()
+		region = models.Region.objects.filter(region_type="Central Valley").first()
+		scenarios = [models.Scenario.objects.filter(scenario_type=scenario_type).first()
+					 for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		crop = models.Crop.objects.exclude(caml_code=None).exclude(caml_code=0).first()
+		if user is None or region is None or None in scenarios or crop is None:
+			raise CommandError("Benchmarking needs a user, the Central Valley region, a scenario of each type and a crop - run load_initial_data first")
+		return user, region, scenarios, crop
+
+	def _submit(self, count, options, user, region, scenarios, crop, submitted):
+		"""
+			Submits runs the way the API does - the run, its region and modifications, then marks it ready
+		"""
+		try:
+			for index in range(count):
+				model_run = None
+				for attempt in range(SUBMIT_ATTEMPTS):
+					try:
+						with transaction.atomic():  # so a refused write doesn't leave half a run behind
+							model_run = models.ModelRun.objects.create(name=RUN_NAME, user=user, n_years=options['years'],
+																	   flow_scenario=scenarios[0], load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+							model_run.regions.add(region)
+							models.Modification.objects.create(model_run=model_run, crop=crop, proportion=0.5)
+							model_run.status = models.ModelRun.READY
+							model_run.save()
+						break
+					except DatabaseError as error:  # SQLite can refuse concurrent writes
+						model_run, last_error = None, error
+						time.sleep(0.05 * 2 ** attempt)
+				if model_run is None:
+					log.error("Failed to submit a benchmark run after {} attempts: {}".format(SUBMIT_ATTEMPTS, last_error))
+					self.submission_errors += 1
+					continue
+				submitted.append(model_run.id)
+				if options['interval']:
+					time.sleep(options['interval'])
+		finally:
+			connection.close()  # each thread gets its own database connection
+
+	@staticmethod
+	def _report(submitted, dispatcher, elapsed, peak_memory, options):
+		runs = models.ModelRun.objects.filter(id__in=list(submitted))
+		completed = [run for run in runs if run.status == models.ModelRun.COMPLETED]
+		queue_latencies = [dispatcher.started[run.id] - run.date_submitted.timestamp() for run in runs if run.id in dispatcher.started]
+		end_to_end = [(run.date_completed - run.date_submitted).total_seconds() for run in completed]
+
+		report = {
+			"runs_submitted": len(submitted),
+			"runs_completed": len(completed),
+			"runs_errored": sum(1 for run in runs if run.status == models.ModelRun.ERROR),
+			"wells_per_run": options['wells'] if options['mantis_host'] is None else None,
+			"elapsed_seconds": elapsed,
+			"throughput_runs_per_second": len(completed) / elapsed if elapsed > 0 else None,
+			"queue_latency_seconds": summarize(queue_latencies),
+			"service_time_seconds": summarize(dispatcher.service_times),
+			"end_to_end_seconds": summarize(end_to_end),
+			"percentile_mode": settings.PERCENTILE_MODE,
+			"peak_traced_memory_mb": peak_memory / 2 ** 20,
+		}
+		if resource is not None:
+			report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+		return report
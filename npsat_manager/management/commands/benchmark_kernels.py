@@ -0,0 +1,53 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from npsat_backend import settings
+from npsat_manager import benchmarks
+
+log = logging.getLogger("npsat.commands.benchmark_kernels")
+
+
+def _grid_size(value):
+	rows, _, cols = value.partition("x")
+	return int(rows), int(cols or rows)
+
+
+class Command(BaseCommand):
+	help = 'Times the in-process model engines on synthetic rasters and records the results to the benchmark history'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--sizes', type=str, default="64x64,256x256", help="Comma separated grid sizes, as ROWSxCOLS")
+		parser.add_argument('--years', type=str, default="50,105", help="Comma separated year counts")
+		parser.add_argument('--engines', type=str, default=",".join(benchmarks.ENGINES),
+							help="Comma separated engines to run, from: {}".format(", ".join(benchmarks.ENGINES)))
+		parser.add_argument('--precision', type=str, default=settings.MANTIS_PRECISION)
+		parser.add_argument('--repeats', type=int, default=3)
+		parser.add_argument('--history', type=str, default=settings.KERNEL_BENCHMARK_HISTORY, help="JSON file to append results to")
+		parser.add_argument('--threshold', type=float, default=0.2, help="Fraction slower than the last run that counts as a regression")
+		parser.add_argument('--no-save', action='store_true', help="Compare against the history without adding to it")
+
+	def handle(self, *args, **options):
+		engines = [engine.strip() for engine in options['engines'].split(",") if engine.strip()]
+		unknown = [engine for engine in engines if engine not in benchmarks.ENGINES]
+		if unknown:
+			raise CommandError("Unknown engines {}".format(", ".join(unknown)))
+
+		results = benchmarks.run_suite(grid_sizes=[_grid_size(size) for size in options['sizes'].split(",")],
+									   year_counts=[int(years) for years in options['years'].split(",")],
+									   engines=engines, precision=options['precision'], repeats=options['repeats'])
+		entry = benchmarks.make_entry(results)
+
+		for result in results:
+			self.stdout.write("{engine:>13} {step:>21} {rows:>5}x{cols:<5} {years:>4} years {best_seconds:10.4f}s "
+							  "{cell_years_per_second:14.0f} cell-years/s {peak_traced_mb:9.1f} MB".format(**result))
+
+		history = benchmarks.load_history(options['history'])
+		regressions = benchmarks.find_regressions(history, entry, threshold=options['threshold'])
+		for regression in regressions:
+			self.stderr.write("Regression: {}".format(json.dumps(regression)))
+
+		if not options['no_save']:
+			history.append(entry)
+			benchmarks.save_history(options['history'], history)
@@ -0,0 +1,89 @@
+import concurrent.futures
+import http.client
+import json
+import logging
+import time
+import urllib.parse
+
+from django.core.management.base import BaseCommand, CommandError
+
+from npsat_manager.support import timing
+
+log = logging.getLogger("npsat.commands.benchmark_server")
+
+
+def _fetch_repeatedly(url, headers, n_requests):
+	"""
+		Makes n_requests GETs to url over one keep-alive connection. Runs in its own process so the client's GIL
+		isn't what limits the rate
+	:return: (list of seconds per request, number of requests that didn't come back 200)
+	"""
+	parsed = urllib.parse.urlsplit(url)
+	path = parsed.path + ("?" + parsed.query if parsed.query else "")
+	connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+	durations = []
+	failures = 0
+	for request in range(n_requests):
+		start_time = time.perf_counter()
+		connection.request("GET", path, headers=headers)
+		response = connection.getresponse()
+		response.read()
+		durations.append(time.perf_counter() - start_time)
+		if response.status != 200:
+			failures += 1
+		if response.getheader("Connection", "").lower() == "close":
+			connection.close()
+			connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+	connection.close()
+	return durations, failures
+
+
+class Command(BaseCommand):
+	help = 'Measures requests per second and latency of a running server on a set of endpoints - see serving.md'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--url', type=str, default="http://127.0.0.1:8010", help="Base URL of the running server")
+		parser.add_argument('--endpoints', type=str, default="/api/model_run/,/api/region/",
+							help="Comma separated paths to benchmark, one after the other")
+		parser.add_argument('--token', type=str, default=None, help="API token to send, for endpoints that need a login")
+		parser.add_argument('--concurrency', type=int, default=8, help="Client processes making requests at the same time")
+		parser.add_argument('--requests', type=int, default=50, help="Requests each client process makes per endpoint")
+		parser.add_argument('--warmup', type=int, default=5, help="Untimed requests per endpoint before measuring")
+		parser.add_argument('--output', type=str, default=None, help="Optional JSON file to write the report to")
+
+	def handle(self, *args, **options):
+		headers = {"Accept": "application/json"}
+		if options['token']:
+			headers["Authorization"] = "Token {}".format(options['token'])
+
+		report = {"url": options['url'], "concurrency": options['concurrency'], "endpoints": {}}
+		with concurrent.futures.ProcessPoolExecutor(max_workers=options['concurrency']) as pool:
+			for endpoint in [endpoint.strip() for endpoint in options['endpoints'].split(",") if endpoint.strip()]:
+				url = options['url'].rstrip("/") + endpoint
+				try:
+					_fetch_repeatedly(url, headers, options['warmup'])
+				except OSError as error:
+					raise CommandError("Couldn't reach {}: {}".format(url, error))
+
+				start_time = time.perf_counter()
+				clients = [pool.submit(_fetch_repeatedly, url, headers, options['requests']) for client in range(options['concurrency'])]
+				outcomes = [client.result() for client in clients]
+				elapsed = time.perf_counter() - start_time
+
+				durations = [duration for client_durations, failures in outcomes for duration in client_durations]
+				latency = timing.summarize([{"latency": duration} for duration in durations], ["latency"], percentiles=(50, 95, 99))["latency"]
+				result = {
+					"requests": len(durations),
+					"failures": sum(failures for client_durations, failures in outcomes),
+					"seconds": elapsed,
+					"requests_per_second": len(durations) / elapsed,
+					"latency": latency,
+				}
+				report["endpoints"][endpoint] = result
+				self.stdout.write("{:<30} {:8.1f} req/s  p50 {:7.1f} ms  p95 {:7.1f} ms  p99 {:7.1f} ms  {} failed".format(
+					endpoint, result["requests_per_second"], latency["p50"] * 1000, latency["p95"] * 1000, latency["p99"] * 1000,
+					result["failures"]))
+
+		if options['output']:
+			with open(options['output'], 'w') as output:
+				json.dump(report, output, indent=1)
@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from npsat_backend import settings
+from npsat_manager import models, region_masks
+
+log = logging.getLogger("npsat.commands.build_region_masks")
+
+
+class Command(BaseCommand):
+	help = 'Rasterizes every Region onto the model grid and saves the region mask index used by the in-process model'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--raster', default=settings.REGION_MASK_REFERENCE_RASTER,
+							help="Raster whose grid the masks should align with")
+		parser.add_argument('--output', default=settings.REGION_MASK_INDEX,
+							help="Path of the .npz file to write the index to")
+
+	def handle(self, *args, **options):
+		grid = region_masks.RasterGrid.from_raster(options['raster'])
+		regions = models.Region.objects.exclude(geometry=None).order_by('id')
+		index = region_masks.RegionMaskIndex.build(regions, grid)
+		index.save(options['output'])
+
+		total_cells = sum(mask.cell_count for mask in index.masks.values())
+		log.info("Saved masks for {} regions ({} cells total) to {}".format(len(index.masks), total_cells, options['output']))
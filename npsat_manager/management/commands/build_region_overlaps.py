@@ -0,0 +1,21 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from npsat_backend import settings
+from npsat_manager import region_overlap
+
+log = logging.getLogger("npsat.commands.build_region_overlaps")
+
+
+class Command(BaseCommand):
+	help = 'Computes how much of each region lies in each region of every other type, for the region_overlap API'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=None, help="Processes to rasterize regions in - defaults to one per core")
+		parser.add_argument('--cell-size', type=float, default=settings.REGION_OVERLAP_CELL_SIZE,
+							help="Size in degrees of the grid cells regions are rasterized onto")
+
+	def handle(self, *args, **options):
+		stored = region_overlap.build(workers=options['workers'], cell_size=options['cell_size'])
+		log.info("Stored {} region overlaps".format(stored))
@@ -0,0 +1,30 @@
+import logging
+import os
+
+from django.core.management.base import BaseCommand
+
+from npsat_backend import settings
+from npsat_manager import urf_store
+from npsat_manager.support import compatibility
+
+log = logging.getLogger("npsat.commands.build_urf_store")
+
+
+class Command(BaseCommand):
+	help = 'Converts a dense multiband unit response function raster (one band per year) into a truncated sparse URF store'
+
+	def add_arguments(self, parser):
+		parser.add_argument('raster', help="Multiband URF raster - band 1 is lag 0")
+		parser.add_argument('name', help="Scenario name to save the store under in settings.URF_STORE_FOLDER")
+		parser.add_argument('--tolerance', type=float, default=settings.URF_STORE_TOLERANCE,
+							help="Cut each URF off once it drops below this fraction of its peak")
+
+	def handle(self, *args, **options):
+		cube = compatibility.raster_bands_to_numpy_array(options['raster'])
+		store = urf_store.URFStore.from_dense(cube, tolerance=options['tolerance'])
+		del cube
+
+		folder = os.path.join(settings.URF_STORE_FOLDER, options['name'])
+		store.save(folder)
+		log.info("Saved URFs for {} cells to {} - {:.1f} MB instead of {:.1f} MB dense".format(
+			len(store.cell_index), folder, store.nbytes / 1e6, store.dense_nbytes / 1e6))
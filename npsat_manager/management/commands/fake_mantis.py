@@ -0,0 +1,40 @@
+import asyncio
+import logging
+
+from django.core.management.base import BaseCommand
+
+from npsat_manager import fake_mantis
+
+log = logging.getLogger("npsat.commands.fake_mantis")
+
+
+def add_fake_mantis_arguments(parser):
+	parser.add_argument('--wells', type=int, default=1000, help="Number of wells in every response")
+	parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before responding")
+	parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many extra seconds are added to the latency at random")
+	parser.add_argument('--chunk-size', type=int, default=65536, help="Bytes to write at a time")
+	parser.add_argument('--chunk-delay', type=float, default=0.0, help="Seconds to wait between chunks")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of commands, 0-1, that fail")
+	parser.add_argument('--seed', type=int, default=None)
+
+
+def config_from_options(options):
+	return fake_mantis.FakeMantisConfig(n_wells=options['wells'], latency=options['latency'], jitter=options['jitter'],
+										chunk_size=options['chunk_size'], chunk_delay=options['chunk_delay'],
+										error_rate=options['error_rate'], seed=options['seed'])
+
+
+class Command(BaseCommand):
+	help = 'Runs a stand-in Mantis server that answers commands with synthetic results, for testing and benchmarking'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--host', type=str, default="127.0.0.1")
+		parser.add_argument('--port', type=int, default=1234)
+		add_fake_mantis_arguments(parser)
+
+	def handle(self, *args, **options):
+		server = fake_mantis.FakeMantis(config_from_options(options))
+		try:
+			asyncio.run(server.serve(options['host'], options['port']))
+		except KeyboardInterrupt:
+			log.info("Fake Mantis stopped after {} commands".format(server.commands_received))
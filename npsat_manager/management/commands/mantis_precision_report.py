@@ -0,0 +1,27 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+
+from npsat_manager import mantis, models
+
+log = logging.getLogger("npsat.commands.mantis_precision_report")
+
+
+class Command(BaseCommand):
+	help = 'Runs the in-process model in float32 and float64 on the configured rasters (Tulare) and reports the difference'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--model-run', type=int, default=None,
+							help="ID of a ModelRun whose modifications and regions should be used. Without it, runs with no modifications on the full rasters")
+
+	def handle(self, *args, **options):
+		modifications = []
+		regions = None
+		if options['model_run'] is not None:
+			model_run = models.ModelRun.objects.get(id=options['model_run'])
+			modifications = list(model_run.modifications.select_related('crop'))
+			regions = list(model_run.regions.all()) or None
+
+		report = mantis.precision_report(modifications, regions=regions)
+		self.stdout.write(json.dumps(report, indent=4))
@@ -0,0 +1,31 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from npsat_manager import models, response_basis
+
+log = logging.getLogger("npsat.commands.precompute_response_basis")
+
+
+class Command(BaseCommand):
+	help = 'Runs Mantis for the base curves and each crop response of every region so that runs that only change crop loadings can skip Mantis'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--base-run', type=int, required=True,
+							help="ID of the ModelRun whose scenarios, years and water content to precompute for")
+		parser.add_argument('--region-type', default=None,
+							help="Only precompute regions of this type (County, CVHMFarm, etc). Defaults to all active regions")
+
+	def handle(self, *args, **options):
+		base_run = models.ModelRun.objects.select_related('flow_scenario', 'load_scenario', 'unsat_scenario').get(id=options['base_run'])
+
+		server = models.MantisServer.objects.filter(online=True).first()
+		if server is None:
+			raise CommandError("No Mantis server is online")
+
+		regions = models.Region.objects.filter(active_in_mantis=True).order_by('id')
+		if options['region_type']:
+			regions = regions.filter(region_type=options['region_type'])
+
+		bases = response_basis.precompute(base_run, regions, server)
+		log.info("Precomputed response bases for {} regions".format(len(bases)))
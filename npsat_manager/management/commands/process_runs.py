@@ -1,19 +1,48 @@
 import logging
+import threading
 import time
 import datetime
 
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.db.models import Count, Q
+from django.utils import timezone
 
-from npsat_manager import mantis_manager, models
+from npsat_backend import settings
+from npsat_manager import kernels, mantis_manager, models, run_queue, scheduler
+from npsat_manager.support import metrics
 
 log = logging.getLogger("npsat.commands.process_runs")
 
+CLAIM_BATCH = 20  # waiting runs to try claiming at a time, in the scheduler's order - other workers may claim some first
+
+QUEUE_DEPTH = metrics.gauge("npsat_runs", "Number of model runs in each status", labels=("status",))
+
+
+def update_queue_depth():
+	counts = dict(models.ModelRun.objects.values_list('status').annotate(Count('id')).order_by())
+	for status, name in models.ModelRun.STATUS_NAMES.items():
+		QUEUE_DEPTH.labels(status=name).set(counts.get(status, 0))
+
 
 class Command(BaseCommand):
 	help = 'Starts the event loop that processes model runs and sends the commands to Mantis'
 
+	def add_arguments(self, parser):
+		parser.add_argument('--metrics-port', type=int, default=settings.DISPATCHER_METRICS_PORT,
+							help="Port to serve dispatcher metrics on at /metrics. Negative to turn the exporter off")
+
 	def handle(self, *args, **options):
+		if options.get('metrics_port') is not None and options['metrics_port'] >= 0:
+			metrics.start_exporter(options['metrics_port'], host=settings.DISPATCHER_METRICS_HOST)
+
+		# compile (or load the cached) model kernels now so that a run handled in process doesn't pay for it
+		try:
+			kernels.warm_up()
+		except Exception:
+			log.warning("Couldn't warm up model kernels - they'll compile on first use instead", exc_info=True)
+
 		self.mantis_server = None
 		self.last_warning_time = 0
 
@@ -22,9 +51,8 @@ class Command(BaseCommand):
 			mantis_servers = mantis_manager.initialize()
 			# asyncio.run(mantis_manager.main_model_run_loop(mantis_servers))  # see note on main_model_run_loop for why we're not using it
 
-			self._waiting_runs = []
 			if len(mantis_servers) > 0:
-				self.mantis_server = mantis_servers[0]  # leaving in place the infra for multiple servers in the future, but we'll use one for now
+				self.mantis_server = mantis_servers[0]
 			else:
 				# warn once a day if run processing isn't happening
 				if datetime.datetime.utcnow().timestamp() - 86400 > self.last_warning_time:
@@ -32,21 +60,93 @@ class Command(BaseCommand):
 					self.last_warning_time = datetime.datetime.utcnow().timestamp()
 				time.sleep(60)  # if we don't have a mantis server, sleep for 60 seconds, then try again
 
-		self.process_runs()
+		# a worker per run each server can handle at once, all claiming runs from the shared queue, so a server going
+		# down only slows the queue. Each worker gets its own copy of its server's record, since send_command updates
+		# the record's recent scenarios
+		for mantis_server in mantis_servers:
+			for index in range(max(mantis_server.capacity, 1)):
+				worker_server = models.MantisServer.objects.get(id=mantis_server.id)
+				threading.Thread(target=self.process_runs, args=(worker_server,), daemon=True,
+								 name="worker-{}-{}".format(mantis_server.address, index)).start()
+		self.sweep_runs()
 
-	def process_runs(self):
+	def sweep_runs(self):
+		"""
+			Requeues runs whose workers stopped responding, every settings.RUN_SWEEP_SECONDS
+		"""
 		while True:
-			self._get_runs()
+			time.sleep(settings.RUN_SWEEP_SECONDS)
+			try:
+				run_queue.sweep()
+				update_queue_depth()
+			except Exception:
+				log.exception("Failed to sweep expired runs")
+			finally:
+				close_old_connections()
 
-			if len(self._waiting_runs) == 0:  # if we don't have any runs, go to sleep for a few seconds, then check again
-				time.sleep(2)
+	def process_runs(self, mantis_server=None):
+		"""
+			Processes runs on one Mantis server until the dispatcher stops. Runs in that server's worker thread
+		"""
+		mantis_server = mantis_server or self.mantis_server
+		while True:
+			try:
+				processed = self.process_waiting_runs(mantis_server)
+			except OSError as error:  # the attempt is already requeued - give the server a chance to come back
+				log.warning("Couldn't reach Mantis server {} - pausing its worker for {} seconds: {}".format(
+					mantis_server.address, settings.MANTIS_SERVER_RETRY_SECONDS, error))
+				time.sleep(settings.MANTIS_SERVER_RETRY_SECONDS)
 				continue
+			finally:
+				close_old_connections()
+			if processed == 0:  # if we don't have any runs, go to sleep for a few seconds, then check again
+				time.sleep(2)
+
+	def process_waiting_runs(self, mantis_server=None):
+		"""
+			Sends runs to Mantis one at a time until there are none left to claim
+		:param mantis_server: MantisServer to send them to - self.mantis_server by default
+		:return: number of runs processed. Raises OSError if the server couldn't be reached
+		"""
+		mantis_server = mantis_server or self.mantis_server
+		processed = 0
+		while True:
+			update_queue_depth()
+			attempt = self._claim_next(mantis_server)
+			if attempt is None:
+				return processed
+			processed += 1
+			try:
+				self.dispatch(attempt.model_run, attempt, mantis_server)
+			except OSError:
+				raise
+			except Exception:  # the attempt recorded the error and requeued the run if it has attempts left
+				log.exception("Failed to process run {}".format(attempt.model_run_id))
+
+	def dispatch(self, run, attempt, mantis_server):
+		with run_queue.Heartbeat(attempt):
+			mantis_server.send_command(model_run=run, attempt=attempt)
 
-			for run in self._waiting_runs:
-				self.mantis_server.send_command(model_run=run)
+	def _claim_next(self, mantis_server):
+		"""
+		:return: RunAttempt for the next waiting run this worker claimed, or None if there isn't one
+		"""
+		for run in self._get_runs(mantis_server):
+			attempt = models.RunAttempt.claim(run, server=mantis_server)
+			if attempt is not None:
+				return attempt
+		return None
 
-	def _get_runs(self):
-		new_runs = models.ModelRun.objects.filter(status=models.ModelRun.READY)\
-											.order_by('date_submitted')\
-											.prefetch_related('modifications')  # get runs that aren't complete
-		self._waiting_runs = new_runs
+	def _get_runs(self, mantis_server=None):
+		"""
+			Finds the next runs to claim, in the order the scheduler wants them run on mantis_server. Returned rather
+			than kept on the command, which every worker thread shares
+		:return: list of ModelRuns
+		"""
+		waiting = models.ModelRun.objects.filter(status=models.ModelRun.READY)\
+										.filter(Q(next_attempt_after=None) | Q(next_attempt_after__lte=timezone.now()))
+		run_ids = scheduler.next_runs(waiting, limit=CLAIM_BATCH, mantis_server=mantis_server)
+		runs = models.ModelRun.objects.filter(id__in=run_ids)\
+										.select_related('flow_scenario', 'load_scenario', 'unsat_scenario')\
+										.prefetch_related('modifications').in_bulk()
+		return [runs[run_id] for run_id in run_ids if run_id in runs]
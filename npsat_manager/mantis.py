@@ -8,7 +8,10 @@ import logging
 import arrow
 
 from npsat_backend import settings
+from npsat_manager import kernels
 from npsat_manager import models
+from npsat_manager import region_masks
+from npsat_manager import urf_store
 from npsat_manager.support import compatibility
 
 log = logging.getLogger("npsat.mantis")
@@ -49,30 +52,65 @@ max_year = min_year + time_range
 	Then, when we're done, we just sum the raster band representing each year for our value.
 """
 
-def make_weight_raster(land_use, modifications):
+def make_weight_raster(land_use, modifications, window=None, dtype=numpy.float64):
 	"""
 		Given a land use raster and a set of weights, applies the weights to each land use type
-		then sets everything else to 1 so that the raster can be used as a multiplier later
+		then sets everything else to the "All Other Crops" weight (1 if there's no such modification) so that the
+		raster can be used as a multiplier later
 	:param land_use: path to a land use raster on disk
 	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param window: optional (row_offset, col_offset, rows, cols) block of the raster to read
+	:param dtype: numpy dtype of the weights - see kernels.dtype_for
 	:return:
 	"""
-	land_use_array = compatibility.raster_to_numpy_array(land_use)
-	land_use_array += 10000  # offset everything by 10000 so we can identify everything that's still a default later
+	land_use_array = compatibility.raster_to_numpy_array(land_use, window=window)
+	# build the weights in their own array - writing fractional weights back into the integer land use
+	# array would truncate them. Same convention as the command sent to Mantis: weight is 1 - proportion
+	# the "All Other Crops" modification (caml_code 0) weights every cell without a modification of its own - the
+	# same as mantis_numba.modification_weights
+	modifications = list(modifications)
+	default_weight = 1
 	for modification in modifications:
-		land_use_array[land_use_array == modification.crop.caml_code] = modification.reduction
+		if modification.crop.caml_code == 0:
+			default_weight = 1 - float(modification.proportion)
+	weights = numpy.full(land_use_array.shape, default_weight, dtype=dtype)
+	for modification in modifications:
+		if modification.crop.caml_code != 0:
+			weights[land_use_array == modification.crop.caml_code] = 1 - float(modification.proportion)
+
+	return weights
 
-	land_use_array[land_use_array >= 10000] = 1
 
-	return land_use_array
+def run(modifications, regions=None, mask_index=None, precision=None, unit_response_functions=None):
+	"""
+		Runs the model in process. When regions are provided, only the cells inside them are used - the bounding
+		window of the combined region mask limits what we read from each raster, and the mask itself limits
+		which cells get convolved and summed, so a county costs a fraction of the full valley.
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param regions: iterable of npsat_manager.models.Region objects (or their ids). None runs the full rasters
+	:param mask_index: region_masks.RegionMaskIndex to use. Loaded from settings.REGION_MASK_INDEX when not provided
+	:param precision: "float32" or "float64" - defaults to settings.MANTIS_PRECISION
+	:param unit_response_functions: urf_store.URFStore for the scenario (see urf_store.load_scenario) - when None,
+									uses fake URFs in DEBUG mode
+	:return: numpy array with the total loading for each year
+	"""
+	if regions is None:
+		return run_mantis(modifications, precision=precision, unit_response_functions=unit_response_functions)
+
+	if mask_index is None:
+		mask_index = region_masks.RegionMaskIndex.load(settings.REGION_MASK_INDEX)
 
+	mask = mask_index.combined(getattr(region, "id", region) for region in regions)
+	if mask.is_empty:
+		raise ValueError("The selected regions don't overlap the model grid")
 
-def run(spatial_subset="Tulare"):  # make sure to only run it for Tulare, which we have the URFs for here
-									# need to subset the other rasters to that area
-	pass
+	log.info("Running for {} cells in window {}".format(mask.cell_count, mask.window))
+	dtype = kernels.dtype_for(precision or settings.MANTIS_PRECISION)
+	annual_loadings = make_annual_loadings(modifications=modifications, window=mask.window, dtype=dtype)
+	return convolve_and_sum(annual_loadings, unit_response_functions, mask=mask.to_array(), window=mask.window)
 
 
-def create_ranges_nd(start, stop, N, endpoint=True):
+def create_ranges_nd(start, stop, N, endpoint=True, dtype=None):
 	"""
 		Via https://stackoverflow.com/a/46694364 - for making in between matrices
 
@@ -89,44 +127,62 @@ def create_ranges_nd(start, stop, N, endpoint=True):
 	:param stop:
 	:param N:
 	:param endpoint:
+	:param dtype: dtype of the output - defaults to the dtype of start so float32 inputs stay float32
 	:return:
 	"""
+	if dtype is None:
+		dtype = start.dtype
 	if endpoint:
 		divisor = N-1
 	else:
 		divisor = N
-	steps = (1.0/divisor) * (stop - start)
-	return start[..., None] + steps[..., None]*numpy.arange(N)
+	steps = ((stop - start) / divisor).astype(dtype, copy=False)
+	return start[..., None] + steps[..., None]*numpy.arange(N, dtype=dtype)
 
 
-def make_annual_loadings(modifications, years=settings.NgwRasters.keys()):
+def make_annual_loadings(modifications, years=None, window=None, dtype=numpy.float64, ngw_rasters=None, land_use_rasters=None):
+	"""
+		Builds the loading for every year by weighting the NGw rasters after the change year, then interpolating
+		between the years we have rasters for.
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param years: the years of the NGw rasters to use - all of them by default
+	:param window: optional (row_offset, col_offset, rows, cols) block of the rasters to read - see region_masks
+	:param dtype: numpy dtype of the loadings - see kernels.dtype_for
+	:param ngw_rasters: dict of year: NGw raster - defaults to settings.NgwRasters
+	:param land_use_rasters: dict of year: land use raster - defaults to settings.LandUseRasters
+	:return: 3D array of (y, x, years)
+	"""
+	if ngw_rasters is None:
+		ngw_rasters = settings.NgwRasters
+	if land_use_rasters is None:
+		land_use_rasters = settings.LandUseRasters
+	if years is None:
+		years = ngw_rasters.keys()
 
 	# First make the loadings for just the years we have precalculated (1945, 1960, etc)
 
-	print("Building Annual Loadings")
+	log.debug("Building Annual Loadings")
 	loadings = {}
 	for year in years:
-		print(year)
-		base_loading_matrix = compatibility.raster_to_numpy_array(settings.NgwRasters[year])
+		base_loading_matrix = compatibility.raster_to_numpy_array(ngw_rasters[year], window=window).astype(dtype, copy=False)
 		if year >= settings.ChangeYear:  # if this year is after our reductions are supposed to be made
-			weight_matrix = make_weight_raster(settings.LandUseRasters[year], modifications=modifications)
+			weight_matrix = make_weight_raster(land_use_rasters[year], modifications=modifications, window=window, dtype=dtype)
 			loadings[year] = weight_matrix * base_loading_matrix
 		else:  # otherwise, use the straight Ngw values - no changes have been made since they're in the past
 			loadings[year] = base_loading_matrix
 
 	# Now that we have the values for the base years, we want to interpolate between them to make ndarrays for each year
 
-	print("Interpolating between years")
+	log.debug("Interpolating between years")
 	sorted_years = sorted(years)
 	all_years_data = None
 	for i, year in enumerate(sorted_years):
-		print(year)
 		if year == sorted_years[-1]:  # if it's the last year, we have special behavior
 			break
 
 		next_data_year = sorted_years[i+1]
 		interval_size = next_data_year - year
-		all_years_in_range = create_ranges_nd(loadings[year], loadings[next_data_year], interval_size)
+		all_years_in_range = create_ranges_nd(loadings[year], loadings[next_data_year], interval_size, endpoint=False)  # the next interval starts with next_data_year
 		if all_years_data is None:
 			all_years_data = all_years_in_range
 		else:
@@ -135,42 +191,61 @@ def make_annual_loadings(modifications, years=settings.NgwRasters.keys()):
 	return all_years_data
 
 
-def convolve_and_sum(loadings, unit_response_functions=None):
+def convolve_and_sum(loadings, unit_response_functions=None, mask=None, window=None):
 	"""
-
-		:param loadings:
-		:param unit_response_functions: A 3D array where 2D represents space and the third represents "time into the future"
-										from any arbitrary year. These should be the unit response functions from Giorgos
-										where each location has a value for how many years in the future we are currently considering.
-										These values are then convoluted with the loadings to represent travel times
-
-		:return:
+		Convolves each cell's loading with its unit response function and sums across cells. The convolution is
+		causal, as in Mantis and kernels.convolve_and_sum - loading in a year only affects that year and later ones.
+
+		:param loadings: 3D array of (y, x, years), as returned by make_annual_loadings. Convolved in place
+		:param unit_response_functions: either a urf_store.URFStore, or a 3D array of (years into the future, x, y) -
+										the loadings' layout transposed. These are the unit response functions from
+										Giorgos, where each location has a value for how many years in the future we
+										are currently considering, and they're convolved with the loadings to
+										represent travel times
+		:param mask: optional 2D boolean array (y, x) of the cells to include - cells outside it are neither convolved
+					nor included in the sums. See region_masks.
+		:param window: (row offset, column offset, rows, columns) of the loadings in the model grid, for looking cells
+					up in a URFStore. Defaults to the whole grid
+
+		:return: 1D float64 array with the total response for each year
 	"""
 
 	loadings = loadings.T
-	print(loadings.shape)
-	print("Convolving")
+	log.debug("Convolving loadings of shape {}".format(loadings.shape))
 	if unit_response_functions is None:  # this logic is temporary, but have a safeguard so it's not accidentally used in production
 		if settings.DEBUG:
-			unit_response_functions = numpy.ones((loadings.shape[0], loadings.shape[1], loadings.shape[2]), dtype=numpy.float64)
+			unit_response_functions = numpy.ones((loadings.shape[0], loadings.shape[1], loadings.shape[2]), dtype=loadings.dtype)
 		else:
 			raise ValueError("Must provide Unit Response Functions!")
 
+	n_years = loadings.shape[0]
+	row_offset, col_offset = (window or (0, 0))[:2]
+
+	def convolve(y, x):  # y and x index the transposed loadings, so they're the grid's column and row
+		if isinstance(unit_response_functions, urf_store.URFStore):
+			urf = unit_response_functions.urf((row_offset + x) * unit_response_functions.grid_shape[1] + col_offset + y)
+		else:
+			urf = unit_response_functions[:, y, x]
+		# the first n_years of the full convolution - each year's loading spreads into that year and the ones after it
+		loadings[:, y, x] = numpy.convolve(loadings[:, y, x], urf, mode="full")[:n_years]
+
 	# output_matrix = numpy.zeros([loadings.shape[0], loadings.shape[1], loadings.shape[2]], dtype=numpy.float64)
-	print("Fake URFs made, convolving")
 	x_length = loadings.shape[2]
 	y_length = loadings.shape[1]
 
 	start_time = arrow.utcnow()
-	for x in range(x_length):
-		for y in range(y_length):
-			loadings[:, y, x] = numpy.convolve(loadings[:, y, x], unit_response_functions[:, y, x], mode="same")
+	if mask is None:
+		for x in range(x_length):
+			for y in range(y_length):
+				convolve(y, x)
+	else:
+		mask = mask.T  # loadings were transposed above, so transpose the mask to match
+		for y, x in zip(*numpy.nonzero(mask)):
+			convolve(y, x)
+		loadings[:, ~mask] = 0  # drop everything outside the regions from the sums
 
-	end_time = arrow.utcnow()
-	print("Convolution took {}".format(end_time-start_time))
-	print("Done convolving, summing")
-	results = loadings.sum(axis=(1, 2))  # sum in 2D space
-	print("Done summing")
+	log.debug("Convolution took {}".format(arrow.utcnow() - start_time))
+	results = loadings.sum(axis=(1, 2), dtype=numpy.float64)  # sum in 2D space - always accumulate in float64
 	return results
 
 
@@ -235,15 +310,47 @@ def convolve_and_sum_slow(loadings, unit_response_functions=None):
 	results = numpy.sum(output_matrix, [1, 2])  # sum in 2D space
 
 
-def run_mantis(modifications):
-	annual_loadings = make_annual_loadings(modifications=modifications)
-	start_time = arrow.utcnow()
-	results = convolve_and_sum(annual_loadings,)
-	end_time = arrow.utcnow()
+def run_mantis(modifications, precision=None, unit_response_functions=None):
+	"""
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param precision: "float32" or "float64" - defaults to settings.MANTIS_PRECISION. float32 halves the memory of
+					the loadings and URFs; the per-year sums are still accumulated in float64
+	:param unit_response_functions: urf_store.URFStore for the scenario - when None, uses fake URFs in DEBUG mode
+	:return: numpy array with the total loading for each year
+	"""
+	dtype = kernels.dtype_for(precision or settings.MANTIS_PRECISION)
+	annual_loadings = make_annual_loadings(modifications=modifications, dtype=dtype)
+	return convolve_and_sum(annual_loadings, unit_response_functions)
 
-	print("Convolution took: {}".format(end_time - start_time))
+def precision_report(modifications, regions=None, mask_index=None):
+	"""
+		Runs the model in float32 and float64 and compares the results, so we can check that float32 is
+		accurate enough on real data before switching settings.MANTIS_PRECISION over.
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param regions: iterable of Region objects or ids to limit the comparison to - None for the full rasters
+	:param mask_index: passed through to run
+	:return: dict with the error of float32 relative to float64 and how long each run took
+	"""
+	results = {}
+	timings = {}
+	for precision in ("float64", "float32"):
+		start_time = arrow.utcnow()
+		results[precision] = numpy.asarray(run(modifications, regions=regions, mask_index=mask_index, precision=precision), dtype=numpy.float64)
+		timings[precision] = (arrow.utcnow() - start_time).total_seconds()
+
+	absolute_error = numpy.abs(results["float32"] - results["float64"])
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		relative_error = numpy.where(results["float64"] != 0, absolute_error / numpy.abs(results["float64"]), 0)
+
+	return {
+		"n_years": int(len(results["float64"])),
+		"max_absolute_error": float(absolute_error.max()),
+		"max_relative_error": float(relative_error.max()),
+		"mean_relative_error": float(relative_error.mean()),
+		"seconds_float64": timings["float64"],
+		"seconds_float32": timings["float32"],
+	}
 
-	return results
 
 if __name__ == "__main__":
 	start_time = arrow.utcnow()
@@ -9,7 +9,7 @@ import logging
 
 from asgiref.sync import sync_to_async, async_to_sync
 
-from npsat_manager import models
+from npsat_manager import models, run_queue
 from npsat_backend import settings
 
 log = logging.getLogger("npsat.manager.mantis_manager")
@@ -85,12 +85,9 @@ def test(server, model_run):
 
 
 def initialize():
-	# we're assuming we're starting now, so set ModelRuns to not running if they're not complete
-	# this helps if the server shut down while running an analysis and makes sure it gets run when it starts up next.
-	all_incomplete_runs = models.ModelRun.objects.filter(status=models.ModelRun.RUNNING)
-	for run in all_incomplete_runs:
-		run.status = models.ModelRun.READY
-		run.save()
+	# requeue runs that a dispatcher was working on when it shut down. Runs whose leases haven't run out yet may be
+	# in progress in another dispatcher, so they're left to the sweeper
+	run_queue.sweep()
 
 	# Now figure out which servers are online - go through the MantisServer object's startup sequence
 	all_mantis_servers = models.MantisServer.objects.all()
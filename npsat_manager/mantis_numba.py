@@ -1,16 +1,20 @@
 """
 	TODO: Add issue about division by 100 in setup code
+
+	Same model as mantis.py, but the cell loops run in the compiled kernels in npsat_manager.kernels. The functions
+	here only handle reading rasters and settings and reshaping arrays - all of the number crunching happens on
+	plain arrays of (cells, years).
 """
 
 import numpy
 import logging
 
-from numba import njit, jit
-
 import arrow
 
 from npsat_backend import settings
-from npsat_manager import models
+from npsat_manager import kernels
+from npsat_manager import region_masks
+from npsat_manager import urf_store
 from npsat_manager.support import compatibility
 
 log = logging.getLogger("npsat.mantis")
@@ -51,216 +55,137 @@ max_year = min_year + time_range
 	Then, when we're done, we just sum the raster band representing each year for our value.
 """
 
-@jit
-def make_weight_raster(land_use, modifications):
+def modification_weights(modifications, dtype=numpy.float64):
 	"""
-		Given a land use raster and a set of weights, applies the weights to each land use type
-		then sets everything else to 1 so that the raster can be used as a multiplier later
-	:param land_use: path to a land use raster on disk
+		Converts modifications into the arrays the reclassify kernel needs. Follows the same convention as the
+		command we send to Mantis - a crop's weight is 1 - proportion, and the "All Other Crops" modification
+		(caml_code 0) sets the weight of every crop that doesn't have its own modification.
 	:param modifications: an iterable of npsat_manager.models.Modification objects
-	:return:
+	:param dtype: numpy dtype of the weights
+	:return: tuple of (codes, weights, default_weight)
 	"""
-	land_use_array = compatibility.raster_to_numpy_array(land_use)
-	land_use_array += 10000  # offset everything by 10000 so we can identify everything that's still a default later
+	codes = []
+	weights = []
+	default_weight = 1
 	for modification in modifications:
-		land_use_array[land_use_array == modification.crop.caml_code] = modification.reduction
-
-	land_use_array[land_use_array >= 10000] = 1
+		if modification.crop.caml_code == 0:
+			default_weight = 1 - float(modification.proportion)
+			continue
+		codes.append(modification.crop.caml_code)
+		weights.append(1 - float(modification.proportion))
 
-	return land_use_array
+	return numpy.array(codes, dtype=numpy.int64), numpy.array(weights, dtype=dtype), dtype(default_weight)
 
 
-def run(spatial_subset="Tulare"):  # make sure to only run it for Tulare, which we have the URFs for here
-									# need to subset the other rasters to that area
-	pass
-
-
-@jit
-def create_ranges_nd(start, stop, N, endpoint=True):
+def make_weight_raster(land_use, modifications, window=None, cells=None, dtype=numpy.float64):
 	"""
-		Via https://stackoverflow.com/a/46694364 - for making in between matrices
-
-		Basically, given a 2D array as start and a 2D array as stop, it will return
-		a new 3D array (with N values in 3rd dimension) that interpolates between
-		start and stop.
-
-		Think of it as taking two bands of a raster and making them the first and last.
-		Then, this function adds N-2 bands in between them where the cells are linearly
-		interpolated values between the start and stop band cell values. That's what
-		we're using this for.
-
-	:param start:
-	:param stop:
-	:param N:
-	:param endpoint:
-	:return:
+		Given a land use raster and a set of modifications, makes an array of weights we can multiply the loading by
+	:param land_use: path to a land use raster on disk
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param window: optional (row_offset, col_offset, rows, cols) block of the raster to read
+	:param cells: optional array of offsets into the (flattened) window of the cells to keep
+	:param dtype: numpy dtype of the weights
+	:return: 1D array of weights, one per cell
 	"""
-	if endpoint:
-		divisor = N-1
-	else:
-		divisor = N
-	steps = (1.0/divisor) * (stop - start)
-	return start[..., None] + steps[..., None]*numpy.arange(N)
-
+	land_use_array = numpy.ascontiguousarray(compatibility.raster_to_numpy_array(land_use, window=window), dtype=numpy.int64).ravel()
+	if cells is not None:
+		land_use_array = land_use_array[cells]
+	codes, weights, default_weight = modification_weights(modifications, dtype=dtype)
+	return kernels.reclassify(land_use_array, codes, weights, default_weight)
 
-@jit
-def make_annual_loadings(modifications, years=settings.NgwRasters.keys()):
 
-	# First make the loadings for just the years we have precalculated (1945, 1960, etc)
-
-	print("Building Annual Loadings")
-	loadings = {}
-	for year in years:
-		print(year)
-		base_loading_matrix = compatibility.raster_to_numpy_array(settings.NgwRasters[year])
-		if year >= settings.ChangeYear:  # if this year is after our reductions are supposed to be made
-			weight_matrix = make_weight_raster(settings.LandUseRasters[year], modifications=modifications)
-			loadings[year] = weight_matrix * base_loading_matrix
-		else:  # otherwise, use the straight Ngw values - no changes have been made since they're in the past
-			loadings[year] = base_loading_matrix
-
-	# Now that we have the values for the base years, we want to interpolate between them to make ndarrays for each year
-
-	print("Interpolating between years")
+def make_annual_loadings(modifications, years=None, window=None, cells=None, dtype=numpy.float64, ngw_rasters=None, land_use_rasters=None):
+	"""
+		Builds the loading for every year for each cell by weighting the NGw rasters after the change year, then
+		interpolating between the years we have rasters for.
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param years: the years of the NGw rasters to use - all of them by default
+	:param window: optional (row_offset, col_offset, rows, cols) block of the rasters to read
+	:param cells: optional array of offsets into the (flattened) window of the cells to keep
+	:param dtype: numpy dtype of the loadings
+	:param ngw_rasters: dict of year: NGw raster - defaults to settings.NgwRasters
+	:param land_use_rasters: dict of year: land use raster - defaults to settings.LandUseRasters
+	:return: 2D array of (cells, years) loadings, starting at the earliest year
+	"""
+	if ngw_rasters is None:
+		ngw_rasters = settings.NgwRasters
+	if land_use_rasters is None:
+		land_use_rasters = settings.LandUseRasters
+	if years is None:
+		years = ngw_rasters.keys()
 	sorted_years = sorted(years)
-	all_years_data = None
-	for i, year in enumerate(sorted_years):
-		print(year)
-		if year == sorted_years[-1]:  # if it's the last year, we have special behavior
-			break
-
-		next_data_year = sorted_years[i+1]
-		interval_size = next_data_year - year
-		all_years_in_range = create_ranges_nd(loadings[year], loadings[next_data_year], interval_size)
-		if all_years_data is None:
-			all_years_data = all_years_in_range
-		else:
-			all_years_data = numpy.concatenate([all_years_data, all_years_in_range], -1)  # stack them on the last axis now
 
-	return all_years_data
+	log.debug("Building Annual Loadings")
+	known_values = None
+	for index, year in enumerate(sorted_years):
+		base_loading = numpy.ascontiguousarray(compatibility.raster_to_numpy_array(ngw_rasters[year], window=window), dtype=dtype).ravel()
+		if cells is not None:
+			base_loading = base_loading[cells]
+		if known_values is None:
+			known_values = numpy.empty((base_loading.shape[0], len(sorted_years)), dtype=dtype)
 
-@njit
-def convolve_and_sum(loadings, unit_response_functions=None):
-	"""
-
-		:param loadings:
-		:param unit_response_functions: A 3D array where 2D represents space and the third represents "time into the future"
-										from any arbitrary year. These should be the unit response functions from Giorgos
-										where each location has a value for how many years in the future we are currently considering.
-										These values are then convoluted with the loadings to represent travel times
+		if year >= settings.ChangeYear:  # if this year is after our reductions are supposed to be made
+			base_loading = base_loading * make_weight_raster(land_use_rasters[year], modifications, window=window, cells=cells, dtype=dtype)
+		known_values[:, index] = base_loading
 
-		:return:
-	"""
+	numpy.nan_to_num(known_values, copy=False)  # kernels are compiled with fastmath, so nodata has to be 0, not NaN
 
-	loadings = loadings.T
-	print(loadings.shape)
-	print("Convolving")
-	#if unit_response_functions is None:  # this logic is temporary, but have a safeguard so it's not accidentally used in production
-	#	if settings.DEBUG:
-	unit_response_functions = numpy.ones((loadings.shape[0], loadings.shape[1], loadings.shape[2]), dtype=numpy.float64)
-	#	else:
-	#		raise ValueError("Must provide Unit Response Functions!")
-
-	# output_matrix = numpy.zeros([loadings.shape[0], loadings.shape[1], loadings.shape[2]], dtype=numpy.float64)
-	print("Fake URFs made, convolving")
-	x_length = loadings.shape[2]
-	y_length = loadings.shape[1]
-
-	#start_time = arrow.utcnow()
-	for x in range(x_length):
-		for y in range(y_length):
-			output = numpy.convolve(loadings[:, y, x], unit_response_functions[:, y, x])  #, mode="same")
-
-	#end_time = arrow.utcnow()
-	#print("Convolution took {}".format(end_time-start_time))
-	print("Done convolving, summing")
-	results = loadings.sum()  # axis=(1, 2))  # sum in 2D space
-	print("Done summing")
-	return results
+	log.debug("Interpolating between years")
+	n_years = sorted_years[-1] - sorted_years[0]
+	return kernels.interpolate_years(known_values, numpy.array(sorted_years, dtype=numpy.int64), sorted_years[0], n_years)
 
-@njit
-def numba_convolve_repr():
-	l1 = [1,2,3,4,5,6,7]
-	l2 = [10,11,12,13,14,15,16]
-	a1 = numpy.asarray(l1)
-	a2 = numpy.asarray(l2)
-	return numpy.convolve(a1,a2)
 
-@jit
-def convolve_and_sum_slow(loadings, unit_response_functions=None):
+def convolve_and_sum(loadings, unit_response_functions=None, grid_cells=None):
 	"""
-		This was the first version of the convolution function I wrote. It takes an approach I thought would be
-		faster originally and takes the loading matrix for each year and multiplies it against the entire
-		URF matrix representing the future relative to the year, then adds its result to the output.
-		That would probably take about two hours (it was a minute to a 80 seconds/year), so I wrote the
-		other version that's in use, where we convolve each pixel individually, but using numpy's
-		convolve.
-	:param loadings:
-	:param unit_response_functions: A 3D array where 2D represents space and the third represents "time into the future"
-									from any arbitrary year.
-	:return:
+	:param loadings: 2D array of (cells, years) as returned by make_annual_loadings
+	:param unit_response_functions: either a urf_store.URFStore, or a 2D array of (cells, years into the future) with
+									the unit response function for each cell, in the same cell order as loadings
+	:param grid_cells: when using a URFStore, the offset of each row of loadings into the grid flattened row-major.
+						Defaults to every cell of the grid, in order
+	:return: 1D array with the total response for each year
 	"""
+	if isinstance(unit_response_functions, urf_store.URFStore):
+		if grid_cells is None:
+			grid_cells = numpy.arange(loadings.shape[0])
+		urf_rows = unit_response_functions.rows_for(grid_cells)
+		return kernels.convolve_sparse_and_sum(loadings, urf_rows, unit_response_functions.offsets, unit_response_functions.values)
 
-	loadings = loadings.T
-	print(loadings.shape)
-	print("Convolving")
-	if unit_response_functions is None:   # this logic is temporary, but have a safeguard so it's not accidentally used in production
+	if unit_response_functions is None:  # this logic is temporary, but have a safeguard so it's not accidentally used in production
 		if settings.DEBUG:
-			unit_response_functions = numpy.ones([loadings.shape[0], loadings.shape[1], loadings.shape[2]], dtype=numpy.float64)
+			unit_response_functions = numpy.ones(loadings.shape, dtype=loadings.dtype)
 		else:
 			raise ValueError("Must provide Unit Response Functions!")
 
-	time_span = loadings.shape[0]
-	output_matrix = numpy.zeros([loadings.shape[0], loadings.shape[1], loadings.shape[2]], dtype=numpy.float64)
-
-	for year in range(time_span):
-		print(year)
-		URF_length = time_span - year
-
-		print("Subset")
-		subset_start = arrow.utcnow()
-		current_year_loadings = loadings[year, :, :,]
-		subset_end = arrow.utcnow()
-		print(subset_end - subset_start)
-
-		#print("Reshape")
-		#reshape_start = arrow.utcnow()
-		#reshaped_loadings = current_year_loadings.reshape(current_year_loadings.shape)
-		#print(reshaped_loadings.shape)
-		#repeated_loadings = numpy.repeat(reshaped_loadings, URF_length, 2)
-		#reshape_end = arrow.utcnow()
-		#print(reshape_end - reshape_start)
-
-		print("Multiply")
-		multiply_start = arrow.utcnow()
-		new_loadings = numpy.multiply(current_year_loadings, unit_response_functions[:URF_length, :, :])
-		multiply_end = arrow.utcnow()
-		print(multiply_end - multiply_start)
-
-		print("Add and Insert Back in")
-		add_start = arrow.utcnow()
-		numpy.add(output_matrix[year:, :, : ], new_loadings, output_matrix[year:, :, : ])
-		add_end = arrow.utcnow()
-		print(add_end - add_start)
-		# multiply this year's matrix * URFs matrix sliced to represent size of future
-		# then add result to output_matrix
-
-	results = numpy.sum(output_matrix, [1, 2])  # sum in 2D space
-
-
-def run_mantis(modifications):
-	annual_loadings = make_annual_loadings(modifications=modifications)
-	start_time = arrow.utcnow()
-	results = convolve_and_sum(annual_loadings,)
-	end_time = arrow.utcnow()
+	return kernels.convolve_and_sum(loadings, unit_response_functions)
 
-	print("Convolution took: {}".format(end_time - start_time))
 
-	return results
+def run_mantis(modifications, regions=None, mask_index=None, precision=None, unit_response_functions=None):
+	"""
+		Runs the model with the compiled kernels
+	:param modifications: an iterable of npsat_manager.models.Modification objects
+	:param regions: iterable of npsat_manager.models.Region objects (or their ids) to limit the run to. None runs the
+					full rasters
+	:param mask_index: region_masks.RegionMaskIndex to use. Loaded from settings.REGION_MASK_INDEX when not provided
+	:param precision: "float32" or "float64" - defaults to settings.MANTIS_PRECISION
+	:param unit_response_functions: urf_store.URFStore for the scenario (see urf_store.load_scenario) - when None,
+									uses fake URFs in DEBUG mode
+	:return: 1D array with the total response for each year
+	"""
+	dtype = kernels.dtype_for(precision or settings.MANTIS_PRECISION)
+	window = None
+	cells = None
+	grid_cells = None
+	if regions is not None:
+		if mask_index is None:
+			mask_index = region_masks.RegionMaskIndex.load(settings.REGION_MASK_INDEX)
+		mask = mask_index.combined(getattr(region, "id", region) for region in regions)
+		window = mask.window
+		cells = mask.window_indices()
+		grid_cells = mask.grid_indices(mask_index.grid.cols)
 
-if __name__ == "__main__":
 	start_time = arrow.utcnow()
+	annual_loadings = make_annual_loadings(modifications=modifications, window=window, cells=cells, dtype=dtype)
+	results = convolve_and_sum(annual_loadings, unit_response_functions, grid_cells=grid_cells)
+	log.info("Model run took: {}".format(arrow.utcnow() - start_time))
 
-	print(results)
-	end_time = arrow.utcnow()
-	print("Total Process took {}".format(end_time-start_time))
\ No newline at end of file
+	return results
@@ -0,0 +1,207 @@
+"""
+	The text protocol we use to talk to a standalone Mantis server. Commands are a single line of space separated
+	values ending in ENDofMSG, and responses are a status flag, the number of wells, then n_years values for each
+	well, ending in EndOfMsg. See https://github.com/giorgk/Mantis#format-of-input-message for the input format.
+
+	Kept separate from the models so that anything that needs to talk to Mantis (the dispatcher, batch jobs that
+	precompute results) builds and reads messages the same way.
+"""
+
+import logging
+import time
+
+from npsat_manager.support import metrics
+
+log = logging.getLogger("npsat.mantis_protocol")
+
+BYTES_RECEIVED = metrics.counter("npsat_mantis_bytes_received_total", "Bytes of Mantis responses read")
+
+END_OF_COMMAND = "ENDofMSG"
+END_OF_RESPONSE = "EndOfMsg"
+RECEIVE_SIZE = 65536
+
+mantis_area_map_id = {
+	"Central Valley": 1,
+	"SubBasin": 2,
+	"CVHMFarm": 5,
+	"B118Basin": 4,
+	"County": 3,
+}
+
+
+class MantisError(Exception):
+	"""
+		Mantis reported a failure, or sent back something we can't turn into results
+	"""
+	pass
+
+
+def crop_weights(modifications, crop_codes):
+	"""
+		Works out the loading weight to send for every crop. A modified crop's weight is 1 - proportion. The
+		"All Other Crops" modification (caml_code 0) sets the weight of every crop without its own modification.
+	:param modifications: iterable of (caml_code, proportion) pairs
+	:param crop_codes: caml codes of every crop - all of them are sent to Mantis
+	:return: list of (caml_code, weight) pairs, modified crops first
+	"""
+	all_crops_proportion = 0
+	weights = []
+	selected_crops = set()
+	for caml_code, proportion in modifications:
+		if caml_code == 0:
+			all_crops_proportion = proportion
+			continue
+		weights.append((caml_code, 1 - proportion))
+		selected_crops.add(caml_code)
+
+	for caml_code in crop_codes:
+		if caml_code not in selected_crops:
+			weights.append((caml_code, 1 - all_crops_proportion))
+
+	return weights
+
+
+def build_command(model_run, region_type, mantis_ids, weights):
+	"""
+		Builds the command string for a run
+	:param model_run: ModelRun (saved or not) - provides the years, water content and scenarios
+	:param region_type: region_type of the regions being run
+	:param mantis_ids: mantis_id of each region. Ignored for the Central Valley, which is always the whole area
+	:param weights: list of (caml_code, weight) pairs, as returned by crop_weights
+	:return: command string, including the terminating ENDofMSG and newline
+	"""
+	area_id = mantis_area_map_id[region_type]
+	parts = [
+		model_run.n_years,
+		model_run.reduction_start_year,
+		model_run.reduction_end_year,
+		model_run.water_content,
+		model_run.flow_scenario.name,
+		model_run.load_scenario.name,
+		model_run.unsat_scenario.name,
+		area_id,
+		len(mantis_ids),
+	]
+	if area_id != 1:
+		parts.extend(mantis_ids)
+
+	parts.append(len(weights))
+	for caml_code, weight in weights:
+		parts.append(caml_code)
+		parts.append(weight)
+
+	parts.append(END_OF_COMMAND)
+	return " ".join(str(part) for part in parts) + "\n"
+
+
+def read_response(connection, timer=None):
+	"""
+		Reads a whole response off of a connected socket - until EndOfMsg arrives or Mantis closes the connection
+	:param connection: connected socket
+	:param timer: optional support.timing.StageTimer - the wait for the first bytes is recorded as "mantis_compute"
+				and the rest of the read as "response_transfer"
+	:return: response text
+	"""
+	chunks = []
+	tail = b""
+	end_marker = END_OF_RESPONSE.encode("utf-8")
+	start_time = time.perf_counter()
+	while True:
+		chunk = connection.recv(RECEIVE_SIZE)
+		if timer is not None and len(chunks) == 0:
+			timer.record("mantis_compute", time.perf_counter() - start_time)
+			start_time = time.perf_counter()
+		if not chunk:
+			break
+		BYTES_RECEIVED.inc(len(chunk))
+		chunks.append(chunk)
+		tail = (tail + chunk)[-len(end_marker) - 2:]  # enough to catch the marker split across chunks plus a newline
+		if end_marker in tail:
+			break
+
+	if timer is not None:
+		timer.record("response_transfer", time.perf_counter() - start_time)
+	return b"".join(chunks).decode("utf-8")
+
+
+def iter_response_rows(connection, n_years, block_wells=1024):
+	"""
+		Reads a response off of a connected socket a chunk at a time and yields the wells as they arrive, so the
+		caller never needs the whole response (or the whole results matrix) in memory at once.
+	:param connection: connected socket the command was sent on
+	:param n_years: number of years the run was for
+	:param block_wells: yield wells in blocks of up to this many rows
+	:return: generator of 2D numpy arrays of (wells, n_years). Raises MantisError if Mantis reports a failure or the
+			number of values doesn't match the number of wells it said it would send
+	"""
+	import numpy  # only the dispatcher reads responses - the web app imports this module for build_command
+
+	header = []
+	pending = []  # values of the current block that haven't been yielded yet
+	wells_expected = None
+	wells_received = 0
+	carry = b""  # partial value left at the end of the previous chunk
+	end_marker = END_OF_RESPONSE.encode("utf-8")
+	finished = False
+
+	while not finished:
+		chunk = connection.recv(RECEIVE_SIZE)
+		if not chunk:
+			data, carry, finished = carry, b"", True
+		else:
+			BYTES_RECEIVED.inc(len(chunk))
+			data = carry + chunk
+			last_space = max(data.rfind(separator) for separator in (b" ", b"\n", b"\r", b"\t"))
+			data, carry = data[:last_space + 1], data[last_space + 1:]
+
+		for token in data.split():
+			if token == end_marker:
+				finished = True
+				break
+			if wells_expected is None:
+				header.append(token)
+				if header[0] == b"0":  # Mantis failed - the rest of the response is the error message
+					raise MantisError((data + carry).decode("utf-8", "replace").strip())
+				if len(header) == 2:
+					wells_expected = int(header[1])
+				continue
+			pending.append(token)
+			if len(pending) == block_wells * n_years:
+				block = numpy.array(pending, dtype=numpy.float64).reshape(block_wells, n_years)
+				pending = []
+				wells_received += block_wells
+				yield block
+		if carry == end_marker:  # nothing follows the marker, and Mantis may keep the connection open after it
+			finished = True
+
+	if wells_expected is None:
+		raise MantisError("Mantis sent back an empty response")
+	if len(pending) % n_years != 0 or wells_received + len(pending) // n_years != wells_expected:
+		raise MantisError("Got an incorrect number of results from model run. Cannot reliably process to percentiles. You may try again")
+	if len(pending) > 0:
+		yield numpy.array(pending, dtype=numpy.float64).reshape(-1, n_years)
+
+
+def parse_response(response, n_years):
+	"""
+		Turns a Mantis response into a matrix of results
+	:param response: response text
+	:param n_years: number of years the run was for
+	:return: 2D numpy array where every row is a well and every column is a year
+	"""
+	import numpy
+
+	values = response.split()  # splitting on any whitespace also drops the empty values that would throw off the count
+	if len(values) == 0 or values[0] == "0":  # Yes, a string 0 because of parsing. It means Mantis failed
+		raise MantisError(" ".join(values) or "Mantis sent back an empty response")
+
+	n_wells = int(values[1])
+	values = values[2:]  # first value is status message, second value is number of wells, last is "EndOfMsg"
+	if len(values) > 0 and values[-1] == END_OF_RESPONSE:
+		values = values[:-1]
+
+	# we need to have a number of results divisible by the number of wells and the number of years
+	if len(values) != n_wells * n_years:
+		raise MantisError("Got an incorrect number of results from model run. Cannot reliably process to percentiles. You may try again")
+
+	return numpy.array(values, dtype=numpy.float64).reshape(n_wells, n_years)
@@ -0,0 +1,185 @@
+import contextvars
+import functools
+import logging
+import random
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+
+from npsat_backend import settings
+from npsat_manager.support import metrics, query_profiling
+
+log = logging.getLogger("npsat.middleware")
+
+# execute wrappers recording the queries of the request being handled - see record_queries
+_RECORDERS = contextvars.ContextVar("npsat_query_recorders", default=())
+
+PROFILES = query_profiling.ProfileBuffer(settings.QUERY_PROFILING_BUFFER_SIZE)  # read by views.QueryProfiles
+
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUEST_LATENCY = metrics.histogram("npsat_http_request_duration_seconds", "Time to respond to requests, by view and action",
+									labels=("view", "action", "method"))
+REQUESTS = metrics.counter("npsat_http_requests_total", "Requests handled, by view, action and response status",
+						   labels=("view", "action", "status"))
+REQUEST_QUERIES = metrics.histogram("npsat_http_request_queries", "Database queries run per request, by view and action",
+									labels=("view", "action"), buckets=QUERY_BUCKETS)
+
+
+def view_name(view_func, method):
+	"""
+		Names a view for metrics and profiling - DRF viewsets are named by class and action (list, retrieve,
+		create, ...), other class based views by class and HTTP method, and function views by function name
+	:return: (view, action) tuple
+	"""
+	view_class = getattr(view_func, "cls", None) or getattr(view_func, "view_class", None)
+	actions = getattr(view_func, "actions", None)
+	name = view_class.__name__ if view_class else getattr(view_func, "__name__", "unknown")
+	action = actions.get(method.lower(), method.lower()) if actions else method.lower()
+	return name, action
+
+
+class QueryCounter(object):
+	"""
+		Database execute wrapper that counts the queries run through it
+	"""
+
+	def __init__(self):
+		self.count = 0
+
+	def __call__(self, execute, sql, params, many, context):
+		self.count += 1
+		return execute(sql, params, many, context)
+
+
+class MetricsMiddleware(MiddlewareMixin):
+	"""
+		Records request latency, response status and query counts per view. Goes first in MIDDLEWARE so the timing
+		covers the other middleware too. Built on MiddlewareMixin so that under ASGI (see npsat_backend/asgi.py) async
+		views stay async rather than being pushed onto a thread.
+	"""
+
+	def process_request(self, request):
+		counter = QueryCounter()
+		request._npsat_metrics = (counter, record_queries(counter), time.perf_counter())
+
+	def process_response(self, request, response):
+		return finish_after_streaming(response, functools.partial(self._record, request, response))
+
+	def _record(self, request, response):
+		counter, stop_recording, start_time = request._npsat_metrics
+		stop_recording()
+		duration = time.perf_counter() - start_time
+
+		view, action = getattr(request, "_npsat_view", ("unmatched", request.method.lower()))
+		REQUEST_LATENCY.labels(view=view, action=action, method=request.method).observe(duration)
+		REQUESTS.labels(view=view, action=action, status=response.status_code).inc()
+		REQUEST_QUERIES.labels(view=view, action=action).observe(counter.count)
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		request._npsat_view = view_name(view_func, request.method)
+
+
+class QueryProfilingMiddleware(MiddlewareMixin):
+	"""
+		Opt in with settings.QUERY_PROFILING_ENABLED. Profiles the SQL of a random sample of requests
+		(QUERY_PROFILING_SAMPLE_RATE) into PROFILES - see support.query_profiling - and logs a warning for any request
+		that runs more than QUERY_PROFILING_WARN_QUERIES queries.
+	"""
+
+	def __init__(self, get_response):
+		if not settings.QUERY_PROFILING_ENABLED:
+			raise MiddlewareNotUsed()
+		super().__init__(get_response)
+		self._random = random.Random()
+
+	def process_request(self, request):
+		if self._random.random() < settings.QUERY_PROFILING_SAMPLE_RATE:
+			profiler = query_profiling.QueryProfiler()
+			request._npsat_profile = (profiler, record_queries(profiler), time.perf_counter())
+
+	def process_response(self, request, response):
+		if not hasattr(request, "_npsat_profile"):
+			return response
+		return finish_after_streaming(response, functools.partial(self._record, request, response))
+
+	def _record(self, request, response):
+		profiler, stop_recording, start_time = request._npsat_profile
+		stop_recording()
+		duration = time.perf_counter() - start_time
+
+		view, action = getattr(request, "_npsat_view", ("unmatched", request.method.lower()))
+		profile = {
+			"date": timezone.now().isoformat(),
+			"method": request.method,
+			"path": request.path,
+			"view": view,
+			"action": action,
+			"status": response.status_code,
+			"seconds": duration,
+		}
+		profile.update(profiler.summarize(n_slowest=settings.QUERY_PROFILING_SLOWEST,
+										  duplicate_threshold=settings.QUERY_PROFILING_DUPLICATE_THRESHOLD))
+		PROFILES.add(profile)
+		if profile["n_queries"] > settings.QUERY_PROFILING_WARN_QUERIES:
+			log.warning("{} {} ran {} queries in {:.3f}s of SQL".format(request.method, request.path, profile["n_queries"], profile["sql_seconds"]))
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		request._npsat_view = view_name(view_func, request.method)
+
+
+def _execute_recorded(execute, sql, params, many, context):
+	"""
+		Execute wrapper installed on every connection - runs each statement through the recorders of the request
+		it belongs to, if any
+	"""
+	for recorder in reversed(_RECORDERS.get()):
+		execute = functools.partial(recorder, execute)
+	return execute(sql, params, many, context)
+
+
+def install_recording(connection, **kwargs):
+	if _execute_recorded not in connection.execute_wrappers:
+		connection.execute_wrappers.append(_execute_recorded)
+
+
+connection_created.connect(install_recording)  # covers the connections of sync_to_async and other threads
+
+
+def record_queries(recorder):
+	"""
+		Runs every query of the current request through recorder, an execute wrapper. The recorders are kept in a
+		context variable rather than on a connection, so they follow the request into sync_to_async threads (the
+		async views) and into streamed responses read after the middleware has returned
+	:return: function that stops recording
+	"""
+	for alias in connections:  # this thread's connections may have opened before this module was imported
+		install_recording(connections[alias])
+	_RECORDERS.set(_RECORDERS.get() + (recorder,))
+
+	def stop():
+		_RECORDERS.set(tuple(current for current in _RECORDERS.get() if current is not recorder))
+	return stop
+
+
+def finish_after_streaming(response, finish):
+	"""
+		Calls finish once the response has been sent - right away, or for streamed responses (the exports) once the
+		server has read all of their content or closed them, so their queries and time are included
+	:return: the response
+	"""
+	if not response.streaming:
+		finish()
+		return response
+
+	def content(original):
+		try:
+			yield from original
+		finally:
+			finish()
+	response.streaming_content = content(response.streaming_content)
+	return response
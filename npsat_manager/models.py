@@ -1,31 +1,37 @@
 import traceback
 import logging
+import time
+import random
+import datetime
+import os
+import threading
 import asyncio
 import socket
 import json
 
-import numpy
-
 import django
-from django.db import models
+from django.db import models, transaction
 from django.core.validators import int_list_validator
 from django.contrib.auth.models import User
-
-import arrow
+from django.utils import timezone
 
 from npsat_backend import settings
+from npsat_manager import mantis_protocol, run_status
+from npsat_manager.support import metrics, timing
 
 # Create your models here.
 
 log = logging.getLogger("npsat.manager")
 
-mantis_area_map_id = {
-    "Central Valley": 1,
-    "SubBasin": 2,
-    "CVHMFarm": 5,
-    "B118Basin": 4,
-    "County": 3,
-}
+MANTIS_LATENCY = metrics.histogram("npsat_mantis_latency_seconds", "Time from sending a command to Mantis until its whole response was read",
+                                   labels=("server",))
+MANTIS_UP = metrics.gauge("npsat_mantis_up", "Whether the last connection attempt to a Mantis server succeeded", labels=("server",))
+RUN_DURATION = metrics.histogram("npsat_run_duration_seconds", "Time to process a model run once picked up, by final status",
+                                 labels=("status",))
+RUN_QUEUE_WAIT = metrics.histogram("npsat_run_queue_wait_seconds", "Time model runs waited between submission and processing")
+RUN_ATTEMPTS = metrics.counter("npsat_run_attempts_total", "Model run attempts, by how they ended", labels=("status",))
+
+mantis_area_map_id = mantis_protocol.mantis_area_map_id
 
 
 class PercentileAggregate(models.Aggregate):
@@ -109,6 +115,22 @@ class Region(models.Model):
         return self.name
 
 
+class RegionOverlap(models.Model):
+    """
+        The fraction of region's area that lies inside other_region, a region of another type. Computed for every
+        pair of region types by npsat_manager.region_overlap.build - rerun it when regions are reloaded
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['region', 'other_region'], name='unique_region_overlap'),
+        ]
+
+    region = models.ForeignKey(Region, on_delete=models.CASCADE, related_name="overlaps")
+    other_region = models.ForeignKey(Region, on_delete=models.CASCADE, related_name="+")
+    fraction = models.FloatField()
+
+
 class Scenario(models.Model):
     """
 		scenario table, used during model run creation
@@ -181,6 +203,7 @@ class ModelRun(models.Model):
     RUNNING = 2
     COMPLETED = 3
     ERROR = 4
+    STATUS_NAMES = {NOT_READY: "not_ready", READY: "ready", RUNNING: "running", COMPLETED: "completed", ERROR: "error"}
     STATUS_CHOICE = [
         (NOT_READY, 0),
         (READY, 1),
@@ -195,6 +218,7 @@ class ModelRun(models.Model):
     result_values = models.TextField(validators=[int_list_validator], default="", null=True, blank=True)
     date_submitted = models.DateTimeField(default=django.utils.timezone.now, null=True, blank=True)
     date_completed = models.DateTimeField(null=True, blank=True)
+    next_attempt_after = models.DateTimeField(null=True, blank=True)  # set while a failed run waits to be retried
     user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="model_runs")
 
     # global model parameters
@@ -227,11 +251,14 @@ class ModelRun(models.Model):
     # whether current model is a base model for its scenario
     is_base = models.BooleanField(null=False, blank=False, default=False)
 
+    # parameter sweep the run was submitted as part of, if any
+    sweep = models.ForeignKey("RunSweep", null=True, blank=True, on_delete=models.SET_NULL, related_name="runs")
+
     # modifications - backward relationship
 
     def load_result(self, values):
         self.result_values = ",".join([str(item) for item in values])
-        self.date_run = arrow.utcnow().datetime
+        self.date_run = timezone.now()
 
     def run(self):
         """
@@ -286,6 +313,223 @@ class Modification(models.Model):
                                   related_name="modifications")
 
 
+class RunSweep(models.Model):
+    """
+        A group of runs submitted together that differ only in some crops' proportions - one run for each point of
+        the axes' cross product. See npsat_manager.sweeps
+    """
+    name = models.CharField(max_length=255)
+    description = models.TextField(null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="run_sweeps")
+    axes = SimpleJSONField(default=list)  # list of {"crop": crop id, "values": [proportions]}
+    date_submitted = models.DateTimeField(default=django.utils.timezone.now)
+
+    def progress(self):
+        """
+        :return: dict of status name: number of the sweep's runs with that status
+        """
+        counts = dict(self.runs.values_list('status').annotate(models.Count('id')).order_by())
+        return {name: counts.get(status, 0) for status, name in ModelRun.STATUS_NAMES.items()}
+
+
+class RunTiming(models.Model):
+    """
+        How long each stage of a model run took, in seconds, so a slow run can be traced to the stage that
+        made it slow. Stages that didn't happen for a run (a run answered from a response basis never goes
+        to Mantis, for example) are null.
+    """
+    STAGES = ("queue_wait", "command_build", "mantis_compute", "response_transfer", "parsing", "percentiles", "db_write")
+
+    model_run = models.OneToOneField(ModelRun, on_delete=models.CASCADE, related_name="timing")
+    queue_wait = models.FloatField(null=True, blank=True)  # submitted until the dispatcher picked it up
+    command_build = models.FloatField(null=True, blank=True)
+    mantis_compute = models.FloatField(null=True, blank=True)  # command sent until the first bytes came back
+    response_transfer = models.FloatField(null=True, blank=True)
+    parsing = models.FloatField(null=True, blank=True)
+    percentiles = models.FloatField(null=True, blank=True)
+    db_write = models.FloatField(null=True, blank=True)
+    total = models.FloatField(null=True, blank=True)  # sum of the stages
+    date_recorded = models.DateTimeField(default=django.utils.timezone.now)
+
+    @classmethod
+    def record(cls, model_run, timer):
+        """
+        :param model_run: ModelRun that was processed
+        :param timer: support.timing.StageTimer the stages were recorded on
+        :return: RunTiming
+        """
+        values = {stage: timer.durations.get(stage) for stage in cls.STAGES}
+        values["total"] = timer.total
+        values["date_recorded"] = timezone.now()
+        run_timing, created = cls.objects.update_or_create(model_run=model_run, defaults=values)
+        return run_timing
+
+
+class LeaseLost(Exception):
+    """
+        Raised when a worker goes to store a run's results after its attempt's lease ran out - the run belongs to the
+        sweeper or a newer attempt then
+    """
+    pass
+
+
+class RunAttempt(models.Model):
+    """
+        One try at processing a model run. The dispatcher worker that claims a run holds a lease on it until
+        lease_expires, and renews it while it works (see run_queue.Heartbeat). If the worker dies or hangs, the lease
+        runs out and run_queue.sweep puts the run back in the queue.
+
+        Failed attempts are retried with exponential backoff up to settings.RUN_MAX_ATTEMPTS times. The last one is
+        then dead lettered and the run marked as an error. Attempts only change out of RUNNING once, so a worker that
+        lost its lease can't undo what the sweeper or a newer attempt did.
+    """
+    RUNNING = 0
+    COMPLETED = 1  # Mantis answered - the run completed, or Mantis reported an error for it
+    FAILED = 2  # will be retried
+    EXPIRED = 3  # lease ran out - will be retried
+    DEAD_LETTER = 4  # failed on the last attempt - the run is marked as an error
+    STATUS_NAMES = {RUNNING: "running", COMPLETED: "completed", FAILED: "failed", EXPIRED: "expired", DEAD_LETTER: "dead_letter"}
+    STATUS_CHOICE = [(status, name) for status, name in STATUS_NAMES.items()]
+
+    model_run = models.ForeignKey(ModelRun, on_delete=models.CASCADE, related_name="attempts")
+    number = models.PositiveSmallIntegerField()  # 1 for the first attempt at a run
+    status = models.IntegerField(default=RUNNING, choices=STATUS_CHOICE)
+    server = models.ForeignKey("MantisServer", null=True, blank=True, on_delete=models.SET_NULL, related_name="attempts")
+    worker = models.CharField(max_length=255, default="", blank=True)  # host, process and thread that claimed the run
+    error = models.TextField(default="", blank=True)
+    date_started = models.DateTimeField(default=django.utils.timezone.now)
+    date_finished = models.DateTimeField(null=True, blank=True)
+    lease_expires = models.DateTimeField()
+    last_heartbeat = models.DateTimeField(null=True, blank=True)
+
+    @staticmethod
+    def worker_name():
+        return "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+    @classmethod
+    def claim(cls, model_run, server=None):
+        """
+            Marks a ready run as running and starts an attempt at it, unless another worker got to it first
+        :param model_run: ModelRun that was READY when it was queried
+        :param server: MantisServer the run will be sent to, if any
+        :return: RunAttempt, or None if the run was claimed already
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            claimed = ModelRun.objects.filter(id=model_run.id, status=ModelRun.READY).update(status=ModelRun.RUNNING,
+                                                                                            next_attempt_after=None)
+            if claimed == 0:
+                return None
+            attempt = cls.objects.create(model_run=model_run, number=model_run.attempts.count() + 1, server=server,
+                                         worker=cls.worker_name(), date_started=now,
+                                         lease_expires=now + datetime.timedelta(seconds=settings.RUN_LEASE_SECONDS))
+        model_run.status = ModelRun.RUNNING
+        model_run.next_attempt_after = None
+        run_status.notify(model_run.id)
+        return attempt
+
+    def holds_lease(self):
+        """
+            Locks the attempt's row until the end of the surrounding transaction
+        :return: True if the attempt is still running and its lease hasn't run out
+        """
+        return RunAttempt.objects.select_for_update()\
+            .filter(id=self.id, status=self.RUNNING, lease_expires__gt=timezone.now()).exists()
+
+    def renew(self):
+        """
+            Extends the lease
+        :return: False if the attempt isn't running anymore - the lease was lost
+        """
+        now = timezone.now()
+        return RunAttempt.objects.filter(id=self.id, status=self.RUNNING)\
+            .update(lease_expires=now + datetime.timedelta(seconds=settings.RUN_LEASE_SECONDS), last_heartbeat=now) > 0
+
+    def _finish(self, status, error=""):
+        """
+        :return: True if this call moved the attempt out of RUNNING
+        """
+        finished = RunAttempt.objects.filter(id=self.id, status=self.RUNNING)\
+            .update(status=status, error=error, date_finished=timezone.now()) > 0
+        if finished:
+            self.status = status
+            self.error = error
+            RUN_ATTEMPTS.labels(status=self.STATUS_NAMES[status]).inc()
+        return finished
+
+    def complete(self):
+        self._finish(self.COMPLETED)
+
+    def fail(self, error, expired=False):
+        """
+            Ends the attempt after an error, and either requeues the run with a backoff or, on its last attempt, marks
+            the run as an error
+        :param error: exception or message
+        :param expired: whether the lease ran out, rather than the worker reporting an error
+        """
+        message = str(error) or type(error).__name__
+        retry = self.number < settings.RUN_MAX_ATTEMPTS
+        if not self._finish((self.EXPIRED if expired else self.FAILED) if retry else self.DEAD_LETTER, message):
+            return  # the sweeper or another attempt dealt with it already
+
+        if retry:
+            delay = retry_delay(self.number)
+            log.warning("Attempt {} at run {} failed, retrying in {:.0f} seconds: {}".format(self.number, self.model_run_id, delay, message))
+            ModelRun.objects.filter(id=self.model_run_id, status=ModelRun.RUNNING).update(
+                status=ModelRun.READY, next_attempt_after=timezone.now() + datetime.timedelta(seconds=delay),
+                status_message="Attempt {} failed - retrying".format(self.number))
+        else:
+            log.error("Run {} failed on its last attempt ({}): {}".format(self.model_run_id, self.number, message))
+            ModelRun.objects.filter(id=self.model_run_id, status=ModelRun.RUNNING).update(
+                status=ModelRun.ERROR, status_message="Model run failed after {} attempts. This error has been reported.".format(self.number))
+        run_status.notify(self.model_run_id)
+
+
+def retry_delay(number):
+    """
+    :param number: number of the attempt that failed
+    :return: seconds to wait before the next attempt - settings.RUN_RETRY_BACKOFF_SECONDS, doubled for each
+            attempt so far and capped at RUN_RETRY_MAX_BACKOFF_SECONDS, with jitter so that runs failed by the same
+            outage don't all come back at once
+    """
+    delay = min(settings.RUN_RETRY_BACKOFF_SECONDS * 2 ** (number - 1), settings.RUN_RETRY_MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.5, 1)
+
+
+class ResponseBasis(models.Model):
+    """
+        Precomputed results for one region and set of run parameters that let us answer new modification sets
+        without running Mantis. The model is linear in loading, so a run's well curves are the base curves minus,
+        for each crop, (1 - weight) times that crop's response. See npsat_manager.response_basis.
+
+        The arrays themselves live in a .npy file in settings.RESPONSE_BASIS_FOLDER, shaped
+        (crops + 1, wells, years) - index 0 is the base curves and the rest line up with crop_codes.
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['region', 'flow_scenario', 'load_scenario', 'unsat_scenario', 'n_years',
+                        'reduction_start_year', 'reduction_end_year', 'water_content'],
+                name='unique_response_basis'
+            ),
+        ]
+
+    region = models.ForeignKey(Region, on_delete=models.CASCADE, related_name="response_bases")
+    flow_scenario = models.ForeignKey(Scenario, on_delete=models.DO_NOTHING, related_name="+")
+    load_scenario = models.ForeignKey(Scenario, on_delete=models.DO_NOTHING, related_name="+")
+    unsat_scenario = models.ForeignKey(Scenario, on_delete=models.DO_NOTHING, related_name="+")
+    n_years = models.IntegerField()
+    reduction_start_year = models.IntegerField()
+    reduction_end_year = models.IntegerField()
+    water_content = models.DecimalField(max_digits=5, decimal_places=4)
+
+    n_wells = models.IntegerField()
+    crop_codes = SimpleJSONField()  # caml codes of the crop responses, in the order they're stored
+    file_name = models.CharField(max_length=255)
+    date_computed = models.DateTimeField(default=django.utils.timezone.now)
+
+
 class MantisServer(models.Model):
     """
 		We can configure a server pool by instantiating different versions of this model. On startup, a function willl
@@ -296,6 +540,9 @@ class MantisServer(models.Model):
     host = models.CharField(max_length=255)
     port = models.PositiveSmallIntegerField(default=1234)
     online = models.BooleanField(default=False)
+    capacity = models.PositiveSmallIntegerField(default=1)  # runs the server can work on at once - one dispatcher worker each
+    # [flow, load, unsat] scenario ids of the runs most recently sent here, newest (the one loaded now) first - see scheduler
+    recent_scenarios = SimpleJSONField(default=list, blank=True)
 
     async def get_status(self):
         stream_reader, stream_writer = asyncio.open_connection(self.host, self.port)
@@ -315,131 +562,239 @@ class MantisServer(models.Model):
 
     # self.get_status()  # saves the object once it determines if the server is online
 
-    def send_command(self, model_run: ModelRun):
+    def send_command(self, model_run: ModelRun, attempt=None):
         """
 			Sends commands to MantisServer and loads results back
 		:param model_run:
+		:param attempt: RunAttempt the dispatcher claimed the run with. Errors are handed to it to retry the run.
+					Without one, any error marks the run as an error
 		:return:
 		"""
-        model_run.status = ModelRun.RUNNING
-        model_run.save()
+        timer = timing.StageTimer()
+        if model_run.date_submitted:
+            timer.record("queue_wait", (timezone.now() - model_run.date_submitted).total_seconds())
+        if attempt is None:  # claiming a run marks it as running
+            model_run.status = ModelRun.RUNNING
+            model_run.save()
+            run_status.notify(model_run.id)
+
+        # imported here because response_basis needs these models
+        from npsat_manager import response_basis
 
-        log.debug("Connecting to server to send command")
         try:
-            self._non_async_send(model_run)
-        except:
-            # on any exception, reset the state of this model run so it will be picked up again later
-            model_run.status = ModelRun.ERROR
-            model_run.save()
+            # runs that only change crop loadings can usually be answered from precomputed responses
+            if response_basis.run_from_basis(model_run, timer=timer, attempt=attempt):
+                return
+
+            log.debug("Connecting to server to send command")
+            self._non_async_send(model_run, timer=timer, attempt=attempt)
+        except Exception as error:
+            if attempt is None:
+                model_run.status = ModelRun.ERROR
+                model_run.save()
+            else:
+                attempt.fail(error)
+                model_run.refresh_from_db(fields=['status', 'status_message', 'next_attempt_after'])
             raise
-
-    def _non_async_send(self, model_run):
-        # sanity check: model_run must be attached with at least one region
-        if len(model_run.regions.all()) < 1:
-            return
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.host, self.port))
-        # mantis_reader, mantis_writer = asyncio.open_connection(server.host, server.port)
-        # log.debug("Connected successfully")
-
-        region_type = model_run.regions.all()[0].region_type
-        modifications = model_run.modifications.all()
-        # sent the command to the server
-        # detailed input refers to https://github.com/giorgk/Mantis#format-of-input-message
-        command_string = "{} {} {} {}".format(model_run.n_years, model_run.reduction_year, model_run.water_content,
-                                              model_run.scenario.name)
-        command_string += " {}".format(mantis_area_map_id[region_type])
-        # use len() to cache db query
-        command_string += " {}".format(len(model_run.regions.all()))
-        if mantis_area_map_id[region_type] != 1:
-            for region in model_run.regions.all():
-                command_string += " {}".format(region.mantis_id)
-
-        # enable all crops, for those that are not explicitly selected, use data in All other crops
-        num_crops = len(Crop.objects.all())
-        selected_crops = set()
-        all_crops_param = 0
-        crops_input = ''
-        for modification in modifications.all():
-            if modification.crop.caml_code == 0:
-                all_crops_param = modification.proportion
-                continue
-            # assume all modifications are active in mantis
-            crops_input += " {} {}".format(modification.crop.caml_code, 1 - modification.proportion)
-            selected_crops.add(modification.crop.caml_code)
-        # add all remaining crops
-        for crop in Crop.objects.all():
-            if crop.caml_code not in selected_crops:
-                crops_input += " {} {}".format(crop.caml_code, 1 - all_crops_param)
-
-        command_string += ' {}'.format(num_crops)
-        command_string += crops_input
-        command_string += ' ENDofMSG\n'
+        else:
+            if attempt is not None:
+                attempt.complete()
+        finally:
+            run_status.notify(model_run.id)
+            RunTiming.record(model_run, timer)
+            self._record_metrics(model_run, timer)
+
+    def _record_metrics(self, model_run, timer):
+        durations = dict(timer.durations)
+        queue_wait = durations.pop("queue_wait", None)
+        if queue_wait is not None:
+            RUN_QUEUE_WAIT.observe(queue_wait)
+        RUN_DURATION.labels(status=ModelRun.STATUS_NAMES.get(model_run.status, model_run.status)).observe(sum(durations.values()))
+        if "response_transfer" in durations:  # only runs that went to Mantis
+            MANTIS_LATENCY.labels(server=self.address).observe(durations["mantis_compute"] + durations["response_transfer"])
+
+    @property
+    def address(self):
+        return "{}:{}".format(self.host, self.port)
+
+    def record_scenarios(self, model_run):
+        """
+            Notes that this server is loading a run's scenarios, so the scheduler can send it more runs like it
+        """
+        scenarios = [model_run.flow_scenario_id, model_run.load_scenario_id, model_run.unsat_scenario_id]
+        with transaction.atomic():  # the server's other workers record theirs too - start from what's stored
+            stored = MantisServer.objects.select_for_update().values_list('recent_scenarios', flat=True).get(id=self.id)
+            recent = [scenarios] + [other for other in stored if other != scenarios]
+            self.recent_scenarios = recent[:settings.MANTIS_RECENT_SCENARIOS]
+            MantisServer.objects.filter(id=self.id).update(recent_scenarios=self.recent_scenarios)
+
+    def _connect(self):
+        try:
+            connection = socket.create_connection((self.host, self.port), timeout=settings.MANTIS_TIMEOUT_SECONDS)
+        except OSError:
+            MANTIS_UP.labels(server=self.address).set(0)
+            raise
+        MANTIS_UP.labels(server=self.address).set(1)
+        return connection
+
+    def _non_async_send(self, model_run, timer=None, attempt=None):
+        from npsat_manager import command_builder  # needs these models
+
+        timer = timer or timing.StageTimer()
+        if settings.REGION_RESULT_CACHE_ENABLED:
+            from npsat_manager import region_results  # numpy, and needs these models
+            stored = region_results.run(self, model_run, timer=timer, attempt=attempt)
+            if stored is not None:  # None when none of its regions are cached - it runs as usual below
+                if stored:
+                    model_run.status = ModelRun.COMPLETED
+                    model_run.date_completed = timezone.now()
+                    model_run.save(update_fields=['status', 'date_completed'])
+                    log.info("Results saved")
+                    region_results.prune()  # after the run's done, so it doesn't hold the run up
+                return
+
+        with timer.stage("command_build"):
+            # sanity check: model_run must be attached with at least one region
+            command_string = command_builder.build(model_run)
+            if command_string is None:
+                return
         log.info("Command String is: {}".format(command_string))
-        s.send(command_string.encode('utf-8'))
+        self.record_scenarios(model_run)
 
-        # s.flush()
-        # mantis_writer.drain()  # make sure the full command is sent before proceeding with this function
+        if settings.PERCENTILE_MODE == "sketch":
+            stored = self._stream_results(command_string, model_run, timer, attempt=attempt)
+        else:
+            stored = process_results(self.run_command(command_string, timer=timer), model_run, timer=timer, attempt=attempt)
 
-        results = s.recv(999999999)  # basically, wait for Mantis to close the connection
-        process_results(results, model_run)
-        # model_run.result_values = str(results)
-        model_run.status = ModelRun.COMPLETED
-        model_run.date_completed = arrow.utcnow().datetime
-        model_run.save()
+        if stored:
+            model_run.status = ModelRun.COMPLETED
+            model_run.date_completed = timezone.now()
+            model_run.save(update_fields=['status', 'date_completed'])
+            log.info("Results saved")
 
-        log.info("Results saved")
+    def _stream_results(self, command_string, model_run, timer, attempt=None):
+        """
+            Feeds wells into a percentile sketch as they arrive so we never hold the full results in memory. Reading,
+            parsing and sketching overlap here, so everything after the first block is timed as the transfer
+        :return: True if results were stored
+        """
+        from npsat_manager import percentiles  # numpy - imported where results are handled to keep the models light
 
+        sketch = percentiles.StreamingPercentiles(model_run.n_years, settings.PERCENTILE_CALCULATIONS,
+                                                  capacity=settings.PERCENTILE_SKETCH_CAPACITY)
+        stage = "mantis_compute"
+        start_time = time.perf_counter()
+        try:
+            for block in self.stream_command(command_string, model_run.n_years):
+                if stage == "mantis_compute":
+                    timer.record(stage, time.perf_counter() - start_time)
+                    stage, start_time = "response_transfer", time.perf_counter()
+                sketch.add(block)
+        except mantis_protocol.MantisError as error:
+            mark_error(model_run, error)
+            return False
+        timer.record(stage, time.perf_counter() - start_time)
+
+        with timer.stage("percentiles"):
+            percentile_values = sketch.result()
+        with timer.stage("db_write"):
+            save_percentiles(percentile_values, model_run, n_wells=sketch.count, attempt=attempt)
+        log.info("Run {} percentiles estimated from {} wells with rank error under {:.3%}".format(
+            model_run.id, sketch.count, sketch.rank_error_bound))
+        return True
+
+    def stream_command(self, command_string, n_years):
+        """
+            Sends a command to this Mantis server and yields the wells in blocks as they come back
+        :param command_string: command, as built by mantis_protocol.build_command
+        :param n_years: number of years the run is for
+        :return: generator of 2D numpy arrays of (wells, years)
+        """
+        with self._connect() as connection:
+            connection.sendall(command_string.encode('utf-8'))
+            for block in mantis_protocol.iter_response_rows(connection, n_years):
+                yield block
 
-def process_results(results, model_run):
+    def run_command(self, command_string, timer=None):
+        """
+            Sends a command to this Mantis server and waits for the full response
+        :param command_string: command, as built by mantis_protocol.build_command
+        :param timer: optional support.timing.StageTimer to record compute and transfer time on
+        :return: response text
+        """
+        with self._connect() as connection:
+            connection.sendall(command_string.encode('utf-8'))
+            return mantis_protocol.read_response(connection, timer=timer)
+
+
+def process_results(results, model_run, timer=None, attempt=None):
     """
-		Given the model results,
-	:param results:
-	:param model_run:
-	:return:
-	"""
-    # This line will only appeared if used provided Test Client
-    # status_message = "Client sent hello message\n"
-    # if results.startswith(status_message):
-    # 	results = results[len(status_message):]  # if it starts with a status message, remove it
-
-    results_values = results.split(" ")
-    if results_values[0] == "0":  # Yes, a string 0 because of parsing. It means Mantis failed, store the error message
-        model_run.status_message = results_values
-        model_run.status = ModelRun.ERROR
-        model_run.save()
-        return
-
-    # otherwise, Mantis ran, so let's process everything
-
-    # slice off any blanks
-    results_values = [value for value in results_values if value not in (
-        "", "\n")]  # drop any extra empty values we got because they make the total number go off
-    model_run.n_wells = int(results_values[1])
-    results_values = results_values[
-                     2:-1]  # first value is status message, second value is number of wells, last is "EndOfMsg"
-
-    # we need to have a number of results divisible by the number of wells and the number of years, so do some checks
-    if len(results_values) % model_run.n_years != 0 or (len(results_values) / model_run.n_wells) != model_run.n_years:
-        error_message = "Got an incorrect number of results from model run. Cannot reliably process to percentiles. You may try again"
-        model_run.status = ModelRun.ERROR
-        model_run.status_message = error_message
-        log.error(error_message)  # log it as an error too so it goes to all the appropriate handlers
-        return
-
-    # OK, now we should be safe to proceed
-    # we're going to make a 2 dimensional numpy array where every row is a well and every column is a year
-    # start by making it a numpy array and convert to float by default
-    results_array = numpy.array(results_values, dtype=numpy.float)
-    results_2d = results_array.reshape(model_run.n_wells, model_run.n_years)
+        Given the model results, stores the percentiles for the run - or, if Mantis failed or sent back something
+        unusable, marks the run as errored
+    :param results: response text from Mantis
+    :param model_run:
+    :param timer: optional support.timing.StageTimer
+    :param attempt: RunAttempt processing the run, if any - see save_percentiles
+    :return: True if results were stored
+    """
+    timer = timer or timing.StageTimer()
+    try:
+        with timer.stage("parsing"):
+            results_2d = mantis_protocol.parse_response(results, model_run.n_years)
+    except mantis_protocol.MantisError as error:
+        mark_error(model_run, error)
+        return False
+
+    save_results(results_2d, model_run, timer=timer, attempt=attempt)
+    return True
+
+
+def mark_error(model_run, error):
+    model_run.status = ModelRun.ERROR
+    model_run.status_message = str(error)
+    log.error(str(error))  # log it as an error too so it goes to all the appropriate handlers
+    model_run.save()
+
 
+def save_results(results_2d, model_run, timer=None, attempt=None):
+    """
+        Computes and stores the percentiles across wells for each year
+    :param results_2d: 2 dimensional numpy array where every row is a well and every column is a year
+    :param model_run:
+    :param timer: optional support.timing.StageTimer
+    :param attempt: RunAttempt processing the run, if any - see save_percentiles
+    :return:
+    """
+    timer = timer or timing.StageTimer()
     # get the percentiles - when a percentile would be between 2 values, get the nearest actual value in the dataset
-    # instead of interpolating between them, mostly because numpy throws errors when we try that.
-    # skip all nan in the mantis output
-    percentiles = numpy.nanpercentile(results_2d, q=settings.PERCENTILE_CALCULATIONS, interpolation="nearest", axis=0)
-    for index, percentile in enumerate(settings.PERCENTILE_CALCULATIONS):
-        current_percentiles = json.dumps(
-            percentiles[index].tolist())  # coerce from numpy to list, then dump as JSON to a string
-        ResultPercentile(model=model_run, percentile=percentile, values=current_percentiles).save()
+    # instead of interpolating between them. skip all nan in the mantis output
+    with timer.stage("percentiles"):
+        from npsat_manager import percentiles
+        percentile_values = percentiles.exact(results_2d, settings.PERCENTILE_CALCULATIONS)
+    with timer.stage("db_write"):
+        save_percentiles(percentile_values, model_run, n_wells=results_2d.shape[0], attempt=attempt)
 
-    model_run.save()
+
+def save_percentiles(percentile_values, model_run, n_wells, attempt=None):
+    """
+        Stores a run's percentiles. Only the result fields are written, so that anything changed on the run while it
+        was processing (it being made public, or requeued by the sweeper) is left alone
+    :param percentile_values: 2D array of (percentiles, years) matching settings.PERCENTILE_CALCULATIONS
+    :param model_run:
+    :param n_wells: number of wells the percentiles were computed over
+    :param attempt: RunAttempt processing the run, if any. Raises LeaseLost, storing nothing, if it doesn't hold its
+                lease anymore
+    :return:
+    """
+    model_run.n_wells = n_wells
+    with transaction.atomic():
+        if attempt is not None and not attempt.holds_lease():
+            raise LeaseLost("Attempt {} at run {} lost its lease - not storing its results".format(attempt.number, model_run.id))
+        # replace anything stored by an earlier attempt at this run that didn't finish
+        ResultPercentile.objects.filter(model=model_run).delete()
+        for index, percentile in enumerate(settings.PERCENTILE_CALCULATIONS):
+            current_percentiles = json.dumps(
+                percentile_values[index].tolist())  # coerce from numpy to list, then dump as JSON to a string
+            ResultPercentile(model=model_run, percentile=percentile, values=current_percentiles).save()
+
+        model_run.save(update_fields=['n_wells'])
@@ -1,15 +1,13 @@
-from numba import njit
-import numpy
-
-import django
+"""
+	Scratch script for trying a model run against whatever Modifications are in the database. Only does anything
+	when run directly - it used to set up Django and run the full model at import time. For timing the model
+	functions, use `python manage.py benchmark_kernels` instead.
+"""
 
 import os
 
-os.environ["DJANGO_SETTINGS_MODULE"] = 'npsat_backend.settings'
-django.setup()
-
-from npsat_manager import mantis
-from npsat_manager import models
+import numpy
+from numba import njit
 
 
 @njit
@@ -18,9 +16,18 @@ def numba_sum():
 	array = numpy.array(l1, dtype=numpy.float64)
 	return array.sum()
 
-test = numba_sum()
 
-mods = models.Modification.objects.all()
+if __name__ == "__main__":
+	import django
+
+	os.environ["DJANGO_SETTINGS_MODULE"] = 'npsat_backend.settings'
+	django.setup()
+
+	from npsat_manager import mantis
+	from npsat_manager import models
+
+	test = numba_sum()
 
-mantis.run_mantis(mods)
+	mods = models.Modification.objects.all()
 
+	mantis.run_mantis(mods)
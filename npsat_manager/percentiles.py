@@ -0,0 +1,179 @@
+"""
+	Percentiles across wells for each year of a run's results.
+
+	exact() gives the same answer as numpy.nanpercentile(..., interpolation="nearest", axis=0) but only partially
+	sorts each year's column with numpy.partition. StreamingPercentiles is a mergeable quantile sketch (a simple
+	KLL style compactor stack) that takes wells a block at a time as they come off the socket, so a statewide run
+	never needs the full (wells, years) matrix in memory. It reports a guaranteed bound on its rank error.
+"""
+
+import numpy
+
+
+def _nearest_ranks(q, counts):
+	"""
+		Ranks (0 based, in sorted order) numpy's "nearest" percentile method picks for each percentile and count
+	:param q: 1D array of percentiles, 0-100
+	:param counts: 1D array of how many values there are in each column
+	:return: 2D int array of (percentiles, columns)
+	"""
+	positions = numpy.asarray(q, dtype=numpy.float64)[:, None] / 100.0 * (numpy.asarray(counts)[None, :] - 1)
+	return numpy.around(positions).astype(numpy.int64)
+
+
+def exact(results_2d, q):
+	"""
+		Nearest-rank percentiles of each column, skipping NaNs
+	:param results_2d: 2D array where every row is a well and every column is a year
+	:param q: iterable of percentiles, 0-100
+	:return: 2D array of (percentiles, years). Columns with no values are NaN
+	"""
+	q = numpy.asarray(q, dtype=numpy.float64)
+	n_wells, n_years = results_2d.shape
+	output = numpy.full((len(q), n_years), numpy.nan)
+
+	nans = numpy.isnan(results_2d)
+	if not nans.any():  # the common case - every column has every well, so partition them all at once
+		if n_wells == 0:
+			return output
+		ranks = _nearest_ranks(q, [n_wells])[:, 0]
+		partitioned = numpy.partition(results_2d, numpy.unique(ranks), axis=0)
+		return partitioned[ranks, :]
+
+	counts = n_wells - nans.sum(axis=0)
+	ranks = _nearest_ranks(q, counts)
+	for year in range(n_years):
+		if counts[year] == 0:
+			continue
+		column = results_2d[~nans[:, year], year]
+		partitioned = numpy.partition(column, numpy.unique(ranks[:, year]))
+		output[:, year] = partitioned[ranks[:, year]]
+
+	return output
+
+
+class StreamingPercentiles(object):
+	"""
+		Approximate per-column percentiles over a stream of rows, in memory proportional to capacity * log(rows)
+		rather than rows.
+
+		Rows go into level 0. Whenever a level holds capacity items, each column is sorted and every other item
+		(starting at a random offset) moves up a level, where it counts double. Since every column is compacted the
+		same way, all the years are handled together with vectorized sorts. NaNs are counted exactly and stored as
+		+inf so that they sort to the top and never affect percentiles of the real values.
+
+		Each compaction at level h can shift any rank by at most 2**h, so summing over compactions gives a hard
+		bound on rank error - see rank_error_bound.
+	"""
+
+	def __init__(self, n_columns, q, capacity=256, seed=None):
+		"""
+		:param n_columns: number of columns (years) in each row
+		:param q: iterable of percentiles, 0-100
+		:param capacity: items per level before it compacts. Larger is more accurate and uses more memory
+		:param seed: seed for the compaction offsets, for reproducible results
+		"""
+		if capacity < 2:
+			raise ValueError("capacity must be at least 2")
+		self.n_columns = n_columns
+		self.q = numpy.asarray(q, dtype=numpy.float64)
+		self.capacity = capacity
+		self.count = 0  # rows added
+		self.nan_counts = numpy.zeros(n_columns, dtype=numpy.int64)
+		self.minimums = numpy.full(n_columns, numpy.inf)
+		self.maximums = numpy.full(n_columns, -numpy.inf)
+		self.levels = [[]]  # list of lists of blocks - level h holds items that each stand for 2**h rows
+		self.level_sizes = [0]
+		self.compactions = [0]
+		self._random = numpy.random.default_rng(seed)
+
+	def add(self, rows):
+		"""
+		:param rows: 2D array of (rows, n_columns), or a single 1D row
+		"""
+		rows = numpy.array(rows, dtype=numpy.float64, ndmin=2)  # copies, since we write infs in below
+		if rows.shape[0] == 0:
+			return
+
+		nans = numpy.isnan(rows)
+		self.nan_counts += nans.sum(axis=0)
+		rows[nans] = numpy.inf
+		self.minimums = numpy.minimum(self.minimums, rows.min(axis=0))
+		finite_rows = numpy.where(nans, -numpy.inf, rows)
+		self.maximums = numpy.maximum(self.maximums, finite_rows.max(axis=0))
+
+		self.count += rows.shape[0]
+		self.levels[0].append(rows)
+		self.level_sizes[0] += rows.shape[0]
+		self._compress()
+
+	def _compress(self):
+		level = 0
+		while level < len(self.levels):
+			if self.level_sizes[level] >= self.capacity:
+				items = numpy.sort(numpy.concatenate(self.levels[level]), axis=0)
+				n_pairs = items.shape[0] // 2
+				offset = int(self._random.integers(2))
+				promoted = items[offset:2 * n_pairs:2]
+				leftover = items[2 * n_pairs:]  # odd item out stays on this level
+
+				self.levels[level] = [leftover] if leftover.shape[0] > 0 else []
+				self.level_sizes[level] = leftover.shape[0]
+				self.compactions[level] += 1
+
+				if level + 1 == len(self.levels):
+					self.levels.append([])
+					self.level_sizes.append(0)
+					self.compactions.append(0)
+				self.levels[level + 1].append(promoted)
+				self.level_sizes[level + 1] += promoted.shape[0]
+			level += 1
+
+	@property
+	def rank_error_bound(self):
+		"""
+			Worst case error in the rank of any returned value, as a fraction of the number of values in a column
+		"""
+		if self.count == 0:
+			return 0.0
+		absolute = sum(compactions * 2 ** level for level, compactions in enumerate(self.compactions))
+		return absolute / float(self.count)
+
+	@property
+	def nbytes(self):
+		return sum(block.nbytes for level in self.levels for block in level)
+
+	def result(self):
+		"""
+		:return: 2D array of (percentiles, columns), using nearest rank like exact(). Columns with no values are NaN
+		"""
+		output = numpy.full((len(self.q), self.n_columns), numpy.nan)
+		valid_counts = self.count - self.nan_counts
+		if self.count == 0:
+			return output
+
+		items = []
+		weights = []
+		for level, blocks in enumerate(self.levels):
+			for block in blocks:
+				items.append(block)
+				weights.append(numpy.full(block.shape[0], 2 ** level, dtype=numpy.int64))
+		items = numpy.concatenate(items)
+		weights = numpy.concatenate(weights)
+
+		order = numpy.argsort(items, axis=0, kind="stable")
+		sorted_items = numpy.take_along_axis(items, order, axis=0)
+		cumulative_weights = numpy.cumsum(weights[order], axis=0)
+
+		ranks = _nearest_ranks(self.q, valid_counts)
+		for column in range(self.n_columns):
+			if valid_counts[column] == 0:
+				continue
+			positions = numpy.searchsorted(cumulative_weights[:, column], ranks[:, column], side="right")
+			positions = numpy.minimum(positions, sorted_items.shape[0] - 1)
+			values = sorted_items[positions, column]
+			# extremes are tracked exactly, and approximation near the top could land on a NaN placeholder
+			values = numpy.clip(values, self.minimums[column], self.maximums[column])
+			output[:, column] = values
+
+		return output
@@ -0,0 +1,81 @@
+"""
+	Caches the API data for the reference tables - regions (with their geometry, the most expensive thing we
+	serialize), crops and scenarios - in the "reference" cache from settings.CACHES. That's a file based cache, so
+	every server worker process shares it and only one of them has to build each response.
+
+	Each table has a version number stored in the same cache, which is part of every key for that table. Saving or
+	deleting a row bumps the version, from whichever process made the change, so every worker stops using the old
+	responses at once. Changes that skip signals (queryset updates, raw SQL) show up once the cache times out.
+"""
+
+import time
+
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from rest_framework.response import Response
+
+from npsat_manager import models
+
+CACHE_ALIAS = "reference"
+REFERENCE_MODELS = (models.Crop, models.Region, models.Scenario)
+
+
+def _cache():
+	return caches[CACHE_ALIAS]
+
+
+def _version_key(model):
+	return "reference_version:{}".format(model._meta.model_name)
+
+
+def version(model):
+	# the clock, rather than a counter, so a cleared cache can't hand out a version that's been used before
+	return _cache().get_or_set(_version_key(model), time.time_ns, timeout=None)
+
+
+def invalidate(model):
+	_cache().set(_version_key(model), time.time_ns(), timeout=None)
+
+
+@receiver([post_save, post_delete])
+def _reference_changed(sender, **kwargs):
+	if sender in REFERENCE_MODELS:
+		invalidate(sender)
+
+
+class CachedReferenceMixin(object):
+	"""
+		For read-only-to-most viewsets of reference tables, whose responses are the same for every user. list and
+		retrieve responses are cached by full path (so query params and paging are part of the key). JSON responses
+		are cached already rendered - rendering region geometry costs more than building the data - and anything
+		else (the browsable API) caches the data. Needs reference_model set to the model being served
+	"""
+	reference_model = None
+
+	def list(self, request, *args, **kwargs):
+		return self._cached_response(request, super().list, *args, **kwargs)
+
+	def retrieve(self, request, *args, **kwargs):
+		return self._cached_response(request, super().retrieve, *args, **kwargs)
+
+	def _cached_response(self, request, view, *args, **kwargs):
+		renderer = request.accepted_renderer
+		rendered = renderer.format == "json"
+		key = "reference:{}:{}:{}:{}".format(self.reference_model._meta.model_name, version(self.reference_model),
+											 renderer.format, request.get_full_path())
+		cached = _cache().get(key)
+		if cached is not None:
+			return HttpResponse(cached, content_type=request.accepted_media_type) if rendered else Response(cached)
+
+		response = view(request, *args, **kwargs)
+		if response.status_code != 200:
+			return response
+		if not rendered:
+			_cache().set(key, response.data)
+			return response
+
+		content = renderer.render(response.data, request.accepted_media_type, self.get_renderer_context())
+		_cache().set(key, content)
+		return HttpResponse(content, content_type=request.accepted_media_type)
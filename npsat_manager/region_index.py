@@ -0,0 +1,157 @@
+"""
+	Spatial index over the regions' bounding boxes, for finding the regions that contain a point or overlap a map
+	view without sending every region's geometry to the client.
+
+	It's a packed Hilbert R-tree. The boxes are sorted along a Hilbert curve through their centers, so neighbors
+	on the map end up next to each other, and then packed bottom up into nodes of NODE_SIZE - each node's box
+	covers its children's. The tree is a list of (nodes, 4) arrays of min_x, min_y, max_x, max_y, one per level
+	with the leaves first, and node i's children are entries i * NODE_SIZE up to (i + 1) * NODE_SIZE of the level
+	below. A query walks down a level at a time with numpy, checking every surviving node's children at once.
+
+	Point queries check the candidates' actual polygons (even-odd, so holes count as outside). Box queries return
+	every region whose bounding box overlaps the box, which is what a map view needs to draw.
+
+	The index is built from every region with a geometry the first time it's needed in each process, and rebuilt
+	when the region reference version changes (see reference_cache) - that's bumped whenever a region is saved or
+	deleted, from any process.
+"""
+
+import logging
+import threading
+
+import numpy
+
+from npsat_manager import models, reference_cache
+from npsat_manager.support import geometry as geometry_tools
+
+log = logging.getLogger("npsat.region_index")
+
+NODE_SIZE = 16
+HILBERT_ORDER = 16  # the curve goes through a 2^16 by 2^16 grid over the regions' extent
+
+
+def hilbert_values(xs, ys, order=HILBERT_ORDER):
+	"""
+	:param xs: integer x positions on the 2^order grid
+	:param ys: integer y positions on the 2^order grid
+	:return: each point's distance along the Hilbert curve, as int64
+	"""
+	side = 1 << order
+	xs = numpy.asarray(xs, dtype=numpy.int64).copy()
+	ys = numpy.asarray(ys, dtype=numpy.int64).copy()
+	distances = numpy.zeros(xs.shape, dtype=numpy.int64)
+	step = side >> 1
+	while step > 0:
+		in_right = (xs & step) > 0
+		in_top = (ys & step) > 0
+		distances += step * step * ((3 * in_right.astype(numpy.int64)) ^ in_top.astype(numpy.int64))
+		# rotate the quadrant so the curve inside it lines up with the one above
+		rotate = ~in_top
+		flip = rotate & in_right
+		xs = numpy.where(flip, side - 1 - xs, xs)
+		ys = numpy.where(flip, side - 1 - ys, ys)
+		xs, ys = numpy.where(rotate, ys, xs), numpy.where(rotate, xs, ys)
+		step >>= 1
+	return distances
+
+
+def _intersects(boxes, box):
+	return (boxes[:, 0] <= box[2]) & (boxes[:, 2] >= box[0]) & (boxes[:, 1] <= box[3]) & (boxes[:, 3] >= box[1])
+
+
+class RegionIndex(object):
+
+	def __init__(self, region_ids, boxes, rings):
+		"""
+		:param region_ids: sequence of region ids
+		:param boxes: (regions, 4) array of each region's min_x, min_y, max_x, max_y
+		:param rings: dict of region id: list of the region's rings, from support.geometry.rings
+		"""
+		region_ids = numpy.asarray(region_ids, dtype=numpy.int64)
+		boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+		self.rings = rings
+
+		if len(boxes) > 0:
+			centers = numpy.column_stack(((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2))
+			low = centers.min(axis=0)
+			extent = numpy.maximum(centers.max(axis=0) - low, numpy.finfo(numpy.float64).tiny)
+			grid = ((centers - low) / extent * ((1 << HILBERT_ORDER) - 1)).astype(numpy.int64)
+			order = numpy.argsort(hilbert_values(grid[:, 0], grid[:, 1]), kind="stable")
+			region_ids, boxes = region_ids[order], boxes[order]
+
+		self.region_ids = region_ids
+		self.levels = [boxes]
+		while len(self.levels[-1]) > NODE_SIZE:
+			children = self.levels[-1]
+			starts = numpy.arange(0, len(children), NODE_SIZE)
+			self.levels.append(numpy.column_stack((
+				numpy.minimum.reduceat(children[:, 0], starts), numpy.minimum.reduceat(children[:, 1], starts),
+				numpy.maximum.reduceat(children[:, 2], starts), numpy.maximum.reduceat(children[:, 3], starts),
+			)))
+
+	@classmethod
+	def build(cls, regions):
+		"""
+		:param regions: iterable of (region id, geometry) - geometry as stored in Region.geometry
+		:return: RegionIndex
+		"""
+		region_ids = []
+		boxes = []
+		rings = {}
+		for region_id, geometry in regions:
+			try:
+				region_rings = geometry_tools.rings(geometry)
+			except (KeyError, TypeError, ValueError) as error:
+				log.warning("Leaving region {} out of the spatial index - its geometry can't be read: {}".format(region_id, error))
+				continue
+			if len(region_rings) == 0:
+				continue
+			coordinates = numpy.concatenate(region_rings)
+			region_ids.append(region_id)
+			boxes.append(numpy.concatenate((coordinates.min(axis=0), coordinates.max(axis=0))))
+			rings[region_id] = region_rings
+		return cls(region_ids, boxes, rings)
+
+	def __len__(self):
+		return len(self.region_ids)
+
+	def intersecting(self, box):
+		"""
+		:param box: (min_x, min_y, max_x, max_y)
+		:return: list of the ids of regions whose bounding boxes overlap the box
+		"""
+		if len(self.region_ids) == 0:
+			return []
+		candidates = numpy.arange(len(self.levels[-1]))
+		for depth in range(len(self.levels) - 1, -1, -1):
+			candidates = candidates[_intersects(self.levels[depth][candidates], box)]
+			if depth > 0:
+				children = (candidates[:, None] * NODE_SIZE + numpy.arange(NODE_SIZE)).ravel()
+				candidates = children[children < len(self.levels[depth - 1])]
+		return self.region_ids[candidates].tolist()
+
+	def containing(self, x, y):
+		"""
+		:return: list of the ids of regions whose polygons contain the point
+		"""
+		return [region_id for region_id in self.intersecting((x, y, x, y))
+				if geometry_tools.contains_point(self.rings[region_id], x, y)]
+
+
+_lock = threading.Lock()
+_index = None
+_index_version = None
+
+
+def get():
+	"""
+	:return: RegionIndex of every region with a geometry, rebuilt if regions changed since it was built
+	"""
+	global _index, _index_version
+	current_version = reference_cache.version(models.Region)
+	with _lock:
+		if _index is None or _index_version != current_version:
+			_index = RegionIndex.build(models.Region.objects.exclude(geometry=None).values_list('id', 'geometry').iterator())
+			_index_version = current_version
+			log.info("Built the region spatial index over {} regions".format(len(_index)))
+		return _index
@@ -0,0 +1,285 @@
+"""
+	Precomputed region masks on the model grid so that the in-process model can work on a subset of the
+	Central Valley without clipping rasters by hand (see utilities/extract_region.py for the old arcpy approach).
+
+	Each Region's geometry is rasterized once onto the grid of the loading rasters. The mask is stored as a
+	bounding window (row offset, column offset, rows, columns) plus run-length encoded runs of cells inside the
+	region, in row-major order within that window. The window lets us read only that block of each raster, and
+	the runs tell the convolution which cells in the block to touch.
+"""
+
+import logging
+import math
+
+import numpy
+
+from npsat_manager.support import compatibility
+from npsat_manager.support import geometry as geometry_tools
+
+log = logging.getLogger("npsat.region_masks")
+
+
+class RasterGrid(object):
+	"""
+		The cell layout of the model rasters - everything needed to turn map coordinates into rows and columns.
+	"""
+
+	def __init__(self, geotransform, rows, cols, projection=None):
+		"""
+		:param geotransform: GDAL style six-tuple (origin_x, cell_width, 0, origin_y, 0, cell_height)
+		:param rows: number of rows in the grid
+		:param cols: number of columns in the grid
+		:param projection: WKT of the grid's coordinate system. When empty or None, region coordinates are
+						assumed to already be in the grid's coordinate system and aren't reprojected
+		"""
+		self.geotransform = tuple(float(value) for value in geotransform)
+		self.rows = int(rows)
+		self.cols = int(cols)
+		self.projection = projection or None
+
+	@classmethod
+	def from_raster(cls, raster):
+		geotransform, rows, cols, projection = compatibility.raster_grid(raster)
+		return cls(geotransform, rows, cols, projection)
+
+	def to_pixel_space(self, xs, ys):
+		"""
+			Converts map coordinates into fractional column/row positions - cell (r, c) covers [c, c+1) x [r, r+1)
+		"""
+		origin_x, cell_width, _, origin_y, _, cell_height = self.geotransform
+		return (xs - origin_x) / cell_width, (ys - origin_y) / cell_height
+
+
+class RegionMask(object):
+	"""
+		Run-length encoded mask of the cells inside a region, limited to the region's bounding window
+	"""
+
+	def __init__(self, window, runs):
+		"""
+		:param window: (row_offset, col_offset, rows, cols) of the block of the grid covering the region
+		:param runs: (n, 2) array of (start, length) runs of cells inside the region. Starts are offsets into
+					the window flattened in row-major order
+		"""
+		self.window = tuple(int(value) for value in window)
+		self.runs = numpy.asarray(runs, dtype=numpy.int64).reshape(-1, 2)
+
+	@classmethod
+	def from_array(cls, mask, row_offset=0, col_offset=0):
+		"""
+			Builds a mask from a boolean array, shrinking the window to the cells that are actually set
+		:param mask: 2D boolean array
+		:param row_offset: row of the grid where mask[0, 0] sits
+		:param col_offset: column of the grid where mask[0, 0] sits
+		:return: RegionMask
+		"""
+		mask = numpy.asarray(mask, dtype=bool)
+		rows_present = numpy.flatnonzero(mask.any(axis=1))
+		cols_present = numpy.flatnonzero(mask.any(axis=0))
+		if len(rows_present) == 0:
+			return cls((row_offset, col_offset, 0, 0), numpy.empty((0, 2), dtype=numpy.int64))
+
+		first_row, last_row = rows_present[0], rows_present[-1] + 1
+		first_col, last_col = cols_present[0], cols_present[-1] + 1
+		window_mask = mask[first_row:last_row, first_col:last_col]
+
+		edges = numpy.diff(numpy.concatenate(([0], window_mask.ravel().view(numpy.int8), [0])))
+		starts = numpy.flatnonzero(edges == 1)
+		ends = numpy.flatnonzero(edges == -1)
+		window = (row_offset + first_row, col_offset + first_col, last_row - first_row, last_col - first_col)
+		return cls(window, numpy.column_stack((starts, ends - starts)))
+
+	@classmethod
+	def union(cls, masks):
+		"""
+			Combines masks into one mask whose window covers all of them
+		:param masks: iterable of RegionMask
+		:return: RegionMask
+		"""
+		masks = [mask for mask in masks if not mask.is_empty]
+		if len(masks) == 0:
+			return cls((0, 0, 0, 0), numpy.empty((0, 2), dtype=numpy.int64))
+
+		first_row = min(mask.window[0] for mask in masks)
+		first_col = min(mask.window[1] for mask in masks)
+		last_row = max(mask.window[0] + mask.window[2] for mask in masks)
+		last_col = max(mask.window[1] + mask.window[3] for mask in masks)
+
+		combined = numpy.zeros((last_row - first_row, last_col - first_col), dtype=bool)
+		for mask in masks:
+			row_offset, col_offset, rows, cols = mask.window
+			row_offset -= first_row
+			col_offset -= first_col
+			combined[row_offset:row_offset + rows, col_offset:col_offset + cols] |= mask.to_array()
+
+		return cls.from_array(combined, first_row, first_col)
+
+	@property
+	def is_empty(self):
+		return len(self.runs) == 0
+
+	@property
+	def cell_count(self):
+		return int(self.runs[:, 1].sum())
+
+	def window_indices(self):
+		"""
+		:return: offsets of every cell in the mask into the window flattened in row-major order
+		"""
+		starts = self.runs[:, 0]
+		lengths = self.runs[:, 1]
+		run_starts_in_output = numpy.cumsum(lengths) - lengths
+		return numpy.arange(lengths.sum(), dtype=numpy.int64) + numpy.repeat(starts - run_starts_in_output, lengths)
+
+	def grid_indices(self, grid_cols):
+		"""
+		:param grid_cols: number of columns in the full grid
+		:return: offsets of every cell in the mask into the full grid flattened in row-major order
+		"""
+		row_offset, col_offset, _, cols = self.window
+		indices = self.window_indices()
+		return (indices // cols + row_offset) * grid_cols + indices % cols + col_offset
+
+	def to_array(self):
+		"""
+		:return: boolean array the size of the window with cells inside the region set to True
+		"""
+		_, _, rows, cols = self.window
+		flat = numpy.zeros(rows * cols, dtype=bool)
+		flat[self.window_indices()] = True
+		return flat.reshape(rows, cols)
+
+
+def rasterize(geometry, grid):
+	"""
+		Finds the cells of the grid whose centers fall inside the geometry. Uses an even-odd scanline fill, so
+		holes and multipolygon parts come out correctly without needing GDAL's rasterizer. Reprojects the
+		geometry (GeoJSON, so lon/lat) onto the grid first when the grid has a projection.
+	:param geometry: GeoJSON Feature, Polygon or MultiPolygon - the contents of Region.geometry
+	:param grid: RasterGrid
+	:return: RegionMask
+	"""
+	edge_starts = []
+	edge_ends = []
+	for ring in geometry_tools.rings(geometry):
+		xs, ys = ring[:, 0], ring[:, 1]
+		if grid.projection:
+			xs, ys = compatibility.transform_coordinates(xs, ys, grid.projection)
+		cols, rows = grid.to_pixel_space(xs, ys)
+		points = numpy.column_stack((cols, rows))
+		edge_starts.append(points)
+		edge_ends.append(numpy.roll(points, -1, axis=0))
+
+	if len(edge_starts) == 0:
+		return RegionMask.from_array(numpy.zeros((0, 0), dtype=bool))
+
+	starts = numpy.concatenate(edge_starts)
+	ends = numpy.concatenate(edge_ends)
+	x0, y0, x1, y1 = starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+	all_x = numpy.concatenate((x0, x1))
+	all_y = numpy.concatenate((y0, y1))
+	first_row = max(0, int(math.floor(all_y.min())))
+	last_row = min(grid.rows, int(math.ceil(all_y.max())))
+	first_col = max(0, int(math.floor(all_x.min())))
+	last_col = min(grid.cols, int(math.ceil(all_x.max())))
+	if first_row >= last_row or first_col >= last_col:  # the region doesn't touch the grid
+		return RegionMask.from_array(numpy.zeros((0, 0), dtype=bool))
+
+	mask = numpy.zeros((last_row - first_row, last_col - first_col), dtype=bool)
+	for row in range(first_row, last_row):
+		center = row + 0.5
+		crossing = (y0 <= center) != (y1 <= center)  # horizontal edges never cross, so no division by zero below
+		if not crossing.any():
+			continue
+		crossing_x = x0[crossing] + (center - y0[crossing]) * (x1[crossing] - x0[crossing]) / (y1[crossing] - y0[crossing])
+		crossing_x.sort()
+		for enter, leave in crossing_x.reshape(-1, 2):
+			# cell c has its center at c + 0.5 - it's inside when enter <= c + 0.5 < leave
+			start_col = max(first_col, int(math.ceil(enter - 0.5)))
+			end_col = min(last_col, int(math.ceil(leave - 0.5)))
+			if end_col > start_col:
+				mask[row - first_row, start_col - first_col:end_col - first_col] = True
+
+	return RegionMask.from_array(mask, first_row, first_col)
+
+
+def rasterize_all(regions, grid):
+	"""
+		Rasterizes a batch of regions. Takes and returns plain data, so batches can be run in a process pool
+	:param regions: list of (region id, geometry) pairs
+	:param grid: RasterGrid
+	:return: list of (region id, RegionMask) pairs
+	"""
+	return [(region_id, rasterize(geometry, grid)) for region_id, geometry in regions]
+
+
+class RegionMaskIndex(object):
+	"""
+		All of the region masks for a grid, keyed by Region id. Saved as a single .npz file with the runs of all
+		regions packed end to end so the whole index loads in a few reads.
+	"""
+
+	def __init__(self, grid, masks=None):
+		self.grid = grid
+		self.masks = masks if masks is not None else {}
+
+	@classmethod
+	def build(cls, regions, grid):
+		"""
+		:param regions: iterable of npsat_manager.models.Region objects
+		:param grid: RasterGrid to rasterize onto
+		:return: RegionMaskIndex
+		"""
+		index = cls(grid)
+		for region in regions:
+			if region.geometry is None:
+				continue
+			index.masks[region.id] = rasterize(region.geometry, grid)
+			log.debug("Rasterized region {} ({} cells)".format(region.name, index.masks[region.id].cell_count))
+		return index
+
+	def __contains__(self, region_id):
+		return region_id in self.masks
+
+	def get(self, region_id):
+		return self.masks[region_id]
+
+	def combined(self, region_ids):
+		"""
+			Gets a single mask covering all of the requested regions
+		:param region_ids: iterable of Region ids
+		:return: RegionMask
+		"""
+		region_ids = list(region_ids)
+		missing = [region_id for region_id in region_ids if region_id not in self.masks]
+		if len(missing) > 0:
+			raise KeyError("No masks for regions {} - rebuild the region mask index".format(missing))
+		return RegionMask.union(self.masks[region_id] for region_id in region_ids)
+
+	def save(self, path):
+		region_ids = sorted(self.masks)
+		masks = [self.masks[region_id] for region_id in region_ids]
+		run_counts = [len(mask.runs) for mask in masks]
+		numpy.savez(
+			path,
+			region_ids=numpy.array(region_ids, dtype=numpy.int64),
+			windows=numpy.array([mask.window for mask in masks], dtype=numpy.int64).reshape(-1, 4),
+			run_offsets=numpy.concatenate(([0], numpy.cumsum(run_counts))).astype(numpy.int64),
+			runs=numpy.concatenate([mask.runs for mask in masks]) if len(masks) > 0 else numpy.empty((0, 2), dtype=numpy.int64),
+			geotransform=numpy.array(self.grid.geotransform, dtype=numpy.float64),
+			shape=numpy.array((self.grid.rows, self.grid.cols), dtype=numpy.int64),
+			projection=numpy.array(self.grid.projection or ""),
+		)
+
+	@classmethod
+	def load(cls, path):
+		with numpy.load(path) as data:
+			grid = RasterGrid(data["geotransform"], data["shape"][0], data["shape"][1], str(data["projection"]))
+			run_offsets = data["run_offsets"]
+			runs = data["runs"]
+			masks = {}
+			for position, region_id in enumerate(data["region_ids"].tolist()):
+				masks[region_id] = RegionMask(data["windows"][position], runs[run_offsets[position]:run_offsets[position + 1]])
+
+		return cls(grid, masks)
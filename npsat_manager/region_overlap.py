@@ -0,0 +1,135 @@
+"""
+	Precomputes how much of each region lies inside each region of every other type - what fraction of a county is
+	in each B118 basin, which townships make up a CVHM farm - so the API can answer cross-type questions with a
+	table read instead of the client intersecting polygons.
+
+	Every region is rasterized onto one lon/lat grid covering them all (settings.REGION_OVERLAP_CELL_SIZE degrees a
+	cell, using region_masks.rasterize), in batches spread over a process pool. Each region type then gets a label
+	grid holding, for every cell, which of that type's regions covers it. Regions of one type are taken to tile
+	the map without overlapping each other - where they do, the region rasterized last gets the shared cells. For
+	each pair of types, the label of the other type is read at every cell of each region, and the cells are summed
+	per pair of regions, weighted by the cosine of their latitude since a degree of longitude narrows to the north.
+
+	The fraction stored for (region, other region) is the area they share over region's area, so a region's
+	fractions over one other type add up to about 1 where that type covers it. Fractions below
+	settings.REGION_OVERLAP_MIN_FRACTION are rasterization slivers along shared borders and aren't stored.
+"""
+
+import concurrent.futures
+import logging
+import math
+import multiprocessing
+import os
+
+import numpy
+from django.db import transaction
+
+from npsat_backend import settings
+from npsat_manager import models, reference_cache, region_masks
+from npsat_manager.support import geometry as geometry_tools
+
+log = logging.getLogger("npsat.region_overlap")
+
+BATCH_SIZE = 50  # regions rasterized per task
+
+
+def grid_for(geometries, cell_size):
+	"""
+	:param geometries: iterable of region geometries
+	:param cell_size: cell width and height, in degrees
+	:return: region_masks.RasterGrid covering all of the geometries, north up
+	"""
+	boxes = numpy.array([box for box in (geometry_tools.bounds(geometry) for geometry in geometries) if box is not None])
+	min_x, min_y = boxes[:, 0].min(), boxes[:, 1].min()
+	max_x, max_y = boxes[:, 2].max(), boxes[:, 3].max()
+	cols = max(1, int(math.ceil((max_x - min_x) / cell_size)))
+	rows = max(1, int(math.ceil((max_y - min_y) / cell_size)))
+	return region_masks.RasterGrid((min_x, cell_size, 0, max_y, 0, -cell_size), rows, cols)
+
+
+def rasterize(regions, grid, workers=None):
+	"""
+	:param regions: list of (region id, geometry) pairs
+	:param grid: region_masks.RasterGrid
+	:param workers: processes to rasterize in - defaults to one per core. 1 rasterizes in this process
+	:return: dict of region id: region_masks.RegionMask
+	"""
+	batches = [regions[start:start + BATCH_SIZE] for start in range(0, len(regions), BATCH_SIZE)]
+	workers = min(workers or os.cpu_count() or 1, len(batches))
+	if workers <= 1:
+		return dict(mask for batch in batches for mask in region_masks.rasterize_all(batch, grid))
+
+	# spawned rather than forked, so the workers don't share this process's database connection
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+		return dict(mask for masks in pool.map(region_masks.rasterize_all, batches, [grid] * len(batches)) for mask in masks)
+
+
+def overlaps(regions_by_type, masks, grid, min_fraction=0.0):
+	"""
+	:param regions_by_type: dict of region type: list of the ids of its regions
+	:param masks: dict of region id: region_masks.RegionMask on grid
+	:param grid: region_masks.RasterGrid the masks are on
+	:param min_fraction: fractions below this are left out
+	:return: list of (region id, other region id, fraction of region's area inside the other region)
+	"""
+	origin_y, cell_height = grid.geotransform[3], grid.geotransform[5]
+	row_weights = numpy.cos(numpy.radians(origin_y + (numpy.arange(grid.rows) + 0.5) * cell_height))
+
+	cells = {}  # region type: (flat cell indices of all its regions, position of the region each cell belongs to)
+	labels = {}  # region type: flat grid of positions in regions_by_type[region type], -1 where there's no region
+	for region_type, region_ids in regions_by_type.items():
+		type_cells = [masks[region_id].grid_indices(grid.cols) for region_id in region_ids]
+		positions = numpy.repeat(numpy.arange(len(region_ids)), [len(indices) for indices in type_cells])
+		type_cells = numpy.concatenate(type_cells) if len(type_cells) > 0 else numpy.empty(0, dtype=numpy.int64)
+		cells[region_type] = (type_cells, positions)
+		labels[region_type] = numpy.full(grid.rows * grid.cols, -1, dtype=numpy.int32)
+		labels[region_type][type_cells] = positions
+
+	results = []
+	for region_type, region_ids in regions_by_type.items():
+		type_cells, positions = cells[region_type]
+		weights = row_weights[type_cells // grid.cols]
+		areas = numpy.bincount(positions, weights=weights, minlength=len(region_ids))
+		for other_type, other_ids in regions_by_type.items():
+			if other_type == region_type:
+				continue
+			other_positions = labels[other_type][type_cells]
+			covered = other_positions >= 0
+			pairs, pair_positions = numpy.unique(positions[covered].astype(numpy.int64) * len(other_ids) + other_positions[covered],
+												 return_inverse=True)
+			shared = numpy.bincount(pair_positions, weights=weights[covered], minlength=len(pairs))
+			for pair, area in zip(pairs.tolist(), shared.tolist()):
+				position, other_position = divmod(pair, len(other_ids))
+				fraction = area / areas[position]
+				if fraction >= min_fraction:
+					results.append((region_ids[position], other_ids[other_position], fraction))
+	return results
+
+
+def build(workers=None, cell_size=None):
+	"""
+		Recomputes the overlap of every region with the regions of every other type, replacing the stored table
+	:param workers: processes to rasterize in - defaults to one per core
+	:param cell_size: grid cell size in degrees - defaults to settings.REGION_OVERLAP_CELL_SIZE
+	:return: number of RegionOverlap rows stored
+	"""
+	regions = list(models.Region.objects.exclude(geometry=None).order_by('id').values_list('id', 'region_type', 'geometry'))
+	if len(regions) == 0:
+		return 0
+	grid = grid_for((geometry for region_id, region_type, geometry in regions), cell_size or settings.REGION_OVERLAP_CELL_SIZE)
+	masks = rasterize([(region_id, geometry) for region_id, region_type, geometry in regions], grid, workers=workers)
+
+	regions_by_type = {}
+	for region_id, region_type, geometry in regions:
+		if masks[region_id].cell_count > 0:  # smaller than a cell - too small to measure at this resolution
+			regions_by_type.setdefault(region_type, []).append(region_id)
+	rows = overlaps(regions_by_type, masks, grid, min_fraction=settings.REGION_OVERLAP_MIN_FRACTION)
+
+	with transaction.atomic():
+		models.RegionOverlap.objects.all().delete()
+		models.RegionOverlap.objects.bulk_create([
+			models.RegionOverlap(region_id=region_id, other_region_id=other_id, fraction=fraction) for region_id, other_id, fraction in rows
+		], batch_size=5000)
+	reference_cache.invalidate(models.RegionOverlap)
+	log.info("Stored {} region overlaps between {} regions on a {} x {} grid".format(len(rows), len(regions), grid.rows, grid.cols))
+	return len(rows)
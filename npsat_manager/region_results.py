@@ -0,0 +1,233 @@
+"""
+	Cache of each region's (wells, years) results, so runs that share regions don't send the same work to Mantis
+	again - a run over Tulare and Kings and one over Tulare and Fresno both need Tulare's wells, and only the first
+	should have to compute them. It's off unless settings.REGION_RESULT_CACHE_ENABLED is set.
+
+	A region's results depend on the region, the scenarios, the run's years and water settings and the loading
+	weight of every crop, so those make up the key (see region_key). Mantis sends back one command's wells without
+	saying which region each belongs to, so only a command for a single region can be cached. A run that has none
+	of its regions cached therefore goes to Mantis as usual, in one command, and isn't cached (unless it's for a
+	single region). Once some of a run's regions are cached, only the missing ones are sent - one command each,
+	cached as they come back, if there are at most settings.REGION_RESULT_CACHE_MAX_SPLIT of them, otherwise
+	together in one command that isn't cached. The percentiles are then computed over the wells of all of the
+	run's regions together.
+
+	Each region's results are a .npy file in settings.REGION_RESULT_CACHE_FOLDER, named by a hash of its key, so
+	every dispatcher process shares them. Files are written under a temporary name and renamed into place, so a
+	reader never sees half of one, and they're read into memory rather than mapped, since Windows won't replace or
+	remove a file another process has mapped. Reads touch the file, and once the folder is over
+	settings.REGION_RESULT_CACHE_MAX_BYTES the least recently used files are removed (see prune). Failing to write,
+	touch or remove a file only costs the cache an entry - it never fails the run.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+import numpy
+
+from npsat_backend import settings
+from npsat_manager import command_builder, mantis_protocol, models, percentiles
+from npsat_manager.support import timing
+
+log = logging.getLogger("npsat.region_results")
+
+
+def region_key(model_run, region_type, mantis_id, weights):
+	"""
+	:param model_run: ModelRun - provides the scenarios, years and water settings
+	:param region_type: the region's region_type
+	:param mantis_id: the region's mantis_id
+	:param weights: list of (caml_code, weight) pairs for every crop, as returned by mantis_protocol.crop_weights
+	:return: hex digest identifying the region's results for these parameters
+	"""
+	# decimals are keyed as floats, so a run just created (water_content=0) and the same run read back from the
+	# database (Decimal("0.0000")) get the same key
+	travel_time = model_run.unsaturated_zone_travel_time
+	key = [
+		region_type, mantis_id,
+		model_run.flow_scenario_id, model_run.load_scenario_id, model_run.unsat_scenario_id,
+		model_run.n_years, model_run.reduction_start_year, model_run.reduction_end_year,
+		float(model_run.water_content), None if travel_time is None else float(travel_time),
+		sorted((caml_code, float(weight)) for caml_code, weight in weights),  # the same modifications in any order
+	]
+	return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def _keys(model_run, inputs):
+	"""
+	:param inputs: command_builder.RunInputs for the run
+	:return: (weights sent to Mantis, region_key of each of the run's regions in order)
+	"""
+	weights = mantis_protocol.crop_weights(inputs.modifications, inputs.crop_codes)
+	return weights, [region_key(model_run, inputs.region_type, mantis_id, weights) for mantis_id in inputs.mantis_ids]
+
+
+def _path(key):
+	return os.path.join(settings.REGION_RESULT_CACHE_FOLDER, "{}.npy".format(key))
+
+
+def load(key):
+	"""
+	:return: the region's 2D array of (wells, years), or None if it isn't cached
+	"""
+	path = _path(key)
+	try:
+		results = numpy.load(path)
+	except (OSError, ValueError):  # not cached, or being replaced or removed while we opened it
+		return None
+	try:
+		os.utime(path)  # for the least recently used eviction in prune
+	except OSError:
+		pass
+	return results
+
+
+def store(key, results):
+	"""
+		Caches a region's results. Failures are logged - a run doesn't depend on its results being cached
+	"""
+	temporary_path = os.path.join(settings.REGION_RESULT_CACHE_FOLDER, "{}.tmp".format(uuid.uuid4().hex))
+	try:
+		os.makedirs(settings.REGION_RESULT_CACHE_FOLDER, exist_ok=True)
+		with open(temporary_path, "wb") as temporary_file:
+			numpy.save(temporary_file, results)
+		os.replace(temporary_path, _path(key))
+	except OSError as error:  # on Windows, another process has the file open
+		log.warning("Couldn't cache region results {}: {}".format(key, error))
+		try:
+			os.remove(temporary_path)
+		except OSError:
+			pass
+
+
+def prune(max_bytes=None):
+	"""
+		Removes the least recently used results until the cache fits in max_bytes. Files another process has open
+		are skipped
+	:param max_bytes: defaults to settings.REGION_RESULT_CACHE_MAX_BYTES
+	:return: number of files removed
+	"""
+	max_bytes = settings.REGION_RESULT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+	entries = []
+	try:
+		with os.scandir(settings.REGION_RESULT_CACHE_FOLDER) as folder:
+			for entry in folder:
+				if entry.name.endswith(".npy"):
+					try:
+						stat = entry.stat()
+					except OSError:  # pruned by another process
+						continue
+					entries.append((stat.st_mtime, stat.st_size, entry.path))
+	except FileNotFoundError:  # nothing cached yet
+		return 0
+
+	total = sum(size for modified, size, path in entries)
+	removed = 0
+	for modified, size, path in sorted(entries):
+		if total <= max_bytes:
+			break
+		try:
+			os.remove(path)
+		except FileNotFoundError:  # pruned by another process
+			total -= size
+			continue
+		except OSError:  # open in another process on Windows - it'll go next time
+			continue
+		total -= size
+		removed += 1
+	return removed
+
+
+def cached(model_run):
+	"""
+		Gets whatever of a run's results is in the cache, without going to Mantis
+	:param model_run: ModelRun
+	:return: list of (region id, 2D array of (wells, years)) for each of the run's regions that is cached
+	"""
+	inputs = command_builder.run_inputs(model_run)
+	if inputs is None:
+		return []
+	weights, keys = _keys(model_run, inputs)
+	found = [(region_id, load(key)) for region_id, key in zip(inputs.region_ids, keys)]
+	return [(region_id, results) for region_id, results in found if results is not None]
+
+
+def _fetch(server, model_run, inputs, weights, indices, timer):
+	"""
+	:param indices: positions in inputs.mantis_ids of the regions to send to Mantis together
+	:return: 2D array of (wells, years) for those regions
+	"""
+	command = mantis_protocol.build_command(model_run, inputs.region_type, [inputs.mantis_ids[index] for index in indices], weights)
+	response = server.run_command(command, timer=timer)
+	with timer.stage("parsing"):
+		return mantis_protocol.parse_response(response, model_run.n_years)
+
+
+def run(server, model_run, timer=None, attempt=None):
+	"""
+		Computes a run's results from its cached regions and Mantis, caching what can be (see the module docstring).
+		Stores the run's percentiles, but leaves completing the run to the caller.
+	:param server: MantisServer to send missing regions to
+	:param model_run: ModelRun
+	:param timer: optional support.timing.StageTimer
+	:param attempt: RunAttempt processing the run, if any - see models.save_percentiles
+	:return: True if results were stored, False if the run has no regions or Mantis failed (the run is marked
+			as an error then), or None if none of the run's regions are cached and it's for more than one region -
+			the caller should run it as usual then
+	"""
+	timer = timer or timing.StageTimer()
+	with timer.stage("command_build"):
+		inputs = command_builder.run_inputs(model_run)
+		if inputs is None:
+			return False
+		weights, keys = _keys(model_run, inputs)
+		present = [os.path.exists(_path(key)) for key in keys]
+	cached_indices = [index for index, is_cached in enumerate(present) if is_cached]
+	missing = [index for index, is_cached in enumerate(present) if not is_cached]
+	if len(cached_indices) == 0 and len(keys) > 1:
+		return None
+
+	log.info("Run {} has {} of {} regions cached".format(model_run.id, len(cached_indices), len(keys)))
+	if len(missing) <= settings.REGION_RESULT_CACHE_MAX_SPLIT:
+		commands = [[index] for index in missing]
+	else:  # too many round trips to be worth caching them
+		commands = [missing]
+	if len(missing) > 0:
+		server.record_scenarios(model_run)
+
+	def region_wells():
+		"""
+			Yields each region's wells (or the missing regions' together), one at a time
+		"""
+		for index in cached_indices:
+			results = load(keys[index])
+			if results is None:  # pruned since we looked
+				results = _fetch(server, model_run, inputs, weights, [index], timer)
+				store(keys[index], results)
+			yield results
+		for indices in commands:
+			results = _fetch(server, model_run, inputs, weights, indices, timer)
+			if len(indices) == 1:
+				store(keys[indices[0]], results)
+			yield results
+
+	try:
+		if settings.PERCENTILE_MODE == "sketch":  # each region's wells are dropped once they're in the sketch
+			sketch = percentiles.StreamingPercentiles(model_run.n_years, settings.PERCENTILE_CALCULATIONS,
+													  capacity=settings.PERCENTILE_SKETCH_CAPACITY)
+			for results in region_wells():
+				with timer.stage("percentiles"):
+					sketch.add(results)
+			with timer.stage("percentiles"):
+				percentile_values = sketch.result()
+			with timer.stage("db_write"):
+				models.save_percentiles(percentile_values, model_run, n_wells=sketch.count, attempt=attempt)
+		else:
+			models.save_results(numpy.concatenate(list(region_wells())), model_run, timer=timer, attempt=attempt)
+	except mantis_protocol.MantisError as error:
+		models.mark_error(model_run, error)
+		return False
+	return True
@@ -0,0 +1,186 @@
+"""
+	Fast path for what-if runs. The model is linear in loading - a modification only scales a crop's loading by its
+	weight after the change year, and the convolution is linear - so for a fixed region and set of run parameters
+
+		well curves = base curves - sum over crops of (1 - weight) * crop response
+
+	where a crop's response is the base curves minus the curves of a run with that crop's loading removed. We
+	precompute the base curves and one response per crop code with Mantis (see precompute), then answer new
+	modification sets with one small matrix multiply instead of a Mantis run.
+
+	This relies on Mantis returning the wells for a region in the same order on every run. Runs with options that
+	aren't linear in loading, or whose parameters don't match a precomputed basis, fall back to Mantis.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+import numpy
+from django.utils import timezone
+
+from npsat_backend import settings
+from npsat_manager import command_builder, mantis_protocol, models
+from npsat_manager.support import timing
+
+log = logging.getLogger("npsat.response_basis")
+
+# ResponseBasis id -> (file name, memory mapped array), least recently used first. Holds at most
+# settings.RESPONSE_BASIS_LOADED_LIMIT, so files that aren't used any more get unmapped - on Windows a mapped file
+# can't be replaced or removed
+_loaded_arrays = collections.OrderedDict()
+_loaded_arrays_lock = threading.Lock()  # dispatcher workers are threads
+
+
+def load_array(basis):
+	"""
+	:param basis: models.ResponseBasis
+	:return: (crops + 1, wells, years) array - base curves first, then one response per crop in basis.crop_codes
+	"""
+	with _loaded_arrays_lock:
+		loaded = _loaded_arrays.pop(basis.id, None)
+		if loaded is None or loaded[0] != basis.file_name:  # not loaded, or recomputed into a new file since
+			array = numpy.load(os.path.join(settings.RESPONSE_BASIS_FOLDER, basis.file_name), mmap_mode="r")
+			loaded = (basis.file_name, array)
+		_loaded_arrays[basis.id] = loaded
+		while len(_loaded_arrays) > settings.RESPONSE_BASIS_LOADED_LIMIT:
+			_loaded_arrays.popitem(last=False)
+	return loaded[1]
+
+
+def reductions(crop_codes, modifications, all_crop_codes):
+	"""
+		Gets how much each crop's loading is reduced (1 - weight) for a set of modifications
+	:param crop_codes: caml codes to return reductions for, in order
+	:param modifications: iterable of (caml_code, proportion) pairs
+	:param all_crop_codes: caml codes of every crop - see mantis_protocol.crop_weights
+	:return: 1D numpy array of reductions matching crop_codes
+	"""
+	weights = dict(mantis_protocol.crop_weights(modifications, all_crop_codes))
+	return numpy.array([1 - float(weights.get(caml_code, 1)) for caml_code in crop_codes], dtype=numpy.float64)
+
+
+def apply(array, crop_reductions):
+	"""
+	:param array: array from load_array
+	:param crop_reductions: reductions for each crop, from reductions
+	:return: 2D array of (wells, years) results
+	"""
+	return array[0] - numpy.tensordot(crop_reductions, array[1:], axes=1)
+
+
+def is_linear(model_run):
+	"""
+		Checks whether a run only uses options that the response basis can represent. The unsaturated zone travel
+		time changes how loading is routed rather than scaling it, so it always needs the full model.
+	"""
+	return model_run.unsaturated_zone_travel_time is None
+
+
+def find_bases(model_run, region_ids):
+	"""
+	:param region_ids: ids of the run's regions
+	:return: a ResponseBasis for each region, in the same order, or None if any region doesn't have one that
+			matches the run's parameters
+	"""
+	bases = models.ResponseBasis.objects.filter(
+		region_id__in=region_ids,
+		flow_scenario_id=model_run.flow_scenario_id,
+		load_scenario_id=model_run.load_scenario_id,
+		unsat_scenario_id=model_run.unsat_scenario_id,
+		n_years=model_run.n_years,
+		reduction_start_year=model_run.reduction_start_year,
+		reduction_end_year=model_run.reduction_end_year,
+		water_content=model_run.water_content,
+	)
+	bases_by_region = {basis.region_id: basis for basis in bases}
+	if any(region_id not in bases_by_region for region_id in region_ids):
+		return None
+	return [bases_by_region[region_id] for region_id in region_ids]
+
+
+def run_from_basis(model_run, timer=None, attempt=None):
+	"""
+		Tries to answer a run from precomputed responses. Stores the results and completes the run when it can.
+	:param model_run: ModelRun to process
+	:param timer: optional support.timing.StageTimer - the lookups are timed as the command build and the matrix
+				math as the compute
+	:param attempt: RunAttempt processing the run, if any - see models.save_percentiles
+	:return: True if the run was completed from the basis, False if it needs to go to Mantis
+	"""
+	if not settings.RESPONSE_BASIS_ENABLED or not is_linear(model_run):
+		return False
+
+	timer = timer or timing.StageTimer()
+	with timer.stage("command_build"):
+		inputs = command_builder.run_inputs(model_run)
+		if inputs is None:
+			return False
+		bases = find_bases(model_run, inputs.region_ids)
+		if bases is None:
+			return False
+
+	with timer.stage("mantis_compute"):
+		results = numpy.concatenate([
+			apply(load_array(basis), reductions(basis.crop_codes, inputs.modifications, inputs.crop_codes)) for basis in bases
+		])
+
+	models.save_results(results, model_run, timer=timer, attempt=attempt)
+	model_run.status = models.ModelRun.COMPLETED
+	model_run.status_message = "Computed from precomputed responses"
+	model_run.date_completed = timezone.now()
+	model_run.save(update_fields=['status', 'status_message', 'date_completed'])
+	log.info("Completed run {} from response basis".format(model_run.id))
+	return True
+
+
+def precompute(base_run, regions, server):
+	"""
+		Runs Mantis for the base curves and each crop's response for every region, and stores them as ResponseBasis
+		records. Each region takes one Mantis run per crop plus one, so this is meant for batch jobs.
+	:param base_run: ModelRun providing the scenarios, years and water content. Its modifications are ignored -
+					the base curves are always for unreduced loading
+	:param regions: iterable of Region objects
+	:param server: MantisServer to run on
+	:return: list of the ResponseBasis records created or updated
+	"""
+	os.makedirs(settings.RESPONSE_BASIS_FOLDER, exist_ok=True)
+	crop_codes = sorted(set(models.Crop.objects.exclude(caml_code=None).values_list('caml_code', flat=True)))
+
+	saved = []
+	for region in regions:
+		curves = []
+		for removed_crop in [None] + crop_codes:
+			weights = [(caml_code, 0 if caml_code == removed_crop else 1) for caml_code in crop_codes]
+			command = mantis_protocol.build_command(base_run, region.region_type, [region.mantis_id], weights)
+			curves.append(mantis_protocol.parse_response(server.run_command(command), base_run.n_years))
+
+		base = curves[0]
+		if any(curve.shape != base.shape for curve in curves):
+			raise mantis_protocol.MantisError("Mantis returned a different number of wells across runs for region {}".format(region.name))
+		array = numpy.stack([base] + [base - curve for curve in curves[1:]])
+
+		file_name = "{}_{}.npy".format(region.id, timezone.now().strftime("%Y%m%d%H%M%S"))
+		numpy.save(os.path.join(settings.RESPONSE_BASIS_FOLDER, file_name), array)
+
+		basis, created = models.ResponseBasis.objects.update_or_create(
+			region=region,
+			flow_scenario=base_run.flow_scenario,
+			load_scenario=base_run.load_scenario,
+			unsat_scenario=base_run.unsat_scenario,
+			n_years=base_run.n_years,
+			reduction_start_year=base_run.reduction_start_year,
+			reduction_end_year=base_run.reduction_end_year,
+			water_content=base_run.water_content,
+			defaults={
+				"n_wells": base.shape[0],
+				"crop_codes": crop_codes,
+				"file_name": file_name,
+				"date_computed": timezone.now(),
+			}
+		)
+		saved.append(basis)
+		log.info("Computed response basis for {} ({} wells, {} crops)".format(region.name, base.shape[0], len(crop_codes)))
+
+	return saved
@@ -0,0 +1,92 @@
+"""
+	Keeps the run queue moving when dispatcher workers die or hang - see models.RunAttempt for the attempts and their
+	leases. A worker renews its attempt's lease from a Heartbeat thread while it waits on Mantis, and sweep, which the
+	dispatcher runs every settings.RUN_SWEEP_SECONDS, requeues (or dead letters) the runs whose leases ran out.
+
+	Attempts stop renewing after settings.RUN_ATTEMPT_TIMEOUT_SECONDS, so a run stuck on a Mantis server that's
+	still connected but never answers goes back in the queue for another worker. Reads from Mantis also time out
+	after settings.MANTIS_TIMEOUT_SECONDS, which frees up the stuck worker.
+"""
+
+import logging
+import threading
+import time
+
+from django.db import connection
+from django.utils import timezone
+
+from npsat_backend import settings
+from npsat_manager import models, run_status
+
+log = logging.getLogger("npsat.run_queue")
+
+
+class Heartbeat(object):
+	"""
+		Renews an attempt's lease every settings.RUN_HEARTBEAT_SECONDS from a background thread, for as long as
+		it's used as a context manager
+	"""
+
+	def __init__(self, attempt, interval=None, timeout=None):
+		"""
+		:param attempt: RunAttempt to keep leased
+		:param interval: seconds between renewals - settings.RUN_HEARTBEAT_SECONDS by default
+		:param timeout: seconds after which the lease is left to run out - settings.RUN_ATTEMPT_TIMEOUT_SECONDS by default
+		"""
+		self.attempt = attempt
+		self.interval = settings.RUN_HEARTBEAT_SECONDS if interval is None else interval
+		self.timeout = settings.RUN_ATTEMPT_TIMEOUT_SECONDS if timeout is None else timeout
+		self.lost = False  # set once a renewal found the attempt had been expired
+		self._stop = threading.Event()
+		self._thread = None
+
+	def __enter__(self):
+		self._thread = threading.Thread(target=self._run, daemon=True, name="heartbeat-{}".format(self.attempt.id))
+		self._thread.start()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._stop.set()
+		self._thread.join()
+
+	def _run(self):
+		started = time.monotonic()
+		try:
+			while not self._stop.wait(self.interval):
+				if time.monotonic() - started > self.timeout:
+					log.warning("Attempt {} at run {} passed its {} second timeout - letting its lease run out".format(
+						self.attempt.number, self.attempt.model_run_id, self.timeout))
+					return
+				try:
+					if not self.attempt.renew():
+						self.lost = True
+						log.warning("Attempt {} at run {} lost its lease".format(self.attempt.number, self.attempt.model_run_id))
+						return
+				except Exception:  # the database may be back by the next beat - the lease has some slack
+					log.warning("Couldn't renew the lease on run {}".format(self.attempt.model_run_id), exc_info=True)
+		finally:
+			connection.close()  # this thread's own database connection
+
+
+def sweep():
+	"""
+		Requeues runs whose attempts' leases ran out, or marks them as errors if that was their last attempt. Safe to
+		run from every dispatcher at once
+	:return: number of runs swept
+	"""
+	expired = models.RunAttempt.objects.filter(status=models.RunAttempt.RUNNING, lease_expires__lt=timezone.now())
+	swept = 0
+	for attempt in expired:
+		log.warning("Lease on run {} (attempt {} by {}) expired".format(attempt.model_run_id, attempt.number, attempt.worker))
+		attempt.fail("Lease expired - the dispatcher processing the run stopped responding", expired=True)
+		swept += 1
+
+	# runs left running without an attempt were started by a dispatcher from before attempts were tracked
+	orphaned = list(models.ModelRun.objects.filter(status=models.ModelRun.RUNNING)
+					.exclude(attempts__status=models.RunAttempt.RUNNING).values_list('id', flat=True))
+	if len(orphaned) > 0:
+		log.warning("Requeuing runs {}, which were running without an attempt".format(orphaned))
+		models.ModelRun.objects.filter(id__in=orphaned, status=models.ModelRun.RUNNING).update(status=models.ModelRun.READY)
+		for run_id in orphaned:
+			run_status.notify(run_id)
+	return swept + len(orphaned)
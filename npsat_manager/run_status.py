@@ -0,0 +1,183 @@
+"""
+	Lets clients wait for a model run's status to change instead of polling the full model run every couple of
+	seconds - see views.model_run_status. Waiting requests hold a future in the RunStatusWatcher of their web process,
+	and one background thread per process settles them all.
+
+	The dispatcher pokes the web server whenever it changes a run's status by sending the run's id in a UDP
+	datagram to each of settings.RUN_STATUS_NOTIFY_ADDRESSES (notify). The watcher listens on
+	RUN_STATUS_LISTEN_ADDRESS, and on a poke reads the status of just that run. Only one process can listen on an
+	address, so with several web processes the others - and any of them if a datagram is lost - catch changes
+	with a single query for every run they have waiters for, every RUN_STATUS_POLL_SECONDS.
+"""
+
+import asyncio
+import logging
+import select
+import socket
+import threading
+import time
+
+from django.db import close_old_connections
+
+from npsat_backend import settings
+
+log = logging.getLogger("npsat.run_status")
+
+MAX_DATAGRAM = 1024
+
+
+def notify(run_id, addresses=None):
+	"""
+		Tells any waiting web processes that a run's status changed. Best effort - the watchers' polling catches
+		anything that doesn't arrive
+	:param run_id: id of the ModelRun that changed
+	:param addresses: (host, port) pairs to send to - settings.RUN_STATUS_NOTIFY_ADDRESSES by default
+	"""
+	addresses = settings.RUN_STATUS_NOTIFY_ADDRESSES if addresses is None else addresses
+	message = str(run_id).encode("utf-8")
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+		for address in addresses:
+			try:
+				sender.sendto(message, tuple(address))
+			except OSError as error:
+				log.debug("Couldn't notify {} of run {}: {}".format(address, run_id, error))
+
+
+def _parse_run_ids(datagram):
+	run_ids = set()
+	for value in datagram.decode("utf-8", errors="ignore").split():
+		try:
+			run_ids.add(int(value))
+		except ValueError:
+			pass
+	return run_ids
+
+
+def _settle(future, status):
+	if not future.done():
+		future.set_result(status)
+
+
+class RunStatusWatcher(object):
+
+	def __init__(self, listen_address=None, poll_seconds=2):
+		"""
+		:param listen_address: (host, port) to receive the dispatcher's pokes on, or None to only poll
+		:param poll_seconds: how often to check every run that has waiters
+		"""
+		self.poll_seconds = poll_seconds
+		self._waiters = {}  # run id: list of (loop, future, status being waited on)
+		self._lock = threading.Lock()
+		self._socket = None
+		if listen_address:
+			try:
+				self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+				self._socket.bind(tuple(listen_address))
+			except OSError as error:  # another web process has it - we'll rely on polling
+				log.info("Not listening for run status notifications on {}: {}".format(listen_address, error))
+				self._socket.close()
+				self._socket = None
+		self._thread = None
+
+	@property
+	def listening(self):
+		return self._socket is not None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, daemon=True, name="run-status-watcher")
+		self._thread.start()
+
+	def waiting_runs(self):
+		with self._lock:
+			return set(self._waiters)
+
+	async def wait(self, run_id, status, timeout):
+		"""
+			Waits for a run to have a status other than the one given
+		:param run_id: id of the ModelRun
+		:param status: status the caller last saw
+		:param timeout: seconds to wait at most
+		:return: the new status, or None if it didn't change within the timeout
+		"""
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		waiter = (loop, future, status)
+		with self._lock:
+			self._waiters.setdefault(run_id, []).append(waiter)
+		try:
+			return await asyncio.wait_for(future, timeout)
+		except asyncio.TimeoutError:
+			return None
+		finally:
+			with self._lock:
+				waiters = self._waiters.get(run_id, [])
+				if waiter in waiters:
+					waiters.remove(waiter)
+				if len(waiters) == 0:
+					self._waiters.pop(run_id, None)
+
+	def resolve(self, statuses):
+		"""
+			Settles the waiters of any run whose status is no longer the one they're waiting on
+		:param statuses: dict of run id: current status
+		"""
+		with self._lock:
+			for run_id, status in statuses.items():
+				for loop, future, waited_status in self._waiters.get(run_id, []):
+					if status != waited_status:
+						loop.call_soon_threadsafe(_settle, future, status)
+
+	def check(self, run_ids):
+		"""
+			Reads the status of the given runs and settles their waiters
+		"""
+		from npsat_manager import models  # models notifies through this module
+
+		if len(run_ids) == 0:
+			return
+		self.resolve(dict(models.ModelRun.objects.filter(id__in=run_ids).values_list('id', 'status')))
+
+	def _receive(self, timeout):
+		"""
+		:return: set of run ids poked within the timeout - empty if none were
+		"""
+		if self._socket is None:
+			time.sleep(timeout)
+			return set()
+		readable, _, _ = select.select([self._socket], [], [], timeout)
+		run_ids = set()
+		while readable:
+			run_ids |= _parse_run_ids(self._socket.recv(MAX_DATAGRAM))
+			readable, _, _ = select.select([self._socket], [], [], 0)
+		return run_ids
+
+	def _run(self):
+		last_poll = time.monotonic()
+		while True:
+			poked = self._receive(max(0, last_poll + self.poll_seconds - time.monotonic()))
+			try:
+				waiting = self.waiting_runs()
+				if time.monotonic() - last_poll >= self.poll_seconds:
+					last_poll = time.monotonic()
+					self.check(waiting)
+				else:
+					self.check(poked & waiting)
+				close_old_connections()
+			except Exception:
+				log.exception("Failed to check run statuses")
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher():
+	"""
+		The watcher for this process, started on first use
+	"""
+	global _watcher
+	with _watcher_lock:
+		if _watcher is None:
+			_watcher = RunStatusWatcher(settings.RUN_STATUS_LISTEN_ADDRESS, settings.RUN_STATUS_POLL_SECONDS)
+			_watcher.start()
+		return _watcher
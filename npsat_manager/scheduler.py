@@ -0,0 +1,124 @@
+"""
+	Chooses which waiting runs the dispatcher takes next, sharing Mantis fairly between users instead of first come,
+	first served - otherwise one user who submits a few hundred runs from a script holds up everyone else for hours.
+
+	Each waiting run gets a tag, and runs go in order of their tags. A user's runs are tagged one after another,
+	each one 1 / weight after the one before, starting from how much Mantis time the user has had lately - their runs
+	running now plus the attempts they started in the last settings.SCHEDULER_USAGE_WINDOW_SECONDS. Users take turns,
+	so a user with one run waiting is next in line however many runs someone else has queued. Their run starts as
+	soon as a worker is free - within one run's time. Staff have settings.SCHEDULER_STAFF_WEIGHT times the weight of
+	other users, and base runs, which every user's results are compared against, settings.SCHEDULER_BASE_WEIGHT times.
+
+	Waiting also counts in a run's favor - one run's worth every settings.SCHEDULER_AGING_SECONDS - so no run waits
+	forever behind higher weights. Users with settings.SCHEDULER_MAX_RUNNING_PER_USER runs in flight are skipped
+	until one finishes. The cap is checked when runs are ordered, so workers claiming at the same moment can go over
+	it by a run or so.
+
+	Mantis servers load a flow/load/unsat scenario combination to run it, and switching to another combination
+	takes a while, so workers also route by scenario (prefer_warm). Within the first
+	settings.SCHEDULER_AFFINITY_WINDOW runs of the fair order, a worker takes runs for the scenarios its server has
+	loaded first, then ones it used recently, so runs with the same scenarios batch up on a server. It leaves runs
+	whose scenarios another server with free capacity has loaded for that server, unless there's nothing else for it
+	to do. The window bounds how far affinity can push a run ahead of its fair turn.
+"""
+
+import collections
+import datetime
+
+from django.db.models import Count
+from django.utils import timezone
+
+from npsat_backend import settings
+from npsat_manager import models
+
+Candidate = collections.namedtuple("Candidate", ("run_id", "user_id", "is_staff", "is_base", "date_submitted", "scenarios"),
+									defaults=(None,))  # scenarios is the (flow, load, unsat) scenario ids
+
+
+def order_runs(candidates, usage, running, now=None):
+	"""
+		Orders waiting runs by weighted fair share
+	:param candidates: iterable of Candidate for the runs that are waiting
+	:param usage: dict of user id: attempts started within the usage window that have finished
+	:param running: dict of user id: runs in flight now
+	:param now: datetime to measure waiting time from - the current time by default
+	:return: list of run ids, next run first. Runs of users at their cap on running runs are left out
+	"""
+	now = now or timezone.now()
+	by_user = collections.defaultdict(list)
+	for candidate in candidates:
+		if running.get(candidate.user_id, 0) < settings.SCHEDULER_MAX_RUNNING_PER_USER:
+			by_user[candidate.user_id].append(candidate)
+
+	tagged = []
+	for user_id, user_runs in by_user.items():
+		user_runs.sort(key=lambda candidate: (not candidate.is_base, candidate.date_submitted or now, candidate.run_id))
+		user_weight = settings.SCHEDULER_STAFF_WEIGHT if user_runs[0].is_staff else 1
+		tag = (usage.get(user_id, 0) + running.get(user_id, 0)) / user_weight
+		for candidate in user_runs:
+			tag += 1 / (user_weight * (settings.SCHEDULER_BASE_WEIGHT if candidate.is_base else 1))
+			waited = (now - candidate.date_submitted).total_seconds() if candidate.date_submitted else 0
+			tagged.append((tag - waited / settings.SCHEDULER_AGING_SECONDS, candidate.date_submitted or now, candidate.run_id))
+
+	tagged.sort()
+	return [run_id for tag, date_submitted, run_id in tagged]
+
+
+def prefer_warm(run_ids, scenarios, warm, loaded_elsewhere, window):
+	"""
+		Reorders the start of the fair order for one server, by which scenarios it and the other servers have loaded
+	:param run_ids: run ids in fair order
+	:param scenarios: dict of run id: (flow, load, unsat) scenario ids
+	:param warm: scenario tuples the server used recently, the one it has loaded now first
+	:param loaded_elsewhere: set of scenario tuples other servers with free capacity have loaded
+	:param window: number of runs at the start of the order that can be reordered
+	:return: list of run ids
+	"""
+	def rank(item):
+		position, run_id = item
+		run_scenarios = scenarios[run_id]
+		if run_scenarios in warm:
+			return 0, warm.index(run_scenarios), position
+		if run_scenarios in loaded_elsewhere:
+			return 2, 0, position
+		return 1, 0, position
+
+	head = sorted(enumerate(run_ids[:window]), key=rank)
+	return [run_id for position, run_id in head] + run_ids[window:]
+
+
+def user_counts(queryset, user_field):
+	return dict(queryset.values_list(user_field).annotate(Count('id')).order_by())
+
+
+def next_runs(waiting, limit, mantis_server=None):
+	"""
+	:param waiting: queryset of the ModelRuns that can be run now
+	:param limit: number of runs to return
+	:param mantis_server: MantisServer the runs are for, to route runs by the scenarios servers have loaded
+	:return: list of up to limit run ids, in the order they should be run
+	"""
+	candidates = [Candidate(*values[:5], scenarios=tuple(values[5:])) for values in
+				  waiting.values_list('id', 'user_id', 'user__is_staff', 'is_base', 'date_submitted',
+									  'flow_scenario_id', 'load_scenario_id', 'unsat_scenario_id')]
+	if len(candidates) == 0:
+		return []
+	since = timezone.now() - datetime.timedelta(seconds=settings.SCHEDULER_USAGE_WINDOW_SECONDS)
+	usage = user_counts(models.RunAttempt.objects.filter(date_started__gte=since).exclude(status=models.RunAttempt.RUNNING),
+					'model_run__user')
+	running = user_counts(models.ModelRun.objects.filter(status=models.ModelRun.RUNNING), 'user')
+	run_ids = order_runs(candidates, usage, running)
+	if mantis_server is None:
+		return run_ids[:limit]
+
+	in_flight = user_counts(models.RunAttempt.objects.filter(status=models.RunAttempt.RUNNING), 'server')
+	warm = []
+	loaded_elsewhere = set()
+	for server_id, capacity, recent_scenarios in models.MantisServer.objects.filter(online=True).values_list('id', 'capacity', 'recent_scenarios'):
+		recent_scenarios = [tuple(scenarios) for scenarios in recent_scenarios]
+		if server_id == mantis_server.id:
+			warm = recent_scenarios
+		elif len(recent_scenarios) > 0 and in_flight.get(server_id, 0) < capacity:
+			loaded_elsewhere.add(recent_scenarios[0])
+	scenarios = {candidate.run_id: candidate.scenarios for candidate in candidates}
+	return prefer_warm(run_ids, scenarios, warm, loaded_elsewhere, settings.SCHEDULER_AFFINITY_WINDOW)[:limit]
@@ -1,8 +1,10 @@
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import transaction
 
 from rest_framework import serializers
 
-from npsat_manager import models
+from npsat_backend import settings
+from npsat_manager import downsampling, models, sweeps
 
 
 class CropSerializer(serializers.ModelSerializer):
@@ -55,6 +57,15 @@ class NestedRegionSerializer(serializers.ModelSerializer):  # for use when neste
 		}
 
 
+class RegionOverlapSerializer(serializers.ModelSerializer):
+	other_region_name = serializers.CharField(source='other_region.name', read_only=True)
+	other_region_type = serializers.CharField(source='other_region.region_type', read_only=True)
+
+	class Meta:
+		model = models.RegionOverlap
+		fields = ('region', 'other_region', 'other_region_name', 'other_region_type', 'fraction')
+
+
 class ScenarioSerializer(serializers.ModelSerializer):
 	class Meta:
 		model = models.Scenario
@@ -104,15 +115,28 @@ class NestedModificationSerializer(serializers.ModelSerializer):
 	class Meta:
 		model = models.Modification
 		fields = ('id', 'crop', 'proportion')
+		extra_kwargs = {'proportion': {'min_value': 0, 'max_value': 1}}
 
 
 class ResultPercentileSerializer(serializers.ModelSerializer):
+	"""
+		When the context has a "downsample" of (method, points) - see views.downsample_param - values is downsampled
+		and years lists the index of the year each value is from
+	"""
 	values = serializers.JSONField(read_only=True, binary=False)
 
 	class Meta:
 		model = models.ResultPercentile
 		fields = ('id', 'values', 'percentile')
 
+	def to_representation(self, instance):
+		data = super().to_representation(instance)
+		downsample = self.context.get("downsample", None)
+		if downsample is not None:
+			method, points = downsample
+			data['years'], data['values'] = downsampling.cached_downsample(instance, points, method)
+		return data
+
 
 class NestedResultPercentileSerializer(serializers.ModelSerializer):
 
@@ -121,6 +145,12 @@ class NestedResultPercentileSerializer(serializers.ModelSerializer):
 		fields = ('id', 'percentile')
 
 
+class RunTimingSerializer(serializers.ModelSerializer):
+	class Meta:
+		model = models.RunTiming
+		fields = models.RunTiming.STAGES + ('total', 'date_recorded')
+
+
 class CompletedRunResultWithValuesSerializer(serializers.ModelSerializer):
 	def __init__(self, **kwargs):
 		self.percentiles = kwargs.pop("percentiles")
@@ -130,7 +160,7 @@ class CompletedRunResultWithValuesSerializer(serializers.ModelSerializer):
 
 	def get_results(self, model_run):
 		query_set = models.ResultPercentile.objects.filter(model=model_run, percentile__in=self.percentiles)
-		return ResultPercentileSerializer(instance=query_set, many=True).data
+		return ResultPercentileSerializer(instance=query_set, many=True, context=self.context).data
 
 	class Meta:
 		model = models.ModelRun
@@ -140,38 +170,70 @@ class CompletedRunResultWithValuesSerializer(serializers.ModelSerializer):
 
 
 class RunResultSerializer(serializers.ModelSerializer):
+	SCENARIO_TYPES = {'flow_scenario': models.Scenario.TYPE_FLOW, 'load_scenario': models.Scenario.TYPE_LOAD,
+					  'unsat_scenario': models.Scenario.TYPE_UNSAT}
+
 	modifications = NestedModificationSerializer(many=True, allow_null=True, partial=True)
 	regions = NestedRegionSerializer(many=True, allow_null=True, partial=True, read_only=False)
-	scenario = ScenarioSerializer(many=False, read_only=False, allow_null=True)
+	flow_scenario = ScenarioSerializer(many=False, read_only=False)
+	load_scenario = ScenarioSerializer(many=False, read_only=False)
+	unsat_scenario = ScenarioSerializer(many=False, read_only=False)
 	results = NestedResultPercentileSerializer(many=True, read_only=True)
+	timing = RunTimingSerializer(read_only=True, allow_null=True)
 
 	class Meta:
 		model = models.ModelRun
 		fields = ('id', 'user', 'name', 'description', 'regions', 'modifications', 'unsaturated_zone_travel_time',
 		          'date_submitted', 'date_completed', 'status', 'status_message', 'n_years', 'water_content',
-				  'reduction_start_year', 'reduction_end_year', 'scenario', 'results', 'n_wells', 'public', 'is_base')
+				  'reduction_start_year', 'reduction_end_year', 'flow_scenario', 'load_scenario', 'unsat_scenario',
+				  'results', 'n_wells', 'public', 'is_base', 'timing')
+		read_only_fields = ('user',)  # runs are always submitted as the requesting user - see ModelRunViewSet
 		depth = 0  # should mean that modifications get included in the initial request
 
 	def validate(self, data):
+		"""
+			Looks up the scenarios, crops and regions by id - one query each, however many regions the run has
+		"""
+		if self.instance is not None:  # updates only change 'public'
+			return data
+
+		scenario_ids = {field: (data[field] or {}).get('id') for field in self.SCENARIO_TYPES}
+		scenarios = models.Scenario.objects.in_bulk([scenario_id for scenario_id in scenario_ids.values() if scenario_id is not None])
+		for field, scenario_id in scenario_ids.items():
+			scenario = scenarios.get(scenario_id)
+			if scenario is None or str(scenario.scenario_type) != str(self.SCENARIO_TYPES[field]):  # a CharField, holding the number
+				raise serializers.ValidationError({field: "Not a {} scenario".format(field.split("_")[0])})
+			data[field] = scenario
+
+		modifications = [(modification["crop"].get("id"), modification["proportion"]) for modification in data.get('modifications') or []]
+		crop_ids = set(crop_id for crop_id, proportion in modifications)
+		if len(crop_ids) != len(modifications):  # or the bulk insert in create() breaks Modification's unique_together
+			raise serializers.ValidationError({'modifications': "Each crop can only be modified once"})
+		missing_crops = crop_ids - set(models.Crop.objects.filter(id__in=crop_ids).values_list('id', flat=True))
+		if missing_crops:
+			raise serializers.ValidationError({'modifications': "Unknown crops: {}".format(sorted(missing_crops, key=str))})
+		data['modifications'] = modifications
+
+		region_ids = list(dict.fromkeys(region.get('id') for region in data.get('regions') or []))
+		missing_regions = set(region_ids) - set(models.Region.objects.filter(id__in=region_ids).values_list('id', flat=True))
+		if missing_regions:
+			raise serializers.ValidationError({'regions': "Unknown regions: {}".format(sorted(missing_regions, key=str))})
+		data['regions'] = region_ids
 		return data
 
 	def create(self, validated_data):
-		regions_data = validated_data.pop('regions')
-		modifications_data = validated_data.pop('modifications')
-		scenario = validated_data.pop('scenario')
-
-		model_run = models.ModelRun.objects.create(**validated_data, scenario=models.Scenario.objects.get(id=scenario['id']))
-		for modification in modifications_data:
-			proportion = modification["proportion"]
-			crop_id = modification["crop"]["id"]
-			models.Modification.objects.create(model_run=model_run, proportion=proportion, crop_id=crop_id)
-
-		for region in regions_data:
-			model_run.regions.add(models.Region.objects.get(id=region['id']))
-
-		# model is ready to run
-		model_run.status = models.ModelRun.READY
-		model_run.save()
+		modifications = validated_data.pop('modifications')
+		region_ids = validated_data.pop('regions')
+
+		# all in one transaction, so the dispatcher never sees a ready run without its modifications or regions
+		with transaction.atomic():
+			model_run = models.ModelRun.objects.create(**validated_data, status=models.ModelRun.READY)
+			models.Modification.objects.bulk_create([
+				models.Modification(model_run=model_run, crop_id=crop_id, proportion=proportion)
+				for crop_id, proportion in modifications
+			])
+			region_link = models.ModelRun.regions.through
+			region_link.objects.bulk_create([region_link(modelrun_id=model_run.id, region_id=region_id) for region_id in region_ids])
 
 		return model_run
 
@@ -183,3 +245,81 @@ class RunResultSerializer(serializers.ModelSerializer):
 		instance.save()
 		return instance
 
+
+
+class SweepModificationSerializer(serializers.Serializer):
+	crop = serializers.IntegerField()
+	proportion = serializers.DecimalField(max_digits=5, decimal_places=4, min_value=0, max_value=1)
+
+
+class SweepAxisSerializer(serializers.Serializer):
+	crop = serializers.IntegerField()
+	values = serializers.ListField(child=serializers.DecimalField(max_digits=5, decimal_places=4, min_value=0, max_value=1), min_length=1)
+
+
+class SweepBaseSerializer(serializers.ModelSerializer):
+	"""
+		What every run of a sweep shares. Regions and crops are given as ids and checked with one query each in
+		RunSweepSerializer, rather than one query per item
+	"""
+	regions = serializers.ListField(child=serializers.IntegerField(), min_length=1)
+	modifications = SweepModificationSerializer(many=True, required=False)
+
+	class Meta:
+		model = models.ModelRun
+		fields = sweeps.RUN_FIELDS + ('regions', 'modifications')
+
+
+class RunSweepSerializer(serializers.ModelSerializer):
+	base = SweepBaseSerializer(write_only=True)
+	axes = SweepAxisSerializer(many=True, allow_empty=False)
+	runs = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+	progress = serializers.SerializerMethodField()
+
+	class Meta:
+		model = models.RunSweep
+		fields = ('id', 'user', 'name', 'description', 'date_submitted', 'base', 'axes', 'runs', 'progress')
+		read_only_fields = ('user', 'date_submitted')
+
+	def get_progress(self, sweep):
+		if hasattr(sweep, "runs_completed"):  # annotated by the viewset
+			counts = {name: getattr(sweep, "runs_" + name) for name in models.ModelRun.STATUS_NAMES.values()}
+		else:
+			counts = sweep.progress()
+		counts["total"] = sum(counts.values())
+		counts["finished"] = counts["completed"] + counts["error"] == counts["total"]
+		return counts
+
+	def validate(self, data):
+		axes = [(axis["crop"], axis["values"]) for axis in data["axes"]]
+		crop_ids = [crop_id for crop_id, values in axes]
+		if len(set(crop_ids)) != len(crop_ids):
+			raise serializers.ValidationError("Each crop can only be swept on one axis")
+
+		base = data["base"]
+		base_modifications = [(modification["crop"], modification["proportion"]) for modification in base.pop("modifications", [])]
+		modifications = dict(base_modifications)
+		if len(modifications) != len(base_modifications):
+			raise serializers.ValidationError({"base": {"modifications": "Each crop can only be modified once"}})
+		crop_names = dict(models.Crop.objects.filter(id__in=set(crop_ids) | set(modifications)).values_list('id', 'name'))
+		missing_crops = (set(crop_ids) | set(modifications)) - set(crop_names)
+		if missing_crops:
+			raise serializers.ValidationError("Unknown crops: {}".format(sorted(missing_crops)))
+
+		regions = list(dict.fromkeys(base.pop("regions")))
+		missing_regions = set(regions) - set(models.Region.objects.filter(id__in=regions).values_list('id', flat=True))
+		if missing_regions:
+			raise serializers.ValidationError("Unknown regions: {}".format(sorted(missing_regions)))
+
+		data["points"] = sweeps.points(axes)
+		if len(data["points"]) > settings.RUN_SWEEP_MAX_RUNS:
+			raise serializers.ValidationError("A sweep can have at most {} runs - this one has {}".format(
+				settings.RUN_SWEEP_MAX_RUNS, len(data["points"])))
+		data.update(axes=axes, regions=regions, modifications=modifications, crop_names=crop_names)
+		return data
+
+	def create(self, validated_data):
+		return sweeps.create(user=validated_data["user"], name=validated_data["name"], base=validated_data["base"],
+							 regions=validated_data["regions"], modifications=validated_data["modifications"],
+							 axes=validated_data["axes"], crop_names=validated_data["crop_names"],
+							 description=validated_data.get("description"))
@@ -1,32 +1,81 @@
+"""
+	Optional dependencies. arcpy and GDAL are slow to import (arcpy especially) and only the model code needs them, so
+	they're imported the first time something asks - either through one of the functions below or by reading the
+	ARCPY, GDAL, NUMBA or PY_MANTIS flags, which are worked out on first access.
+"""
+
+import functools
 import logging
 
 import numpy
 
 log = logging.getLogger("npsat.support.compatibility")
 
-ARCPY = False
-GDAL = False
-PY_MANTIS = False  # flag on whether we can run Mantis
-try:
-	import arcpy
-	ARCPY = True
-except ImportError:
-	pass
 
-try:
-	from osgeo import gdal
-	GDAL = True
-except ImportError:
-	pass
+@functools.lru_cache(maxsize=None)
+def _arcpy():
+	try:
+		import arcpy
+		return arcpy
+	except ImportError:
+		return None
+
+
+@functools.lru_cache(maxsize=None)
+def _gdal():
+	try:
+		from osgeo import gdal
+		return gdal
+	except ImportError:
+		return None
+
+
+@functools.lru_cache(maxsize=None)
+def _numba():
+	try:
+		import numba
+		return numba
+	except ImportError:
+		return None
+
+
+@functools.lru_cache(maxsize=None)
+def _pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+		return pyarrow
+	except ImportError:
+		return None
+
 
-if not ARCPY and not GDAL:
-	PY_MANTIS = False
-	log.warning("Both arcpy and GDAL are missing - won't be able to run Mantis via Python - make sure at least one is available for processing")
-else:
-	PY_MANTIS = True
+@functools.lru_cache(maxsize=None)
+def _py_mantis():
+	"""
+		Whether we can run Mantis in Python - warns once if we can't
+	"""
+	if _arcpy() is None and _gdal() is None:
+		log.warning("Both arcpy and GDAL are missing - won't be able to run Mantis via Python - make sure at least one is available for processing")
+		return False
+	return True
+
+
+_FLAGS = {
+	"ARCPY": lambda: _arcpy() is not None,
+	"GDAL": lambda: _gdal() is not None,
+	"NUMBA": lambda: _numba() is not None,
+	"PYARROW": lambda: _pyarrow() is not None,  # for Parquet exports
+	"PY_MANTIS": _py_mantis,  # flag on whether we can run Mantis
+}
 
 
-def raster_to_numpy_array(raster):
+def __getattr__(name):
+	if name in _FLAGS:
+		return _FLAGS[name]()
+	raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
+def raster_to_numpy_array(raster, window=None):
 	"""
 		Provides a compatibility layer for loading rasters into numpy arrays using either arcpy or GDAL.
 
@@ -35,13 +84,98 @@ def raster_to_numpy_array(raster):
 		possible that the data types from the different methods of loading could be different. Be careful!
 
 		GDAL method via https://gis.stackexchange.com/a/33070/1955
-	:param raster: Full path to a raster on disk - reads only the first band when using GDAL
+	:param raster: Full path to a raster on disk - reads only the first band when using GDAL. A 2D numpy array is
+					also accepted and treated as an in-memory raster, which is how the benchmarks feed in synthetic data
+	:param window: optional (row_offset, col_offset, rows, cols) tuple - when provided, only that block of cells
+					is read. GDAL reads the block directly from disk, arcpy reads the whole raster and slices it.
 	:return: numpy array representing the values in the raster
 	"""
-	if ARCPY:
-		return arcpy.RasterToNumPyArray(arcpy.Raster(raster))
-	elif GDAL:
+	if isinstance(raster, numpy.ndarray):
+		if window is not None:
+			row_offset, col_offset, rows, cols = window
+			return raster[row_offset:row_offset + rows, col_offset:col_offset + cols]
+		return raster
+
+	arcpy, gdal = _arcpy(), _gdal()
+	if arcpy:
+		array = arcpy.RasterToNumPyArray(arcpy.Raster(raster))
+		if window is not None:
+			row_offset, col_offset, rows, cols = window
+			array = array[row_offset:row_offset + rows, col_offset:col_offset + cols]
+		return array
+	elif gdal:
 		raster_source = gdal.Open(raster)
+		if window is not None:
+			row_offset, col_offset, rows, cols = window
+			return numpy.array(raster_source.GetRasterBand(1).ReadAsArray(col_offset, row_offset, cols, rows))
 		return numpy.array(raster_source.GetRasterBand(1).ReadAsArray())
 	else:
-		raise RuntimeError("Both arcpy and GDAL are unavailable - can't load raster into numpy array. Please install Arcpy or GDAL with Python bindings in the current interpreter")
\ No newline at end of file
+		raise RuntimeError("Both arcpy and GDAL are unavailable - can't load raster into numpy array. Please install Arcpy or GDAL with Python bindings in the current interpreter")
+
+
+def raster_bands_to_numpy_array(raster):
+	"""
+		Like raster_to_numpy_array, but loads every band of a multiband raster (unit response functions are stored
+		with one band per year into the future)
+	:param raster: Full path to a raster on disk
+	:return: 3D numpy array of (bands, rows, cols)
+	"""
+	arcpy, gdal = _arcpy(), _gdal()
+	if arcpy:
+		array = arcpy.RasterToNumPyArray(arcpy.Raster(raster))
+	elif gdal:
+		array = numpy.array(gdal.Open(raster).ReadAsArray())
+	else:
+		raise RuntimeError("Both arcpy and GDAL are unavailable - can't load raster into numpy array. Please install Arcpy or GDAL with Python bindings in the current interpreter")
+
+	if array.ndim == 2:  # single band rasters come back without the band axis
+		array = array[None, :, :]
+	return array
+
+
+def raster_grid(raster):
+	"""
+		Gets the grid definition of a raster on disk so that other data (region polygons, for example) can be
+		placed onto the same cells.
+	:param raster: Full path to a raster on disk
+	:return: tuple of (geotransform, rows, cols, projection_wkt) where geotransform is a GDAL style six-tuple of
+			(origin_x, cell_width, 0, origin_y, 0, cell_height) - cell_height is negative for north-up rasters
+	"""
+	arcpy, gdal = _arcpy(), _gdal()
+	if arcpy:
+		arc_raster = arcpy.Raster(raster)
+		geotransform = (arc_raster.extent.XMin, arc_raster.meanCellWidth, 0,
+						arc_raster.extent.YMax, 0, -arc_raster.meanCellHeight)
+		return geotransform, arc_raster.height, arc_raster.width, arc_raster.spatialReference.exportToString()
+	elif gdal:
+		raster_source = gdal.Open(raster)
+		return raster_source.GetGeoTransform(), raster_source.RasterYSize, raster_source.RasterXSize, raster_source.GetProjection()
+	else:
+		raise RuntimeError("Both arcpy and GDAL are unavailable - can't read the raster grid. Please install Arcpy or GDAL with Python bindings in the current interpreter")
+
+
+def transform_coordinates(xs, ys, target_wkt, source_epsg=4326):
+	"""
+		Reprojects coordinate arrays (GeoJSON is lon/lat, EPSG 4326) into the coordinate system of a raster.
+		Only available with GDAL, since the osr bindings handle this cleanly.
+	:param xs: numpy array of x (longitude) values
+	:param ys: numpy array of y (latitude) values
+	:param target_wkt: WKT string of the destination coordinate system, as returned by raster_grid
+	:param source_epsg: EPSG code the coordinates are currently in
+	:return: tuple of numpy arrays (xs, ys) in the target coordinate system
+	"""
+	if _gdal() is None:
+		raise RuntimeError("GDAL is unavailable - can't reproject region geometries onto the model grid")
+
+	from osgeo import osr
+	source = osr.SpatialReference()
+	source.ImportFromEPSG(source_epsg)
+	target = osr.SpatialReference()
+	target.ImportFromWkt(target_wkt)
+	if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):  # GDAL 3 swaps to lat/lon order for EPSG:4326 otherwise
+		source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+		target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+	transformation = osr.CoordinateTransformation(source, target)
+	points = transformation.TransformPoints(list(zip(xs.tolist(), ys.tolist())))
+	points = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+	return points[:, 0], points[:, 1]
@@ -0,0 +1,83 @@
+"""
+	Small helpers for working with the GeoJSON we store in Region.geometry without pulling in a full
+	geometry library. Region.geometry holds the whole GeoJSON Feature record from load_data, so these accept
+	a Feature, a bare geometry, or a JSON string of either.
+"""
+
+import json
+
+import numpy
+
+
+def _geometry_dict(geometry):
+	if isinstance(geometry, (str, bytes)):
+		geometry = json.loads(geometry)
+	if geometry is None:
+		return None
+	if geometry.get("type") == "Feature":
+		return geometry.get("geometry")
+	return geometry
+
+
+def polygons(geometry):
+	"""
+		Gets the polygons in a GeoJSON geometry as lists of rings, where the first ring is the outer boundary
+		and any others are holes. Each ring is an (n, 2) numpy array of x, y coordinates.
+	:param geometry: GeoJSON Feature, Polygon or MultiPolygon (dict or JSON string)
+	:return: list of polygons, each a list of rings
+	"""
+	geometry = _geometry_dict(geometry)
+	if geometry is None:
+		return []
+
+	if geometry["type"] == "Polygon":
+		parts = [geometry["coordinates"]]
+	elif geometry["type"] == "MultiPolygon":
+		parts = geometry["coordinates"]
+	else:
+		raise ValueError("Unsupported geometry type {} - regions must be polygons".format(geometry["type"]))
+
+	return [[numpy.asarray(ring, dtype=numpy.float64)[:, :2] for ring in part if len(ring) > 0] for part in parts]
+
+
+def rings(geometry):
+	"""
+		Flattens all rings of all polygons in a geometry into one list - for even-odd tests, holes and
+		separate parts of a multipolygon are handled correctly by treating every ring the same way
+	:param geometry: GeoJSON Feature, Polygon or MultiPolygon (dict or JSON string)
+	:return: list of (n, 2) numpy arrays
+	"""
+	return [ring for polygon in polygons(geometry) for ring in polygon]
+
+
+def bounds(geometry):
+	"""
+	:param geometry: GeoJSON Feature, Polygon or MultiPolygon (dict or JSON string)
+	:return: (min_x, min_y, max_x, max_y) tuple, or None for an empty geometry
+	"""
+	all_rings = rings(geometry)
+	if len(all_rings) == 0:
+		return None
+	coordinates = numpy.concatenate(all_rings)
+	return (float(coordinates[:, 0].min()), float(coordinates[:, 1].min()),
+			float(coordinates[:, 0].max()), float(coordinates[:, 1].max()))
+
+
+def contains_point(geometry_rings, x, y):
+	"""
+		Even-odd point in polygon test, so holes and the parts of a multipolygon are handled the same way
+	:param geometry_rings: list of (n, 2) rings, as returned by rings
+	:param x: x coordinate of the point
+	:param y: y coordinate of the point
+	:return: True if the point is inside
+	"""
+	inside = False
+	for ring in geometry_rings:
+		xs, ys = ring[:, 0], ring[:, 1]
+		next_xs, next_ys = numpy.roll(xs, -1), numpy.roll(ys, -1)
+		straddles = (ys > y) != (next_ys > y)
+		with numpy.errstate(divide="ignore", invalid="ignore"):  # horizontal edges never straddle, so their nans don't count
+			crossing_xs = xs + (y - ys) * (next_xs - xs) / (next_ys - ys)
+		if numpy.count_nonzero(straddles & (x < crossing_xs)) % 2 == 1:
+			inside = not inside
+	return inside
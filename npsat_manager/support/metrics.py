@@ -0,0 +1,359 @@
+"""
+	A small in-process metrics registry that renders the Prometheus text exposition format, so the web app and
+	the dispatcher can be scraped without running any other service. Metrics live in the memory of the process
+	that records them - the web app serves its own at /metrics, and process_runs starts start_exporter so the
+	dispatcher can be scraped too.
+
+	Metrics are created with counter/gauge/histogram, which return the existing metric when called again with
+	the same name, so modules can declare what they record at import time:
+
+		RUNS = metrics.counter("npsat_runs_total", "Runs processed", labels=("status",))
+		RUNS.labels(status="completed").inc()
+
+	Recording is a dict lookup and an addition under a lock, so it's cheap enough to leave on everywhere.
+
+	Under the multi-process server (npsat_backend/server.py) every worker has its own registry, so each one writes a
+	snapshot of it to MULTIPROCESS_FOLDER every few seconds and /metrics renders all of them merged (see render).
+	Counters and histograms are summed across workers, and gauges get a pid label. When a worker exits, the server
+	folds its counters and histograms into an archive file with mark_process_dead, so totals don't go backwards
+	when workers are reloaded or replaced.
+"""
+
+import bisect
+import glob
+import http.server
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+log = logging.getLogger("npsat.support.metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEAD_FILE = "dead.json"  # counters and histograms of workers that have exited, in MULTIPROCESS_FOLDER
+
+MULTIPROCESS_FOLDER = None  # set in each worker of the multi-process server - see the module docstring
+
+
+def _format_value(value):
+	if value == math.inf:
+		return "+Inf"
+	if value == -math.inf:
+		return "-Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
+
+
+def _format_labels(label_names, label_values, extra=()):
+	pairs = list(zip(label_names, label_values)) + list(extra)
+	if len(pairs) == 0:
+		return ""
+	escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for name, value in pairs)
+	return "{" + ",".join('{}="{}"'.format(name, value) for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Child(object):
+	"""
+		One set of label values of a metric. Returned by Metric.labels, and what the metric records to directly
+		when it has no labels
+	"""
+
+	def __init__(self, metric):
+		self._metric = metric
+		self._lock = metric._lock
+		self.value = 0.0
+		if metric.kind == "histogram":
+			self.bucket_counts = [0] * len(metric.buckets)
+			self.count = 0
+
+	def inc(self, amount=1):
+		if self._metric.kind == "histogram":
+			self._metric._wrong_kind("inc")
+		if self._metric.kind == "counter" and amount < 0:
+			raise ValueError("Counters can only go up")
+		with self._lock:
+			self.value += amount
+
+	def dec(self, amount=1):
+		if self._metric.kind != "gauge":
+			self._metric._wrong_kind("dec")
+		self.inc(-amount)
+
+	def set(self, value):
+		if self._metric.kind != "gauge":
+			self._metric._wrong_kind("set")
+		with self._lock:
+			self.value = float(value)
+
+	def observe(self, value):
+		if self._metric.kind != "histogram":
+			self._metric._wrong_kind("observe")
+		index = bisect.bisect_left(self._metric.buckets, value)
+		with self._lock:
+			if index < len(self.bucket_counts):
+				self.bucket_counts[index] += 1
+			self.count += 1
+			self.value += value
+
+
+class Metric(object):
+
+	def __init__(self, name, documentation, kind, labels=(), buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.documentation = documentation
+		self.kind = kind
+		self.label_names = tuple(labels)
+		self.buckets = tuple(sorted(buckets))
+		self._lock = threading.Lock()
+		self._children = {}
+		if len(self.label_names) == 0:
+			self._children[()] = _Child(self)
+
+	def labels(self, **label_values):
+		key = tuple(str(label_values[name]) for name in self.label_names)
+		child = self._children.get(key)
+		if child is None:
+			with self._lock:
+				child = self._children.setdefault(key, _Child(self))
+		return child
+
+	def _unlabelled(self):
+		if len(self.label_names) > 0:
+			raise ValueError("{} has labels - call labels() first".format(self.name))
+		return self._children[()]
+
+	def _wrong_kind(self, operation):
+		raise TypeError("Can't {} a {}".format(operation, self.kind))
+
+	def inc(self, amount=1):
+		self._unlabelled().inc(amount)
+
+	def dec(self, amount=1):
+		self._unlabelled().dec(amount)
+
+	def set(self, value):
+		self._unlabelled().set(value)
+
+	def observe(self, value):
+		self._unlabelled().observe(value)
+
+	def render(self):
+		lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+		with self._lock:
+			children = sorted(self._children.items())
+			for key, child in children:
+				if self.kind != "histogram":
+					lines.append("{}{} {}".format(self.name, _format_labels(self.label_names, key), _format_value(child.value)))
+					continue
+				cumulative = 0
+				for bound, bucket_count in zip(self.buckets, child.bucket_counts):
+					cumulative += bucket_count
+					lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.label_names, key, [("le", _format_value(float(bound)))]), cumulative))
+				lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.label_names, key, [("le", "+Inf")]), child.count))
+				lines.append("{}_sum{} {}".format(self.name, _format_labels(self.label_names, key), _format_value(child.value)))
+				lines.append("{}_count{} {}".format(self.name, _format_labels(self.label_names, key), child.count))
+		return "\n".join(lines)
+
+
+class Registry(object):
+
+	def __init__(self):
+		self._metrics = {}
+		self._lock = threading.Lock()
+
+	def get_or_create(self, name, documentation, kind, labels=(), buckets=DEFAULT_BUCKETS):
+		with self._lock:
+			metric = self._metrics.get(name)
+			if metric is None:
+				metric = self._metrics[name] = Metric(name, documentation, kind, labels, buckets)
+			elif metric.kind != kind or metric.label_names != tuple(labels):
+				raise ValueError("{} is already registered as a {} with labels {}".format(name, metric.kind, metric.label_names))
+			return metric
+
+	def render(self):
+		"""
+		:return: every metric in the Prometheus text exposition format
+		"""
+		with self._lock:
+			metrics = sorted(self._metrics.items())
+		return "\n".join(metric.render() for name, metric in metrics) + "\n"
+
+	def snapshot(self):
+		"""
+		:return: JSON-able dict of every metric's definition and values - see merge_snapshots
+		"""
+		with self._lock:
+			metrics = list(self._metrics.values())
+		snapshot = {}
+		for metric in metrics:
+			with metric._lock:
+				children = [[list(key), child.value, getattr(child, "bucket_counts", None), getattr(child, "count", None)]
+							for key, child in metric._children.items()]
+			snapshot[metric.name] = {"documentation": metric.documentation, "kind": metric.kind,
+									 "labels": list(metric.label_names), "buckets": list(metric.buckets), "children": children}
+		return snapshot
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=(), registry=REGISTRY):
+	return registry.get_or_create(name, documentation, "counter", labels)
+
+
+def gauge(name, documentation, labels=(), registry=REGISTRY):
+	return registry.get_or_create(name, documentation, "gauge", labels)
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+	return registry.get_or_create(name, documentation, "histogram", labels, buckets)
+
+
+def merge_snapshots(snapshots):
+	"""
+		Adds up registry snapshots from several processes
+	:param snapshots: iterable of (pid, snapshot) pairs. Gauges can't be added up, so each process's gauges are kept
+					as their own series with a pid label - pass a pid of None for snapshots without gauges
+	:return: Registry holding the totals
+	"""
+	registry = Registry()
+	for pid, snapshot in snapshots:
+		for name, data in snapshot.items():
+			label_names = tuple(data["labels"]) + (("pid",) if data["kind"] == "gauge" else ())
+			try:
+				metric = registry.get_or_create(name, data["documentation"], data["kind"], label_names, data["buckets"])
+			except ValueError:  # redefined by new code since an older worker wrote it
+				log.warning("Skipping {} from process {} - it doesn't match the current definition".format(name, pid))
+				continue
+			for key, value, bucket_counts, count in data["children"]:
+				if data["kind"] == "gauge":
+					key = key + [pid]
+				child = metric.labels(**dict(zip(label_names, key)))
+				child.value += value
+				if data["kind"] == "histogram":
+					child.bucket_counts = [total + added for total, added in zip(child.bucket_counts, bucket_counts)]
+					child.count += count
+	return registry
+
+
+def _snapshot_path(folder, pid):
+	return os.path.join(folder, "{}.json".format(pid))
+
+
+def _write_json(path, data):
+	"""
+		Writes atomically, so readers never see a partial file
+	"""
+	temporary_path = "{}.{}.tmp".format(path, os.getpid())
+	try:
+		with open(temporary_path, "w") as output:
+			json.dump(data, output)
+		os.replace(temporary_path, path)
+	except OSError as error:  # on Windows, replacing a file another worker is reading fails - the next write will do
+		log.debug("Couldn't write {}: {}".format(path, error))
+		try:
+			os.remove(temporary_path)
+		except OSError:
+			pass
+
+
+def _read_json(path, attempts=3):
+	for attempt in range(attempts):
+		try:
+			with open(path) as input_file:
+				return json.load(input_file)
+		except FileNotFoundError:
+			return None
+		except (OSError, ValueError) as error:  # being replaced right now, on Windows
+			if attempt == attempts - 1:
+				log.warning("Couldn't read {}: {}".format(path, error))
+				return None
+			time.sleep(0.01)
+
+
+def write_snapshot(folder=None, registry=REGISTRY):
+	"""
+		Writes this process's metrics for the other workers to render - see the module docstring
+	"""
+	folder = folder or MULTIPROCESS_FOLDER
+	_write_json(_snapshot_path(folder, os.getpid()), registry.snapshot())
+
+
+def mark_process_dead(pid, folder):
+	"""
+		Folds an exited worker's counters and histograms into the archive and drops its gauges. Called by the server
+		process only, once the worker has exited, so nothing else writes the archive
+	"""
+	path = _snapshot_path(folder, pid)
+	snapshot = _read_json(path)
+	if snapshot is None:
+		return
+	dead_path = os.path.join(folder, DEAD_FILE)
+	kept = {name: data for name, data in snapshot.items() if data["kind"] != "gauge"}
+	_write_json(dead_path, merge_snapshots([(None, _read_json(dead_path) or {}), (None, kept)]).snapshot())
+	try:
+		os.remove(path)
+	except OSError as error:
+		log.warning("Couldn't remove {}: {}".format(path, error))
+
+
+def clear_folder(folder):
+	"""
+		Starts a server's metrics afresh
+	"""
+	os.makedirs(folder, exist_ok=True)
+	for path in glob.glob(os.path.join(folder, "*.json")):
+		os.remove(path)
+
+
+def render(registry=REGISTRY):
+	"""
+	:return: this process's metrics in the Prometheus text exposition format, or every worker's added up when
+			running under the multi-process server
+	"""
+	if MULTIPROCESS_FOLDER is None:
+		return registry.render()
+	write_snapshot(registry=registry)  # so this worker's own numbers are current
+	snapshots = []
+	for path in glob.glob(os.path.join(MULTIPROCESS_FOLDER, "*.json")):
+		name = os.path.splitext(os.path.basename(path))[0]
+		snapshot = _read_json(path)
+		if snapshot is not None:
+			snapshots.append((None if name + ".json" == DEAD_FILE else name, snapshot))
+	return merge_snapshots(snapshots).render()
+
+
+class _ExporterHandler(http.server.BaseHTTPRequestHandler):
+	registry = REGISTRY
+
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		body = self.registry.render().encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", CONTENT_TYPE)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):  # scrapes every few seconds would flood stderr otherwise
+		log.debug(format % args)
+
+
+def start_exporter(port, host="127.0.0.1", registry=REGISTRY):
+	"""
+		Serves /metrics over HTTP from a daemon thread - for processes that aren't the web app, like the dispatcher
+	:param port: port to listen on - 0 picks a free one
+	:return: the server - server.server_address has the port it's listening on. Call shutdown() to stop it
+	"""
+	handler = type("ExporterHandler", (_ExporterHandler,), {"registry": registry})
+	server = http.server.ThreadingHTTPServer((host, port), handler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True, name="metrics-exporter").start()
+	log.info("Serving metrics on {}:{}".format(*server.server_address[:2]))
+	return server
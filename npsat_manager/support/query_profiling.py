@@ -0,0 +1,104 @@
+"""
+	Per-request SQL profiling - see middleware.QueryProfilingMiddleware. A QueryProfiler is installed as a database
+	execute wrapper for the length of a request and records every statement. At the end of the request it's
+	summarized into a profile (query count, total SQL time, repeated statements and the slowest ones), which goes
+	into a fixed size ring buffer that staff can read from /api/query_profiles/.
+
+	Repeated statements are grouped by fingerprint - the SQL with literals and IN lists collapsed - so an N+1
+	pattern, the same query run once per object of a list, shows up as one fingerprint with a high count.
+"""
+
+import collections
+import re
+import threading
+import time
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+MAX_SQL_LENGTH = 1000  # statements longer than this are truncated in profiles
+
+
+def fingerprint(sql):
+	"""
+		Normalizes a statement so that runs of the same query with different values compare equal
+	:param sql: SQL, as passed to the database cursor
+	:return: normalized SQL
+	"""
+	sql = _STRING_LITERAL.sub("?", sql)
+	sql = _NUMBER.sub("?", sql)
+	sql = sql.replace("%s", "?")
+	sql = _PLACEHOLDER_LIST.sub("(...)", sql)
+	return _WHITESPACE.sub(" ", sql).strip()
+
+
+class QueryProfiler(object):
+	"""
+		Database execute wrapper that records each statement and how long it took
+	"""
+
+	def __init__(self):
+		self.queries = []  # (sql, seconds)
+
+	def __call__(self, execute, sql, params, many, context):
+		start_time = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.queries.append((sql, time.perf_counter() - start_time))
+
+	def summarize(self, n_slowest=5, duplicate_threshold=2):
+		"""
+		:param n_slowest: number of the slowest statements to keep
+		:param duplicate_threshold: fingerprints run at least this many times are reported as duplicates
+		:return: dict with n_queries, sql_seconds, duplicates and slowest
+		"""
+		by_fingerprint = collections.OrderedDict()
+		for sql, seconds in self.queries:
+			group = by_fingerprint.setdefault(fingerprint(sql), {"count": 0, "seconds": 0.0})
+			group["count"] += 1
+			group["seconds"] += seconds
+
+		duplicates = [{"fingerprint": key[:MAX_SQL_LENGTH], "count": group["count"], "seconds": group["seconds"]}
+					  for key, group in by_fingerprint.items() if group["count"] >= duplicate_threshold]
+		duplicates.sort(key=lambda duplicate: duplicate["count"], reverse=True)
+		slowest = sorted(self.queries, key=lambda query: query[1], reverse=True)[:n_slowest]
+
+		return {
+			"n_queries": len(self.queries),
+			"sql_seconds": sum(seconds for sql, seconds in self.queries),
+			"duplicates": duplicates,
+			"slowest": [{"sql": sql[:MAX_SQL_LENGTH], "seconds": seconds} for sql, seconds in slowest],
+		}
+
+
+class ProfileBuffer(object):
+	"""
+		Thread-safe ring buffer of the most recent request profiles. Lives in the memory of each web server process
+	"""
+
+	def __init__(self, size):
+		self._profiles = collections.deque(maxlen=size)
+		self._lock = threading.Lock()
+
+	def add(self, profile):
+		with self._lock:
+			self._profiles.append(profile)
+
+	def snapshot(self):
+		"""
+		:return: list of profiles, most recent first
+		"""
+		with self._lock:
+			return list(reversed(self._profiles))
+
+	def clear(self):
+		with self._lock:
+			self._profiles.clear()
+
+	def resize(self, size):
+		with self._lock:
+			if size != self._profiles.maxlen:
+				self._profiles = collections.deque(self._profiles, maxlen=size)
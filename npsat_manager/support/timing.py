@@ -0,0 +1,50 @@
+"""
+	Small helpers for timing the stages of a model run. A StageTimer gets passed along the run's code path,
+	each stage is wrapped in `with timer.stage(name):`, and at the end the durations are stored on the run
+	(see models.RunTiming).
+"""
+
+import contextlib
+import time
+
+
+class StageTimer(object):
+
+	def __init__(self):
+		self.durations = {}  # stage name: seconds. A stage that's entered more than once accumulates
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - start_time)
+
+	def record(self, name, seconds):
+		self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+	@property
+	def total(self):
+		return sum(self.durations.values())
+
+
+def summarize(rows, stages, percentiles=(50, 95)):
+	"""
+		Percentiles of each stage's durations for a group of runs
+	:param rows: iterable of dicts of stage name: seconds (None when a stage didn't happen for that run)
+	:param stages: stage names to summarize
+	:param percentiles: percentiles to compute, 0-100
+	:return: dict with n_runs and, for each stage, a dict of "p50": seconds, etc. - None when no run had the stage
+	"""
+	rows = list(rows)
+	summary = {"n_runs": len(rows)}
+	for stage in stages:
+		values = [row[stage] for row in rows if row.get(stage) is not None]
+		if len(values) == 0:
+			summary[stage] = None
+			continue
+		import numpy  # the web app uses this module, and only needs numpy for summaries
+		computed = numpy.percentile(values, percentiles)
+		summary[stage] = {"p{}".format(percentile): float(value) for percentile, value in zip(percentiles, computed)}
+	return summary
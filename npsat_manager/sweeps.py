@@ -0,0 +1,77 @@
+"""
+	Parameter sweeps - one request that submits a run for every combination of some crops' proportions, over the same
+	regions and scenarios. See views.RunSweepViewSet.
+
+	The runs, their modifications and their regions are each created with a single bulk insert, so a sweep costs the
+	same handful of queries whether it has 5 points or 200. Points that come out the same (an axis listing a value
+	twice) are only run once. The runs share their scenarios, so the scheduler batches them on a server that has those
+	scenarios loaded, and runs that only change crop loadings are usually answered from a response basis without
+	going to Mantis at all.
+"""
+
+import itertools
+
+from django.db import transaction
+
+from npsat_manager import models
+
+RUN_FIELDS = ("description", "n_years", "reduction_start_year", "reduction_end_year", "water_content",
+			  "unsaturated_zone_travel_time", "flow_scenario", "load_scenario", "unsat_scenario", "public")
+MAX_NAME_LENGTH = 255
+
+
+def points(axes):
+	"""
+	:param axes: list of (crop id, list of proportions)
+	:return: list of dicts of crop id: proportion, one for each distinct combination, in the order of the axes
+	"""
+	crop_ids = [crop_id for crop_id, values in axes]
+	combinations = []
+	seen = set()
+	for values in itertools.product(*[axis_values for crop_id, axis_values in axes]):
+		if values not in seen:
+			seen.add(values)
+			combinations.append(dict(zip(crop_ids, values)))
+	return combinations
+
+
+def run_name(sweep_name, point, crop_names):
+	label = ", ".join("{} {:g}%".format(crop_names.get(crop_id, crop_id), float(proportion) * 100) for crop_id, proportion in point.items())
+	return "{} ({})".format(sweep_name, label)[:MAX_NAME_LENGTH]
+
+
+def create(user, name, base, regions, modifications, axes, crop_names, description=None):
+	"""
+		Creates a sweep and all of its runs, ready to be processed
+	:param user: User submitting the sweep
+	:param name: name of the sweep - each run's name adds its proportions
+	:param base: dict of the runs' shared ModelRun field values - see RUN_FIELDS
+	:param regions: list of region ids every run is for
+	:param modifications: dict of crop id: proportion every run has, unless an axis sets that crop
+	:param axes: list of (crop id, list of proportions) to sweep over
+	:param crop_names: dict of crop id: name, for naming the runs
+	:param description: optional description of the sweep
+	:return: RunSweep
+	"""
+	sweep_points = points(axes)
+	# one transaction, so the dispatcher doesn't see any of the runs before their modifications and regions
+	with transaction.atomic():
+		sweep = models.RunSweep.objects.create(name=name, description=description, user=user,
+											   axes=[{"crop": crop_id, "values": [float(value) for value in values]} for crop_id, values in axes])
+		models.ModelRun.objects.bulk_create([
+			models.ModelRun(name=run_name(name, point, crop_names), user=user, sweep=sweep, status=models.ModelRun.READY,
+							**{field: base[field] for field in RUN_FIELDS if field in base})
+			for point in sweep_points
+		])
+		run_ids = list(sweep.runs.order_by('id').values_list('id', flat=True))  # not every database returns ids from bulk inserts
+
+		models.Modification.objects.bulk_create([
+			models.Modification(model_run_id=run_id, crop_id=crop_id, proportion=proportion)
+			for run_id, point in zip(run_ids, sweep_points)
+			for crop_id, proportion in {**modifications, **point}.items()
+		])
+		region_link = models.ModelRun.regions.through
+		region_link.objects.bulk_create([
+			region_link(modelrun_id=run_id, region_id=region_id) for run_id in run_ids for region_id in regions
+		])
+	return sweep
@@ -4,6 +4,15 @@ from npsat_manager import models
 from npsat_manager import views
 from django.contrib.auth.models import User
 
+# in-memory stand-ins for every cache in settings.CACHES, so tests don't read or write the file caches in cache/.
+# runner.LocalCacheRunner applies them to the whole test run
+LOCAL_CACHES = {
+	'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+	'reference': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-reference'},
+	'throttle': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-throttle'},
+	'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-results'},
+}
+
 # Create your tests here.
 class TestViewSet(TestCase):
 	def setUp(self) -> None:
@@ -0,0 +1,22 @@
+"""
+	Test runner for the whole suite - see settings.TEST_RUNNER. The reference, throttle and results caches are file
+	caches under cache/ so every server worker shares them, and saving a crop, region or scenario writes to the
+	reference cache, so every test runs against LOCAL_CACHES instead of the real cache folders.
+"""
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from npsat_manager.tests import LOCAL_CACHES
+
+
+class LocalCacheRunner(DiscoverRunner):
+
+	def setup_test_environment(self, **kwargs):
+		super().setup_test_environment(**kwargs)
+		self._local_caches = override_settings(CACHES=LOCAL_CACHES)
+		self._local_caches.enable()
+
+	def teardown_test_environment(self, **kwargs):
+		self._local_caches.disable()
+		super().teardown_test_environment(**kwargs)
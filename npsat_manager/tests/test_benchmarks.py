@@ -0,0 +1,70 @@
+import copy
+from types import SimpleNamespace
+
+import numpy
+from django.test import SimpleTestCase
+
+from npsat_manager import benchmarks, mantis, mantis_numba, urf_store
+
+
+class TestBenchmarks(SimpleTestCase):
+	def test_engines_build_the_same_loadings(self):
+		inputs = benchmarks.SyntheticInputs(6, 5, 30)
+		all_other_crops = SimpleNamespace(crop=SimpleNamespace(caml_code=0), proportion=0.5)
+		for modifications in (inputs.modifications, inputs.modifications + [all_other_crops]):
+			numpy_loadings = mantis.make_annual_loadings(modifications, ngw_rasters=inputs.ngw_rasters,
+														 land_use_rasters=inputs.land_use_rasters)
+			numba_loadings = mantis_numba.make_annual_loadings(modifications, ngw_rasters=inputs.ngw_rasters,
+															   land_use_rasters=inputs.land_use_rasters)
+			numpy.testing.assert_allclose(numpy_loadings.reshape(30, 30), numba_loadings)
+
+			# the synthetic years all come before settings.ChangeYear, so compare the weights on their own too
+			land_use = inputs.land_use_rasters[min(inputs.land_use_rasters)]
+			numpy.testing.assert_allclose(mantis.make_weight_raster(land_use, modifications).ravel(),
+										  mantis_numba.make_weight_raster(land_use, modifications))
+
+	def test_engines_convolve_the_same_way(self):
+		rows, cols, n_years = 3, 4, 12
+		random_state = numpy.random.default_rng(5)
+		loadings = random_state.uniform(0, 10, size=(rows, cols, n_years))
+		# lopsided URFs, peaking a few years in and tailing off, so a centered convolution would give other curves
+		urfs = numpy.zeros((n_years, rows, cols))
+		urfs[:6] = numpy.array([0.0, 0.1, 0.6, 0.2, 0.05, 0.05])[:, None, None] * random_state.uniform(0.5, 2, size=(rows, cols))
+		urfs[:, 1, 2] = 0  # a cell without wells
+
+		expected = numpy.zeros(n_years)  # loading in a year reaches that year and the ones after it
+		for row in range(rows):
+			for col in range(cols):
+				for year in range(n_years):
+					for lag in range(n_years - year):
+						expected[year + lag] += loadings[row, col, year] * urfs[lag, row, col]
+
+		store = urf_store.URFStore.from_dense(urfs, tolerance=0, dtype=numpy.float64)
+		numpy.testing.assert_allclose(mantis.convolve_and_sum(loadings.copy(), urfs.transpose(0, 2, 1)), expected)
+		numpy.testing.assert_allclose(mantis.convolve_and_sum(loadings.copy(), store), expected)
+		numpy.testing.assert_allclose(mantis_numba.convolve_and_sum(loadings.reshape(-1, n_years), urfs.reshape(n_years, -1).T), expected)
+		numpy.testing.assert_allclose(mantis_numba.convolve_and_sum(loadings.reshape(-1, n_years), store), expected)
+
+		# a region covering part of the grid - rows 1-2, columns 1-3 - read through its window
+		mask = numpy.zeros((rows, cols), dtype=bool)
+		mask[1:, 1:] = True
+		in_region = numpy.einsum("ryl,ry->l", numpy.stack([
+			numpy.convolve(loadings[row, col], urfs[:, row, col])[:n_years] for row in range(rows) for col in range(cols)
+		]).reshape(rows, cols, n_years), mask)
+		window = (1, 1, 2, 3)
+		numpy.testing.assert_allclose(mantis.convolve_and_sum(loadings[1:, 1:].copy(), store, mask=mask[1:, 1:], window=window), in_region)
+		grid_cells = numpy.flatnonzero(mask)
+		numpy.testing.assert_allclose(mantis_numba.convolve_and_sum(loadings.reshape(-1, n_years)[grid_cells], store, grid_cells=grid_cells), in_region)
+
+	def test_suite_and_regressions(self):
+		results = benchmarks.run_suite([(8, 8)], [20], engines=["numba"], repeats=1)
+		self.assertEqual([result["step"] for result in results],
+						 ["make_weight_raster", "interpolate_years", "make_annual_loadings", "convolve_and_sum"])
+		self.assertTrue(all(result["cell_years_per_second"] > 0 for result in results))
+
+		entry = benchmarks.make_entry(results)
+		self.assertEqual(benchmarks.find_regressions([], entry), [])
+		slower = copy.deepcopy(entry)
+		slower["results"][3]["best_seconds"] = entry["results"][3]["best_seconds"] * 2
+		regressions = benchmarks.find_regressions([entry], slower, threshold=0.5)
+		self.assertEqual([regression["step"] for regression in regressions], ["convolve_and_sum"])
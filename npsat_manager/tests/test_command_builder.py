@@ -0,0 +1,48 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from npsat_manager import command_builder, models
+
+
+class TestCommandBuilder(TestCase):
+	def setUp(self):
+		command_builder.CROP_CODES.invalidate()
+		command_builder.REGIONS.invalidate()
+		self.user = User.objects.create_user("builder", "builder@example.com", "builder")
+		self.scenarios = {
+			scenario_type: models.Scenario.objects.create(name="scenario_{}".format(scenario_type), scenario_type=scenario_type)
+			for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)
+		}
+		self.region = models.Region.objects.create(name="Kern", mantis_id=15, region_type="County")
+
+	def make_run(self, n_crops, first_code=1):
+		crops = [models.Crop.objects.create(name="crop {}".format(code), caml_code=code) for code in range(first_code, first_code + n_crops)]
+		model_run = models.ModelRun.objects.create(name="{} crops".format(n_crops), user=self.user,
+												   flow_scenario=self.scenarios[models.Scenario.TYPE_FLOW],
+												   load_scenario=self.scenarios[models.Scenario.TYPE_LOAD],
+												   unsat_scenario=self.scenarios[models.Scenario.TYPE_UNSAT])
+		model_run.regions.add(self.region)
+		for crop in crops:
+			models.Modification.objects.create(model_run=model_run, crop=crop, proportion=0.5)
+		return models.ModelRun.objects.select_related('flow_scenario', 'load_scenario', 'unsat_scenario')\
+										.prefetch_related('modifications').get(id=model_run.id)
+
+	def test_queries_do_not_grow_with_crops(self):
+		for n_crops, first_code in ((3, 1), (300, 100)):
+			model_run = self.make_run(n_crops, first_code)
+			command_builder.build(model_run)  # warms the caches, which the crops we just made invalidated
+			with self.assertNumQueries(1):  # just the run's regions
+				command = command_builder.build(model_run)
+			# after the run settings, area, region count and region comes the number of crops
+			self.assertEqual(command.split()[10], str(models.Crop.objects.count()))
+
+	def test_changed_crop_invalidates_cache(self):
+		model_run = self.make_run(3)
+		unused = models.Crop.objects.create(name="unused crop", caml_code=50)
+		self.assertIn(" 50 1 ", command_builder.build(model_run))
+
+		unused.delete()
+		models.Crop.objects.create(name="new crop", caml_code=77)
+		command = command_builder.build(model_run)
+		self.assertIn(" 77 1 ", command)
+		self.assertNotIn(" 50 1 ", command)
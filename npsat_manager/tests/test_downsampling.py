@@ -0,0 +1,75 @@
+import json
+import math
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from npsat_manager import downsampling, models
+
+
+class TestDownsample(TestCase):
+	def setUp(self):
+		self.values = [math.sin(year / 8.0) for year in range(200)]
+		self.values[77] = 5  # a spike both methods have to keep
+
+	def test_methods(self):
+		for method in downsampling.METHODS:
+			indices, values = downsampling.downsample(self.values, 20, method)
+			self.assertLessEqual(len(indices), 20)
+			self.assertEqual(indices, sorted(set(indices)))
+			self.assertEqual((indices[0], indices[-1]), (0, 199))
+			self.assertIn(77, indices)
+			self.assertEqual(values, [self.values[index] for index in indices])
+		self.assertEqual(len(downsampling.lttb(self.values, 20)), 20)
+
+	def test_short_series_are_whole(self):
+		for method in downsampling.METHODS:
+			self.assertEqual(downsampling.downsample([3, 1, 2], 10, method), ([0, 1, 2], [3, 1, 2]))
+
+
+class TestDownsampledResults(TestCase):
+	def setUp(self):
+		caches[downsampling.CACHE_ALIAS].clear()  # result ids are reused between tests
+		self.user = User.objects.create_user("plotter")
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+		scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+					 for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.model_run = models.ModelRun.objects.create(name="long run", user=self.user, n_years=300, status=models.ModelRun.COMPLETED,
+														 flow_scenario=scenarios[0], load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+		for percentile in (10, 50, 90):
+			models.ResultPercentile.objects.create(model=self.model_run, percentile=percentile,
+												   values=json.dumps([percentile + math.sin(year / 10.0) for year in range(300)]))
+
+	def test_results_endpoint(self):
+		results = self.client.get("/api/model_results/?points=30&downsample=minmax", format="json").json()["results"]
+		self.assertEqual(len(results), 3)
+		for result in results:
+			self.assertLessEqual(len(result["values"]), 30)
+			self.assertEqual(len(result["years"]), len(result["values"]))
+
+		whole = self.client.get("/api/model_results/", format="json").json()["results"][0]
+		self.assertEqual(len(whole["values"]), 300)
+		self.assertNotIn("years", whole)
+		self.assertEqual(self.client.get("/api/model_results/?points=2", format="json").status_code, 400)
+		self.assertEqual(self.client.get("/api/model_results/?points=30&downsample=mean", format="json").status_code, 400)
+
+	def test_dashboard_and_cache(self):
+		plot = self.client.get("/api/feed/", format="json").json()["plot_models_data"]
+		self.assertEqual(len(plot[0]["results"][0]["values"]), 300)  # every year unless the client asks for fewer
+		self.assertNotIn("years", plot[0]["results"][0])
+
+		plot = self.client.get("/api/feed/?points=50", format="json").json()["plot_models_data"]
+		series = plot[0]["results"][0]
+		self.assertEqual(len(series["values"]), 50)
+		self.assertEqual(series["years"][-1], 299)
+
+		# served from the cache afterwards, even if the stored values were edited without replacing the row
+		models.ResultPercentile.objects.filter(model=self.model_run).update(values=json.dumps([0] * 300))
+		plot = self.client.get("/api/feed/?points=50", format="json").json()["plot_models_data"]
+		self.assertEqual(plot[0]["results"][0]["values"], series["values"])
+
+		plot = self.client.get("/api/feed/?points=0", format="json").json()["plot_models_data"]
+		self.assertEqual(plot[0]["results"][0]["values"], [0] * 300)
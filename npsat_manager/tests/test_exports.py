@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+from django.contrib.auth.models import User
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from npsat_backend import settings
+from npsat_manager import command_builder, mantis_protocol, models, region_results
+from npsat_manager.support import compatibility
+
+
+class TestExports(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user("analyst")
+		other_user = User.objects.create_user("other")
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+		self.scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+						  for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.region = models.Region.objects.create(name="Tulare", region_type="County", mantis_id=1)
+		self.crop = models.Crop.objects.create(name="Corn", caml_code=606)
+
+		self.mine = self.model_run("mine", self.user, n_years=4)
+		self.public = self.model_run("public", other_user, n_years=3, public=True)
+		self.model_run("private", other_user, n_years=4)
+		self.model_run("running", self.user, n_years=4, status=models.ModelRun.RUNNING)
+
+	def model_run(self, name, user, n_years, status=models.ModelRun.COMPLETED, public=False):
+		model_run = models.ModelRun.objects.create(name=name, user=user, n_years=n_years, status=status, public=public,
+												   flow_scenario=self.scenarios[0], load_scenario=self.scenarios[1], unsat_scenario=self.scenarios[2])
+		model_run.regions.add(self.region)
+		models.Modification.objects.create(model_run=model_run, crop=self.crop, proportion=0.5)
+		for percentile in (10, 50, 90):
+			models.ResultPercentile.objects.create(model=model_run, percentile=percentile, values=json.dumps([percentile + year for year in range(n_years)]))
+		return model_run
+
+	def export(self, query):
+		response = self.client.get("/api/model_run/export/?" + query)
+		self.assertEqual(response.status_code, 200, response.content if not response.streaming else "")
+		self.assertTrue(response.streaming)
+		return response, b"".join(response.streaming_content)
+
+	def test_csv_layouts(self):
+		with mock.patch.object(settings, "EXPORT_CHUNK_ROWS", 5):
+			response, content = self.export("")
+		rows = list(csv.reader(io.StringIO(content.decode("utf-8"))))
+		self.assertEqual(rows[0], ["run_id", "run_name", "percentile", "year_index", "value"])
+		self.assertEqual(len(rows) - 1, 3 * 4 + 3 * 3)  # completed runs the user can see, a row per percentile and year
+		self.assertEqual(rows[1], [str(self.mine.id), "mine", "10", "0", "10"])
+
+		response, content = self.export("layout=wide&ids={}".format(self.public.id))
+		rows = list(csv.reader(io.StringIO(content.decode("utf-8"))))
+		self.assertEqual(rows[0], ["run_id", "run_name", "percentile", "year_0", "year_1", "year_2"])
+		self.assertEqual(rows[1:], [[str(self.public.id), "public", str(percentile)] + [str(percentile + year) for year in range(3)]
+									for percentile in (10, 50, 90)])
+
+		self.assertEqual(self.client.get("/api/model_run/export/?layout=tall").status_code, 400)
+
+	def test_wells_from_region_cache(self):
+		with tempfile.TemporaryDirectory() as folder, mock.patch.object(settings, "REGION_RESULT_CACHE_FOLDER", folder):
+			wells = numpy.arange(8, dtype=numpy.float64).reshape(2, 4)
+			inputs = command_builder.run_inputs(self.mine)
+			weights = mantis_protocol.crop_weights(inputs.modifications, inputs.crop_codes)
+			region_results.store(region_results.region_key(self.mine, "County", 1, weights), wells)
+			response, content = self.export("data=wells&layout=wide")
+
+		rows = list(csv.reader(io.StringIO(content.decode("utf-8"))))
+		self.assertEqual(rows[0], ["run_id", "run_name", "region_id", "well", "year_0", "year_1", "year_2", "year_3"])
+		self.assertEqual(rows[1:], [[str(self.mine.id), "mine", str(self.region.id), str(well)] + [str(float(value)) for value in wells[well]]
+									for well in range(2)])  # the public run's region isn't cached
+
+	@unittest.skipUnless(compatibility.PYARROW, "pyarrow isn't installed")
+	def test_parquet(self):
+		import pyarrow.parquet
+
+		with mock.patch.object(settings, "EXPORT_CHUNK_ROWS", 4):
+			response, content = self.export("type=parquet&layout=wide")
+		table = pyarrow.parquet.read_table(io.BytesIO(content))
+		self.assertEqual(table.num_rows, 6)
+		self.assertEqual(pyarrow.parquet.ParquetFile(io.BytesIO(content)).num_row_groups, 2)
+		self.assertEqual(table.column("year_3").to_pylist().count(None), 3)  # the 3 year run's percentiles
@@ -0,0 +1,86 @@
+import io
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from npsat_manager import fake_mantis, mantis_protocol, models
+from npsat_manager.management.commands import benchmark_dispatcher
+
+
+class TestFakeMantis(SimpleTestCase):
+	def test_chunked_response_parses(self):
+		server = fake_mantis.start_in_thread(fake_mantis.FakeMantisConfig(n_wells=40, chunk_size=100, seed=1))
+		try:
+			response = models.MantisServer(host=server.host, port=server.port).run_command("12 2020 2025 0 flow load unsat 1 1 0 ENDofMSG\n")
+		finally:
+			server.stop()
+		self.assertEqual(mantis_protocol.parse_response(response, 12).shape, (40, 12))
+
+	def test_error_rate(self):
+		server = fake_mantis.start_in_thread(fake_mantis.FakeMantisConfig(error_rate=1))
+		try:
+			response = models.MantisServer(host=server.host, port=server.port).run_command("12 ENDofMSG\n")
+		finally:
+			server.stop()
+		with self.assertRaises(mantis_protocol.MantisError):
+			mantis_protocol.parse_response(response, 12)
+
+
+class TestDispatcher(TestCase):
+	def test_dispatcher_completes_runs(self):
+		user = User.objects.create_user("benchmark")
+		region = models.Region.objects.create(name="Central Valley", region_type="Central Valley", mantis_id=1)
+		scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+					 for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		crop = models.Crop.objects.create(name="Corn", caml_code=606)
+		for index in range(3):
+			model_run = models.ModelRun.objects.create(name="run {}".format(index), user=user, n_years=10, status=models.ModelRun.READY,
+													   flow_scenario=scenarios[0], load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+			model_run.regions.add(region)
+			models.Modification.objects.create(model_run=model_run, crop=crop, proportion=0.5)
+
+		server = fake_mantis.start_in_thread(fake_mantis.FakeMantisConfig(n_wells=50, chunk_size=1000))
+		try:
+			dispatcher = benchmark_dispatcher.TimedDispatcher(models.MantisServer.objects.create(host=server.host, port=server.port, online=True))
+			self.assertEqual(dispatcher.process_waiting_runs(), 3)
+		finally:
+			server.stop()
+
+		self.assertEqual(models.ModelRun.objects.filter(status=models.ModelRun.COMPLETED, n_wells=50).count(), 3)
+		self.assertEqual(len(dispatcher.service_times), 3)
+
+		timing = models.RunTiming.objects.get(model_run__name="run 0")
+		for stage in ("queue_wait", "command_build", "mantis_compute", "response_transfer", "parsing", "percentiles", "db_write"):
+			self.assertIsNotNone(getattr(timing, stage), stage)
+		self.assertAlmostEqual(timing.total, sum(getattr(timing, stage) for stage in models.RunTiming.STAGES))
+
+
+class TestBenchmarkDispatcher(TransactionTestCase):
+	def setUp(self):
+		User.objects.create_superuser("benchmark", "benchmark@example.com", "benchmark")
+		models.Region.objects.create(name="Central Valley", region_type="Central Valley", mantis_id=1)
+		for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT):
+			models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+		models.Crop.objects.create(name="Corn", caml_code=606)
+
+	def test_benchmark_completes_runs(self):
+		output = io.StringIO()
+		call_command("benchmark_dispatcher", runs=6, submitters=1, years=10, wells=50, stdout=output)
+		report = json.loads(output.getvalue())
+
+		self.assertEqual(report["runs_completed"], 6)
+		self.assertEqual(report["submission_errors"], 0)
+		self.assertIsNotNone(report["queue_latency_seconds"])
+		self.assertFalse(models.ModelRun.objects.exists())  # cleaned up
+		self.assertFalse(models.MantisServer.objects.exists())
+
+	def test_failed_submissions_fail_the_benchmark(self):
+		with mock.patch.object(benchmark_dispatcher, "SUBMIT_ATTEMPTS", 1), \
+				mock.patch.object(models.Modification.objects, "create", side_effect=OperationalError("database is locked")):
+			with self.assertRaises(CommandError):
+				call_command("benchmark_dispatcher", runs=2, submitters=1, years=10, wells=50, stdout=io.StringIO())
+		self.assertFalse(models.ModelRun.objects.exists())  # the half submitted runs were rolled back
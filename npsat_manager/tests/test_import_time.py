@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+from django.test import SimpleTestCase
+
+from npsat_backend import settings
+
+# loaded only by the dispatcher and the model code - the web app should start without them
+HEAVY_MODULES = ("numpy", "numba", "osgeo", "arcpy", "arrow", "drf_yasg")
+MAX_IMPORT_SECONDS = 5  # generous - it's about 0.5 seconds on a slow VM. A regression to eager imports is what this catches
+
+IMPORT_WEB_APP = """
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "npsat_backend.settings")
+import django
+django.setup()
+import npsat_backend.urls
+import npsat_backend.wsgi
+"""
+
+
+def import_times(code):
+	"""
+		Runs code in a fresh interpreter with -X importtime
+	:return: (dict of module name: cumulative import time in seconds for every module the code imported,
+			total seconds spent importing)
+	"""
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=settings.BASE_DIR,
+							stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+	times = {}
+	total = 0
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		self_time, cumulative, name = line[len("import time:"):].split("|")
+		seconds = int(cumulative) / 1e6  # reported in microseconds
+		times[name.strip()] = seconds
+		if not name[1:].startswith(" "):  # nested imports are indented under the import that pulled them in
+			total += seconds
+	return times, total
+
+
+class TestImportTime(SimpleTestCase):
+	def test_web_app_imports_are_light(self):
+		times, total = import_times(IMPORT_WEB_APP)
+		loaded = sorted(module for module in times if module.split(".")[0] in HEAVY_MODULES)
+		self.assertEqual(loaded, [], "the web app shouldn't import these at startup")
+		self.assertLess(total, MAX_IMPORT_SECONDS)
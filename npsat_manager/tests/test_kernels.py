@@ -0,0 +1,34 @@
+import numpy
+from django.test import SimpleTestCase
+
+from npsat_manager import kernels
+
+
+class TestKernels(SimpleTestCase):
+	def test_reclassify_uses_default_weight(self):
+		land_use = numpy.array([0, 606, 2200, 606, 5], dtype=numpy.int64)
+		weights = kernels.reclassify(land_use, numpy.array([606, 2200], dtype=numpy.int64),
+									 numpy.array([0.5, 0.25]), numpy.float64(0.9))
+		numpy.testing.assert_allclose(weights, [0.9, 0.5, 0.25, 0.5, 0.9])
+
+	def test_interpolate_years(self):
+		known = numpy.array([[0.0, 15.0, 45.0]])
+		loadings = kernels.interpolate_years(known, numpy.array([1945, 1960, 1975], dtype=numpy.int64), 1945, 30)
+		self.assertEqual(loadings.shape, (1, 30))
+		numpy.testing.assert_allclose(loadings[0, [0, 5, 15, 20]], [0, 5, 15, 25])
+
+	def test_convolve_and_sum_matches_numpy(self):
+		random = numpy.random.default_rng(42)
+		loadings = random.random((7, 20))
+		urfs = random.random((7, 12))
+		expected = sum(numpy.convolve(loadings[cell], urfs[cell])[:20] for cell in range(7))
+		numpy.testing.assert_allclose(kernels.convolve_and_sum(loadings, urfs), expected)
+
+	def test_float32_sums_accumulate_in_float64(self):
+		dtype = kernels.dtype_for("float32")
+		loadings = numpy.full((1000, 10), 0.1, dtype=dtype)
+		results = kernels.convolve_and_sum(loadings, numpy.ones((1000, 1), dtype=dtype))
+		self.assertEqual(results.dtype, numpy.float64)
+		numpy.testing.assert_allclose(results, 100, rtol=1e-6)
+		with self.assertRaises(ValueError):
+			kernels.dtype_for("float16")
@@ -0,0 +1,123 @@
+import os
+import tempfile
+import urllib.request
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.db import connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from rest_framework.test import APIClient
+
+from npsat_manager import middleware, models
+from npsat_manager.support import metrics
+
+
+class TestRegistry(SimpleTestCase):
+	def test_render(self):
+		registry = metrics.Registry()
+		runs = metrics.counter("test_runs_total", "Runs", labels=("status",), registry=registry)
+		runs.labels(status="completed").inc()
+		runs.labels(status="completed").inc(2)
+		latency = metrics.histogram("test_latency_seconds", "Latency", buckets=(0.1, 1), registry=registry)
+		for value in (0.05, 0.1, 0.5, 5):
+			latency.observe(value)
+		self.assertIs(metrics.counter("test_runs_total", "Runs", labels=("status",), registry=registry), runs)
+		with self.assertRaises(ValueError):
+			runs.inc()
+
+		text = registry.render()
+		self.assertIn('test_runs_total{status="completed"} 3', text)
+		self.assertIn('test_latency_seconds_bucket{le="0.1"} 2', text)
+		self.assertIn('test_latency_seconds_bucket{le="1"} 3', text)
+		self.assertIn('test_latency_seconds_bucket{le="+Inf"} 4', text)
+		self.assertIn('test_latency_seconds_count 4', text)
+
+	def test_exporter(self):
+		registry = metrics.Registry()
+		metrics.gauge("test_up", "Up", registry=registry).set(1)
+		server = metrics.start_exporter(0, registry=registry)
+		try:
+			with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1])) as response:
+				self.assertIn("test_up 1", response.read().decode("utf-8"))
+		finally:
+			server.shutdown()
+			server.server_close()
+
+
+class TestMultiprocess(SimpleTestCase):
+	def test_workers_are_added_up(self):
+		folder = tempfile.TemporaryDirectory()
+		self.addCleanup(folder.cleanup)
+		for pid, requests in ((101, 2), (102, 3)):
+			registry = metrics.Registry()
+			metrics.counter("test_requests_total", "Requests", labels=("view",), registry=registry).labels(view="runs").inc(requests)
+			metrics.histogram("test_latency_seconds", "Latency", buckets=(1,), registry=registry).observe(0.5)
+			metrics.gauge("test_threads", "Threads", registry=registry).set(pid)
+			with mock.patch.object(os, "getpid", return_value=pid):
+				metrics.write_snapshot(folder.name, registry)
+
+		this_worker = metrics.Registry()
+		metrics.counter("test_requests_total", "Requests", labels=("view",), registry=this_worker).labels(view="runs").inc()
+		with mock.patch.object(metrics, "MULTIPROCESS_FOLDER", folder.name):
+			text = metrics.render(this_worker)
+			self.assertIn('test_requests_total{view="runs"} 6', text)
+			self.assertIn('test_latency_seconds_count 2', text)
+			self.assertIn('test_threads{pid="101"} 101', text)
+
+			metrics.mark_process_dead(101, folder.name)  # its counts stay, its gauges go
+			text = metrics.render(this_worker)
+			self.assertIn('test_requests_total{view="runs"} 6', text)
+			self.assertIn('test_latency_seconds_count 2', text)
+			self.assertNotIn('pid="101"', text)
+			self.assertIn('test_threads{pid="102"} 102', text)
+
+
+class TestMetricsMiddleware(TestCase):
+	def test_requests_recorded_per_viewset_action(self):
+		client = APIClient()
+		client.force_authenticate(User.objects.create_user("metrics"))
+		self.assertEqual(client.get("/api/crops/").status_code, 200)
+
+		text = client.get("/metrics").content.decode("utf-8")
+		self.assertIn('npsat_http_requests_total{view="CropViewSet",action="list",status="200"}', text)
+		self.assertIn('npsat_http_request_queries_count{view="CropViewSet",action="list"}', text)
+
+
+class TestQueryRecording(TransactionTestCase):
+	def test_queries_on_other_threads_are_recorded(self):
+		def count_scenarios():  # runs on a thread of its own, with its own connection
+			try:
+				return models.Scenario.objects.count()
+			finally:
+				connections.close_all()
+
+		counter = middleware.QueryCounter()
+		stop_recording = middleware.record_queries(counter)
+		try:
+			async_to_sync(sync_to_async(count_scenarios, thread_sensitive=False))()
+		finally:
+			stop_recording()
+		self.assertEqual(counter.count, 1)
+
+		models.Scenario.objects.count()
+		self.assertEqual(counter.count, 1)  # stopped
+
+	def test_streamed_queries_are_recorded(self):
+		def rows():
+			yield "header\n"
+			for scenario in models.Scenario.objects.all():  # read after the middleware has returned
+				yield scenario.name
+			yield str(models.Crop.objects.count())
+
+		queries = middleware.REQUEST_QUERIES.labels(view="unmatched", action="get")
+		before = (queries.count, queries.value)
+		response = middleware.MetricsMiddleware(lambda request: StreamingHttpResponse(rows()))(RequestFactory().get("/export"))
+		self.assertEqual((queries.count, queries.value), before)  # nothing sent yet
+
+		b"".join(response.streaming_content)
+		self.assertEqual((queries.count, queries.value), (before[0] + 1, before[1] + 2))
+
+		middleware.MetricsMiddleware(lambda request: HttpResponse("done"))(RequestFactory().get("/export"))
+		self.assertEqual((queries.count, queries.value), (before[0] + 2, before[1] + 2))
@@ -0,0 +1,74 @@
+import numpy
+from django.test import SimpleTestCase
+
+from npsat_manager import mantis_protocol, percentiles
+
+PERCENTILES = (1, 2, 5, 10, 25, 50, 75, 90, 95, 99)
+
+
+class FakeConnection(object):
+	"""
+		Hands back a response a few bytes at a time, like a slow socket
+	"""
+	def __init__(self, response, chunk_size):
+		self.data = response.encode("utf-8")
+		self.chunk_size = chunk_size
+
+	def recv(self, size):
+		chunk, self.data = self.data[:self.chunk_size], self.data[self.chunk_size:]
+		return chunk
+
+
+class OpenConnection(FakeConnection):
+	"""
+		A connection Mantis leaves open once it's sent everything - reading past the response would block
+	"""
+	def recv(self, size):
+		if len(self.data) == 0:
+			raise AssertionError("read past the end of the response")
+		return super().recv(size)
+
+
+class TestPercentiles(SimpleTestCase):
+	def test_exact_matches_numpy_nearest(self):
+		values = numpy.random.default_rng(1).normal(size=(501, 6))
+		expected = numpy.nanpercentile(values, PERCENTILES, method="nearest", axis=0)
+		numpy.testing.assert_array_equal(percentiles.exact(values, PERCENTILES), expected)
+
+		values[::3, 2] = numpy.nan
+		values[:, 4] = numpy.nan
+		result = percentiles.exact(values, PERCENTILES)
+		numpy.testing.assert_array_equal(result[:, 2], numpy.nanpercentile(values[:, 2], PERCENTILES, method="nearest"))
+		self.assertTrue(numpy.isnan(result[:, 4]).all())
+
+	def test_sketch_within_rank_error_bound(self):
+		values = numpy.random.default_rng(2).lognormal(size=(20000, 3))
+		values[::7, 1] = numpy.nan
+		sketch = percentiles.StreamingPercentiles(3, PERCENTILES, capacity=128, seed=3)
+		for start in range(0, values.shape[0], 1000):
+			sketch.add(values[start:start + 1000])
+
+		self.assertLess(sketch.nbytes, values.nbytes / 10)
+		result = sketch.result()
+		for column in range(3):
+			column_values = numpy.sort(values[~numpy.isnan(values[:, column]), column])
+			target_ranks = numpy.array(PERCENTILES) / 100.0 * (len(column_values) - 1)
+			actual_ranks = numpy.searchsorted(column_values, result[:, column])
+			allowed = sketch.rank_error_bound * len(values) + 1
+			self.assertTrue(numpy.all(numpy.abs(actual_ranks - target_ranks) <= allowed))
+
+	def test_streamed_rows_match_parsed_response(self):
+		values = numpy.arange(30, dtype=numpy.float64).reshape(10, 3) / 4
+		response = "1 10 " + " ".join(str(value) for value in values.ravel()) + " EndOfMsg\n"
+		blocks = list(mantis_protocol.iter_response_rows(FakeConnection(response, 7), 3, block_wells=4))
+		self.assertEqual([block.shape[0] for block in blocks], [4, 4, 2])
+		numpy.testing.assert_array_equal(numpy.concatenate(blocks), mantis_protocol.parse_response(response, 3))
+
+		for chunk_size in (7, len(response)):  # ending exactly on the marker, whether it arrives alone or not
+			blocks = list(mantis_protocol.iter_response_rows(OpenConnection(response.rstrip(), chunk_size), 3))
+			numpy.testing.assert_array_equal(numpy.concatenate(blocks), values)
+
+		with self.assertRaises(mantis_protocol.MantisError):
+			list(mantis_protocol.iter_response_rows(FakeConnection("1 11 " + response[5:], 7), 3))
+		with self.assertRaises(mantis_protocol.MantisError):
+			list(mantis_protocol.iter_response_rows(FakeConnection("0 Region not found EndOfMsg", 7), 3))
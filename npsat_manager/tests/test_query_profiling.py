@@ -0,0 +1,45 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from npsat_backend import settings
+from npsat_manager import middleware, models
+from npsat_manager.support import query_profiling
+
+
+class TestFingerprint(SimpleTestCase):
+	def test_values_and_in_lists_collapse(self):
+		first = query_profiling.fingerprint('SELECT * FROM "crop" WHERE "id" IN (%s, %s, %s) AND name = \'Corn\' LIMIT 21')
+		second = query_profiling.fingerprint('SELECT * FROM "crop"\n WHERE "id" IN (%s) AND name = \'Grapes\' LIMIT 5')
+		self.assertEqual(first, second)
+		self.assertEqual(first, 'SELECT * FROM "crop" WHERE "id" IN (...) AND name = ? LIMIT ?')
+
+
+class TestQueryProfilingMiddleware(TestCase):
+	def test_repeated_queries_are_reported(self):
+		admin = User.objects.create_superuser("admin", "admin@example.com", "admin")
+		for index in range(4):
+			models.ModelRun.objects.create(name="run {}".format(index), user=admin,
+										   flow_scenario=models.Scenario.objects.create(name="flow {}".format(index), scenario_type=models.Scenario.TYPE_FLOW),
+										   load_scenario=models.Scenario.objects.create(name="load {}".format(index), scenario_type=models.Scenario.TYPE_LOAD),
+										   unsat_scenario=models.Scenario.objects.create(name="unsat {}".format(index), scenario_type=models.Scenario.TYPE_UNSAT))
+		middleware.PROFILES.clear()
+
+		with mock.patch.object(settings, "QUERY_PROFILING_ENABLED", True), mock.patch.object(settings, "QUERY_PROFILING_SAMPLE_RATE", 1):
+			client = APIClient()
+			client.force_authenticate(admin)
+			self.assertEqual(client.get("/api/model_run/").status_code, 200)
+			profiles = client.get("/api/query_profiles/").json()["profiles"]
+			self.assertEqual(len(client.get("/api/query_profiles/?limit=1").json()["profiles"]), 1)
+			for limit in ("all", "-1"):
+				response = client.get("/api/query_profiles/?limit={}".format(limit))
+				self.assertEqual(response.status_code, 400, limit)
+				self.assertIn("limit", response.json())
+
+		profile = profiles[-1]  # newest first, so the model run list is last
+		self.assertEqual((profile["view"], profile["action"]), ("ModelRunViewSet", "list"))
+		self.assertGreater(profile["n_queries"], 4)
+		self.assertTrue(any(duplicate["count"] >= 4 for duplicate in profile["duplicates"]))  # nested serializers query per run
+		self.assertLessEqual(len(profile["slowest"]), settings.QUERY_PROFILING_SLOWEST)
@@ -0,0 +1,71 @@
+import numpy
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from npsat_manager import models, region_index
+
+
+def square(min_x, min_y, size, hole=None):
+	rings = [[[min_x, min_y], [min_x + size, min_y], [min_x + size, min_y + size], [min_x, min_y + size], [min_x, min_y]]]
+	if hole is not None:
+		rings.append(square(*hole)["geometry"]["coordinates"][0])
+	return {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": rings}}
+
+
+class TestRegionIndex(SimpleTestCase):
+	def setUp(self):
+		# a 40 x 40 grid of unit squares, like townships, and one big region with a hole over part of it
+		self.regions = [(row * 40 + col, square(col, row, 1)) for row in range(40) for col in range(40)]
+		self.regions.append((5000, square(10, 10, 10, hole=(12, 12, 2))))
+		self.index = region_index.RegionIndex.build(self.regions)
+
+	def brute_force(self, box):
+		matches = []
+		for region_id, geometry in self.regions:
+			coordinates = numpy.array(geometry["geometry"]["coordinates"][0])
+			if coordinates[:, 0].min() <= box[2] and coordinates[:, 0].max() >= box[0] and \
+					coordinates[:, 1].min() <= box[3] and coordinates[:, 1].max() >= box[1]:
+				matches.append(region_id)
+		return sorted(matches)
+
+	def test_matches_brute_force(self):
+		self.assertGreater(len(self.index.levels), 2)
+		random = numpy.random.default_rng(0)
+		for _ in range(50):
+			corner = random.uniform(-5, 45, size=2)
+			box = (corner[0], corner[1], corner[0] + random.uniform(0, 8), corner[1] + random.uniform(0, 8))
+			self.assertEqual(sorted(self.index.intersecting(box)), self.brute_force(box))
+
+	def test_point_in_polygon(self):
+		self.assertEqual(sorted(self.index.containing(15.5, 11.5)), [11 * 40 + 15, 5000])
+		self.assertEqual(self.index.containing(12.5, 12.5), [12 * 40 + 12])  # in the big region's hole
+		self.assertEqual(self.index.containing(-1, -1), [])
+		self.assertEqual(region_index.RegionIndex.build([]).containing(0, 0), [])
+
+
+class TestRegionQueries(TestCase):
+	def setUp(self):
+		self.client = APIClient()
+		self.client.force_authenticate(User.objects.create_user("mapper"))
+		self.county = models.Region.objects.create(name="County", region_type=models.Region.COUNTY, mantis_id=1,
+												   active_in_mantis=True, geometry=square(0, 0, 10))
+		self.basin = models.Region.objects.create(name="Basin", region_type=models.Region.SUB_BASIN, mantis_id=1,
+												  active_in_mantis=True, geometry=square(5, 5, 10))
+
+	def names(self, query):
+		response = self.client.get("/api/region/?" + query, format="json")
+		self.assertEqual(response.status_code, 200, response.content)
+		data = response.json()
+		return sorted(region["name"] for region in data.get("results", data))
+
+	def test_contains_and_bbox(self):
+		self.assertEqual(self.names("contains=2,2"), ["County"])
+		self.assertEqual(self.names("contains=7,7"), ["Basin", "County"])
+		self.assertEqual(self.names("contains=7,7&region_type={}".format(models.Region.SUB_BASIN)), ["Basin"])
+		self.assertEqual(self.names("bbox=11,11,20,20"), ["Basin"])
+		self.assertEqual(self.client.get("/api/region/?bbox=1,2,3", format="json").status_code, 400)
+
+		self.basin.geometry = square(50, 50, 10)
+		self.basin.save()  # the index is rebuilt for the change
+		self.assertEqual(self.names("contains=7,7"), ["County"])
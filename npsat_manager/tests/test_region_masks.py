@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+import numpy
+from django.test import SimpleTestCase
+
+from npsat_manager import region_masks
+
+
+class TestRegionMasks(SimpleTestCase):
+	def setUp(self) -> None:
+		# 10x10 grid of unit cells with its top left corner at (0, 10), north up
+		self.grid = region_masks.RasterGrid((0, 1, 0, 10, 0, -1), 10, 10)
+
+	def test_rasterize_square_with_hole(self):
+		square = {
+			"type": "Feature",
+			"properties": {},
+			"geometry": {
+				"type": "Polygon",
+				"coordinates": [
+					[[2, 2], [8, 2], [8, 8], [2, 8], [2, 2]],
+					[[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]],
+				]
+			}
+		}
+		mask = region_masks.rasterize(square, self.grid)
+		self.assertEqual(mask.window, (2, 2, 6, 6))
+		self.assertEqual(mask.cell_count, 36 - 4)
+		self.assertFalse(mask.to_array()[3, 3])  # cell centered at (5.5, 4.5) in the window is in the hole
+
+	def test_union_and_grid_indices(self):
+		first = numpy.zeros((10, 10), dtype=bool)
+		first[1, 1:3] = True
+		second = numpy.zeros((10, 10), dtype=bool)
+		second[5, 7] = True
+
+		combined = region_masks.RegionMask.union([
+			region_masks.RegionMask.from_array(first),
+			region_masks.RegionMask.from_array(second),
+		])
+		self.assertEqual(combined.window, (1, 1, 5, 7))
+		self.assertEqual(sorted(combined.grid_indices(10).tolist()), [11, 12, 57])
+
+	def test_index_round_trip(self):
+		full = numpy.zeros((10, 10), dtype=bool)
+		full[2:5, 3:9] = True
+		index = region_masks.RegionMaskIndex(self.grid, {7: region_masks.RegionMask.from_array(full)})
+
+		with tempfile.TemporaryDirectory() as folder:
+			path = os.path.join(folder, "masks.npz")
+			index.save(path)
+			loaded = region_masks.RegionMaskIndex.load(path)
+
+		self.assertEqual(loaded.grid.geotransform, self.grid.geotransform)
+		numpy.testing.assert_array_equal(loaded.combined([7]).to_array(), full[2:5, 3:9])
+		with self.assertRaises(KeyError):
+			loaded.combined([7, 8])
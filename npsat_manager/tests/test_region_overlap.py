@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from npsat_manager import models, region_overlap
+from npsat_manager.tests.test_region_index import square
+
+
+def rectangle(min_x, min_y, max_x, max_y):
+	ring = [[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]
+	return {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+
+class TestRegionOverlap(TestCase):
+	def setUp(self):
+		self.county = models.Region.objects.create(name="County", region_type="County", geometry=square(-120, 36, 1))
+		self.west = models.Region.objects.create(name="West Basin", region_type="Basin", geometry=rectangle(-120, 36, -119.5, 37))
+		self.east = models.Region.objects.create(name="East Basin", region_type="Basin", geometry=rectangle(-119.5, 36, -118, 37))
+		self.township = models.Region.objects.create(name="Township", region_type="Townships", geometry=rectangle(-119.6, 36.5, -119.4, 36.6))
+
+	def fractions(self, region):
+		return {overlap.other_region.name: overlap.fraction for overlap in models.RegionOverlap.objects.filter(region=region)}
+
+	def test_fractions_of_area(self):
+		self.assertGreater(region_overlap.build(workers=1, cell_size=0.01), 0)
+
+		county = self.fractions(self.county)
+		self.assertAlmostEqual(county["West Basin"], 0.5, delta=0.02)
+		self.assertAlmostEqual(county["East Basin"], 0.5, delta=0.02)
+		self.assertAlmostEqual(self.fractions(self.east)["County"], 1 / 3, delta=0.02)  # the rest is outside the county
+		self.assertAlmostEqual(self.fractions(self.west)["County"], 1, delta=0.02)
+		self.assertEqual(set(self.fractions(self.township)), {"County", "West Basin", "East Basin"})
+		self.assertNotIn("East Basin", self.fractions(self.west))  # no overlaps within a type
+
+		self.county.delete()
+		region_overlap.build(workers=1, cell_size=0.01)  # replaces the old table
+		self.assertEqual(set(self.fractions(self.township)), {"West Basin", "East Basin"})
+
+	def test_api(self):
+		region_overlap.build(workers=1, cell_size=0.01)
+		client = APIClient()
+		client.force_authenticate(User.objects.create_user("analyst"))
+		response = client.get("/api/region_overlap/?region={}&region_type=Basin".format(self.county.id), format="json")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(sorted(overlap["other_region_name"] for overlap in response.json()["results"]), ["East Basin", "West Basin"])
+		self.assertEqual(client.get("/api/region_overlap/?region=county", format="json").status_code, 400)
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+import numpy
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from npsat_backend import settings
+from npsat_manager import fake_mantis, models, region_results
+
+
+class TestRegionResults(TestCase):
+	def setUp(self):
+		folder = tempfile.TemporaryDirectory()
+		self.addCleanup(folder.cleanup)
+		for name, value in (("REGION_RESULT_CACHE_FOLDER", folder.name), ("REGION_RESULT_CACHE_ENABLED", True)):
+			patcher = mock.patch.object(settings, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		self.user = User.objects.create_user("regions")
+		self.counties = {name: models.Region.objects.create(name=name, region_type="County", mantis_id=mantis_id)
+						 for mantis_id, name in enumerate(("Tulare", "Kings", "Fresno"), start=1)}
+		self.scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+						  for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.crop = models.Crop.objects.create(name="Corn", caml_code=606)
+
+	def model_run(self, county_names, proportion=0.5):
+		model_run = models.ModelRun.objects.create(name=" + ".join(county_names), user=self.user, n_years=10, status=models.ModelRun.RUNNING,
+												   flow_scenario=self.scenarios[0], load_scenario=self.scenarios[1], unsat_scenario=self.scenarios[2])
+		model_run.regions.add(*[self.counties[name] for name in county_names])
+		models.Modification.objects.create(model_run=model_run, crop=self.crop, proportion=proportion)
+		return model_run
+
+	def test_only_missing_regions_go_to_mantis(self):
+		mantis = fake_mantis.start_in_thread(fake_mantis.FakeMantisConfig(n_wells=30, chunk_size=1000, seed=2))
+		server = models.MantisServer.objects.create(host=mantis.host, port=mantis.port, online=True)
+		try:
+			server.send_command(self.model_run(["Tulare", "Kings"]))
+			self.assertEqual(mantis.fake_mantis.commands_received, 1)  # nothing cached - one command, as usual
+			self.assertEqual(os.listdir(settings.REGION_RESULT_CACHE_FOLDER), [])
+
+			server.send_command(self.model_run(["Tulare"]))  # a single region's wells can be cached
+			self.assertEqual(mantis.fake_mantis.commands_received, 2)
+
+			second = self.model_run(["Tulare", "Kings", "Fresno"])
+			server.send_command(second)
+			self.assertEqual(mantis.fake_mantis.commands_received, 4)  # Kings and Fresno, one command each
+
+			third = self.model_run(["Fresno", "Kings", "Tulare"])
+			server.send_command(third)
+			self.assertEqual(mantis.fake_mantis.commands_received, 4)
+
+			with mock.patch.object(settings, "REGION_RESULT_CACHE_MAX_SPLIT", 1):
+				server.send_command(self.model_run(["Tulare"], proportion=0.25))  # different modifications
+				server.send_command(self.model_run(["Tulare", "Kings", "Fresno"], proportion=0.25))
+			self.assertEqual(mantis.fake_mantis.commands_received, 6)  # Kings and Fresno went together
+			self.assertEqual(len(os.listdir(settings.REGION_RESULT_CACHE_FOLDER)), 4)
+		finally:
+			mantis.stop()
+
+		second.refresh_from_db()
+		self.assertEqual(second.status, models.ModelRun.COMPLETED)
+		third.refresh_from_db()
+		self.assertEqual(third.status, models.ModelRun.COMPLETED)
+		self.assertEqual(third.n_wells, 90)  # percentiles are over every region's wells
+		self.assertEqual(third.results.count(), len(settings.PERCENTILE_CALCULATIONS))
+
+	def test_key_matches_run_read_back(self):
+		model_run = self.model_run(["Tulare"])
+		model_run.unsaturated_zone_travel_time = 12.5
+		model_run.save()
+		weights = [(606, 0.5)]
+		stored = models.ModelRun.objects.get(id=model_run.id)  # decimals now, rather than what was assigned
+		self.assertEqual(region_results.region_key(model_run, "County", 1, weights),
+						 region_results.region_key(stored, "County", 1, [(606, stored.modifications.get().proportion)]))
+
+	def test_files_in_use_dont_fail_runs(self):
+		region_results.store("old", numpy.ones((100, 10)))
+		with mock.patch("os.replace", side_effect=PermissionError("in use")):  # what Windows does while it's open
+			region_results.store("old", numpy.zeros((100, 10)))
+		with mock.patch("os.remove", side_effect=PermissionError("in use")):
+			self.assertEqual(region_results.prune(max_bytes=0), 0)
+		self.assertEqual(region_results.load("old").sum(), 1000)
+		self.assertEqual([name for name in os.listdir(settings.REGION_RESULT_CACHE_FOLDER) if name.endswith(".tmp")], [])
+
+	def test_prune_removes_least_recently_used(self):
+		for key in ("old", "new"):
+			region_results.store(key, numpy.ones((100, 10)))
+		past = time.time() - 60
+		os.utime(os.path.join(settings.REGION_RESULT_CACHE_FOLDER, "old.npy"), (past, past))
+		size = os.path.getsize(os.path.join(settings.REGION_RESULT_CACHE_FOLDER, "new.npy"))
+
+		self.assertEqual(region_results.prune(max_bytes=size), 1)
+		self.assertIsNone(region_results.load("old"))
+		self.assertEqual(region_results.load("new").shape, (100, 10))
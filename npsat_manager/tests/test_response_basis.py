@@ -0,0 +1,124 @@
+import os
+import tempfile
+from unittest import mock
+
+import numpy
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from npsat_backend import settings
+from npsat_manager import fake_mantis, mantis_protocol, models, response_basis
+
+
+class TestResponseBasis(SimpleTestCase):
+	def test_linear_combination_matches_scaled_loading(self):
+		# two crops, three wells, four years. Crop 606 contributes 2 to every value and crop 2200 contributes 1
+		base = numpy.full((3, 4), 10.0)
+		responses = numpy.stack([numpy.full((3, 4), 2.0), numpy.full((3, 4), 1.0)])
+		array = numpy.concatenate([base[None], responses])
+
+		crop_reductions = response_basis.reductions([606, 2200], [(606, 0.5), (0, 0.25)], [0, 606, 2200])
+		numpy.testing.assert_allclose(crop_reductions, [0.5, 0.25])
+		numpy.testing.assert_allclose(response_basis.apply(array, crop_reductions), 10 - 0.5 * 2 - 0.25 * 1)
+
+
+class TestLoadedArrays(SimpleTestCase):
+	def test_bounded_and_replaced_when_recomputed(self):
+		folder = tempfile.TemporaryDirectory()
+		self.addCleanup(folder.cleanup)
+		for name, value in (("RESPONSE_BASIS_FOLDER", folder.name), ("RESPONSE_BASIS_LOADED_LIMIT", 2)):
+			patcher = mock.patch.object(settings, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		self.addCleanup(response_basis._loaded_arrays.clear)
+		for file_name, value in (("1_old.npy", 1), ("1_new.npy", 2), ("2.npy", 3), ("3.npy", 4)):
+			numpy.save(os.path.join(folder.name, file_name), numpy.full((2, 1, 1), value, dtype=numpy.float64))
+
+		old, new = models.ResponseBasis(id=1, file_name="1_old.npy"), models.ResponseBasis(id=1, file_name="1_new.npy")
+		self.assertEqual(response_basis.load_array(old)[0, 0, 0], 1)
+		self.assertEqual(response_basis.load_array(new)[0, 0, 0], 2)  # the basis was recomputed - the old file's dropped
+		self.assertEqual(list(response_basis._loaded_arrays), [1])
+
+		response_basis.load_array(models.ResponseBasis(id=2, file_name="2.npy"))
+		response_basis.load_array(new)
+		response_basis.load_array(models.ResponseBasis(id=3, file_name="3.npy"))
+		self.assertEqual(list(response_basis._loaded_arrays), [1, 3])  # 2 was used least recently
+
+
+class LinearMantis(fake_mantis.FakeMantis):
+	"""
+		Fake Mantis whose wells are linear in loading, like the real model - each crop adds its own fixed curves,
+		scaled by the weight the command sends for it
+	"""
+
+	def respond(self, command):
+		parts = command.split()
+		n_years = int(parts[0])
+		area_id, n_regions = int(parts[7]), int(parts[8])
+		position = 9 if area_id == 1 else 9 + n_regions
+		n_weights = int(parts[position])
+		weights = parts[position + 1:position + 1 + 2 * n_weights]
+
+		results = numpy.zeros((self.config.n_wells, n_years))
+		for caml_code, weight in zip(weights[::2], weights[1::2]):
+			curves = numpy.random.default_rng(int(caml_code)).integers(0, 20, size=(self.config.n_wells, n_years))
+			results += float(weight) * curves
+		return fake_mantis.format_response(results)
+
+
+class TestPrecomputedRuns(TestCase):
+	def setUp(self):
+		folder = tempfile.TemporaryDirectory()
+		self.addCleanup(folder.cleanup)
+		for patcher in (mock.patch.object(settings, "RESPONSE_BASIS_FOLDER", folder.name),
+						mock.patch.dict(response_basis._loaded_arrays, clear=True)):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		self.user = User.objects.create_user("basis")
+		self.region = models.Region.objects.create(name="Tulare", region_type="County", mantis_id=1)
+		# names without spaces, so LinearMantis can split the command on whitespace
+		self.scenarios = [models.Scenario.objects.create(name="scenario_{}".format(scenario_type), scenario_type=scenario_type)
+						  for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.crops = {caml_code: models.Crop.objects.create(name=name, caml_code=caml_code)
+					  for caml_code, name in ((0, "All Other Crops"), (606, "Corn"), (2200, "Grapes"))}
+
+		self.mantis = fake_mantis.FakeMantisThread(LinearMantis(fake_mantis.FakeMantisConfig(n_wells=20, chunk_size=1000)))
+		self.mantis.start()
+		self.mantis.wait_until_ready()
+		self.addCleanup(self.mantis.stop)
+		self.server = models.MantisServer.objects.create(host=self.mantis.host, port=self.mantis.port, online=True)
+
+	def model_run(self, name, modifications=()):
+		model_run = models.ModelRun.objects.create(name=name, user=self.user, n_years=15, status=models.ModelRun.RUNNING,
+												   flow_scenario=self.scenarios[0], load_scenario=self.scenarios[1], unsat_scenario=self.scenarios[2])
+		model_run.regions.add(self.region)
+		for caml_code, proportion in modifications:
+			models.Modification.objects.create(model_run=model_run, crop=self.crops[caml_code], proportion=proportion)
+		return model_run
+
+	def test_run_from_basis_matches_full_run(self):
+		response_basis.precompute(self.model_run("base"), [self.region], self.server)
+		self.assertEqual(self.mantis.fake_mantis.commands_received, 4)  # the base curves and one for each crop
+
+		modifications = [(606, 0.5), (0, 0.25)]
+		with mock.patch.object(settings, "RESPONSE_BASIS_ENABLED", True):
+			from_basis = self.model_run("from basis", modifications)
+			self.server.send_command(from_basis)
+		self.assertEqual(self.mantis.fake_mantis.commands_received, 4)  # answered without Mantis
+
+		with mock.patch.object(settings, "RESPONSE_BASIS_ENABLED", False):
+			full = self.model_run("full", modifications)
+			self.server.send_command(full)
+		self.assertEqual(self.mantis.fake_mantis.commands_received, 5)
+
+		from_basis.refresh_from_db()
+		full.refresh_from_db()
+		self.assertEqual(from_basis.status, models.ModelRun.COMPLETED)
+		self.assertEqual(from_basis.status_message, "Computed from precomputed responses")
+		self.assertEqual(full.status, models.ModelRun.COMPLETED)
+		self.assertEqual(from_basis.n_wells, full.n_wells)
+
+		for percentile in settings.PERCENTILE_CALCULATIONS:
+			numpy.testing.assert_allclose(from_basis.results.get(percentile=percentile).values,
+										  full.results.get(percentile=percentile).values, rtol=1e-5)
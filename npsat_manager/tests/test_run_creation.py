@@ -0,0 +1,75 @@
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from npsat_manager import models
+
+
+class TestRunCreation(TestCase):
+	def setUp(self):
+		caches["throttle"].clear()  # user ids are reused between tests
+		self.user = User.objects.create_user("creator")
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+		self.scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+						  for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.regions = [models.Region.objects.create(name="Township {}".format(number), region_type="Township", mantis_id=number)
+						for number in range(1, 201)]
+		self.crops = [models.Crop.objects.create(name="Crop {}".format(code), caml_code=code) for code in (1, 2, 3)]
+
+	def submission(self, regions=(), **changes):
+		submission = {
+			"name": "run", "n_years": 50, "water_content": 0, "unsaturated_zone_travel_time": 0,
+			"reduction_start_year": 2020, "reduction_end_year": 2025,
+			"flow_scenario": {"id": self.scenarios[0].id}, "load_scenario": {"id": self.scenarios[1].id},
+			"unsat_scenario": {"id": self.scenarios[2].id},
+			"modifications": [{"crop": {"id": crop.id}, "proportion": 0.5} for crop in self.crops],
+			"regions": [{"id": region.id} for region in regions],
+		}
+		submission.update(changes)
+		return submission
+
+	def post(self, submission):
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post("/api/model_run/", submission, format="json")
+		return response, len(queries)
+
+	def test_query_count_does_not_grow_with_regions(self):
+		response, few_queries = self.post(self.submission(self.regions[:2]))
+		self.assertEqual(response.status_code, 201, response.content)
+		response, many_queries = self.post(self.submission(self.regions))
+		self.assertEqual(response.status_code, 201, response.content)
+		self.assertEqual(many_queries, few_queries)
+
+		model_run = models.ModelRun.objects.get(id=response.json()["id"])
+		self.assertEqual(model_run.status, models.ModelRun.READY)
+		self.assertEqual(model_run.regions.count(), len(self.regions))
+		self.assertEqual(sorted(model_run.modifications.values_list("crop_id", flat=True)), [crop.id for crop in self.crops])
+		self.assertEqual(response.json()["flow_scenario"]["name"], self.scenarios[0].name)
+
+	def test_rejects_unknown_ids(self):
+		response, queries = self.post(self.submission([self.regions[0], models.Region(id=10 ** 6)]))
+		self.assertEqual(response.status_code, 400)
+		for changes in ({"modifications": [{"crop": {"id": 10 ** 6}, "proportion": 0.5}]},
+						{"flow_scenario": {"id": self.scenarios[1].id}}):
+			response, queries = self.post(self.submission(**changes))
+			self.assertEqual(response.status_code, 400, changes)
+		self.assertEqual(models.ModelRun.objects.count(), 0)
+
+	def test_rejects_duplicate_crops_and_proportions_above_one(self):
+		crop = {"id": self.crops[0].id}
+		for modifications in ([{"crop": crop, "proportion": 0.5}, {"crop": crop, "proportion": 0.7}],
+							  [{"crop": crop, "proportion": 1.5}]):
+			response, queries = self.post(self.submission([self.regions[0]], modifications=modifications))
+			self.assertEqual(response.status_code, 400, modifications)
+			self.assertIn("modifications", response.json())
+		self.assertEqual(models.ModelRun.objects.count(), 0)
+
+	def test_runs_belong_to_the_submitter(self):
+		other_user = User.objects.create_user("someone else")
+		response, queries = self.post(self.submission([self.regions[0]], user=other_user.id))
+		self.assertEqual(response.status_code, 201, response.content)
+		self.assertEqual(models.ModelRun.objects.get(id=response.json()["id"]).user, self.user)
@@ -0,0 +1,131 @@
+import datetime
+import socket
+from unittest import mock
+
+import numpy
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from npsat_backend import settings
+from npsat_manager import fake_mantis, models, run_queue
+from npsat_manager.management.commands import process_runs
+
+
+def closed_port():
+	with socket.socket() as listener:
+		listener.bind(("127.0.0.1", 0))
+		return listener.getsockname()[1]
+
+
+class TestRunQueue(TestCase):
+	def setUp(self):
+		user = User.objects.create_user("queue")
+		self.region = models.Region.objects.create(name="Central Valley", region_type="Central Valley", mantis_id=1)
+		scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+					 for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.model_run = models.ModelRun.objects.create(name="run", user=user, n_years=10, status=models.ModelRun.READY,
+														flow_scenario=scenarios[0], load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+		self.model_run.regions.add(self.region)
+		models.Modification.objects.create(model_run=self.model_run, crop=models.Crop.objects.create(name="Corn", caml_code=606), proportion=0.5)
+
+	def test_claim_is_exclusive(self):
+		attempt = models.RunAttempt.claim(self.model_run)
+		self.assertEqual(attempt.number, 1)
+		self.assertIsNone(models.RunAttempt.claim(models.ModelRun.objects.get(id=self.model_run.id)))
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.RUNNING)
+
+	@mock.patch.object(settings, "RUN_MAX_ATTEMPTS", 2)
+	def test_retries_then_dead_letters(self):
+		first = models.RunAttempt.claim(self.model_run)
+		first.fail(OSError("connection reset"))
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.READY)
+		self.assertGreater(self.model_run.next_attempt_after, timezone.now())
+
+		dispatcher = process_runs.Command()
+		self.assertEqual(dispatcher._get_runs(), [])  # backing off
+
+		models.ModelRun.objects.filter(id=self.model_run.id).update(next_attempt_after=timezone.now())
+		second = models.RunAttempt.claim(self.model_run)
+		self.assertEqual(second.number, 2)
+		second.fail(OSError("connection reset"))
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.ERROR)
+		self.assertEqual([attempt.status for attempt in self.model_run.attempts.order_by('number')],
+						 [models.RunAttempt.FAILED, models.RunAttempt.DEAD_LETTER])
+
+	def test_sweep_requeues_expired_leases(self):
+		attempt = models.RunAttempt.claim(self.model_run)
+		models.RunAttempt.objects.filter(id=attempt.id).update(lease_expires=timezone.now() - datetime.timedelta(seconds=1))
+		self.assertEqual(run_queue.sweep(), 1)
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.READY)
+
+		retry = models.RunAttempt.claim(self.model_run)
+		attempt.fail(OSError("timed out"))  # the stale worker finally gives up - it mustn't touch the retry
+		self.assertFalse(attempt.renew())
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.RUNNING)
+		self.assertEqual(models.RunAttempt.objects.get(id=retry.id).status, models.RunAttempt.RUNNING)
+		self.assertEqual(models.RunAttempt.objects.get(id=attempt.id).status, models.RunAttempt.EXPIRED)
+
+	def test_expired_attempt_does_not_store_results(self):
+		attempt = models.RunAttempt.claim(self.model_run)
+		models.ModelRun.objects.filter(id=self.model_run.id).update(public=True)  # made public while it runs
+		percentile_values = numpy.zeros((len(settings.PERCENTILE_CALCULATIONS), self.model_run.n_years))
+		models.save_percentiles(percentile_values, self.model_run, n_wells=3, attempt=attempt)
+		self.model_run.refresh_from_db()
+		self.assertEqual((self.model_run.n_wells, self.model_run.public), (3, True))  # only the results were written
+
+		models.RunAttempt.objects.filter(id=attempt.id).update(lease_expires=timezone.now() - datetime.timedelta(seconds=1))
+		run_queue.sweep()
+		with self.assertRaises(models.LeaseLost):
+			models.save_percentiles(percentile_values, self.model_run, n_wells=5, attempt=attempt)
+		self.model_run.refresh_from_db()
+		self.assertEqual((self.model_run.n_wells, self.model_run.status), (3, models.ModelRun.READY))
+
+	def test_sweep_requeues_runs_without_attempts(self):
+		models.ModelRun.objects.filter(id=self.model_run.id).update(status=models.ModelRun.RUNNING)
+		self.assertEqual(run_queue.sweep(), 1)
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.READY)
+
+	def test_run_moves_to_another_server(self):
+		dispatcher = process_runs.Command()
+		dead_server = models.MantisServer.objects.create(host="127.0.0.1", port=closed_port(), online=True)
+		with self.assertRaises(OSError):
+			dispatcher.process_waiting_runs(dead_server)
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.READY)
+
+		models.ModelRun.objects.filter(id=self.model_run.id).update(next_attempt_after=None)
+		server = fake_mantis.start_in_thread(fake_mantis.FakeMantisConfig(n_wells=20, chunk_size=1000))
+		try:
+			self.assertEqual(dispatcher.process_waiting_runs(models.MantisServer.objects.create(host=server.host, port=server.port, online=True)), 1)
+		finally:
+			server.stop()
+		self.model_run.refresh_from_db()
+		self.assertEqual(self.model_run.status, models.ModelRun.COMPLETED)
+		self.assertEqual([attempt.status for attempt in self.model_run.attempts.order_by('number')],
+						 [models.RunAttempt.FAILED, models.RunAttempt.COMPLETED])
+
+	def test_routes_runs_to_warm_servers(self):
+		warm_server = models.MantisServer.objects.create(host="127.0.0.1", port=1, online=True)
+		cold_server = models.MantisServer.objects.create(host="127.0.0.1", port=2, online=True)
+		other_run = models.ModelRun.objects.create(name="other scenarios", user=self.model_run.user, status=models.ModelRun.READY,
+												   flow_scenario=self.model_run.load_scenario, load_scenario=self.model_run.load_scenario,
+												   unsat_scenario=self.model_run.unsat_scenario)
+		models.MantisServer.objects.get(id=warm_server.id).record_scenarios(other_run)  # another worker on the same server
+		warm_server.record_scenarios(self.model_run)
+		self.assertEqual(models.MantisServer.objects.get(id=warm_server.id).recent_scenarios,
+						 [[self.model_run.flow_scenario_id, self.model_run.load_scenario_id, self.model_run.unsat_scenario_id],
+						  [other_run.flow_scenario_id, other_run.load_scenario_id, other_run.unsat_scenario_id]])
+		models.MantisServer.objects.filter(id=warm_server.id).update(recent_scenarios=warm_server.recent_scenarios[:1])
+
+		dispatcher = process_runs.Command()
+		self.assertEqual([run.id for run in dispatcher._get_runs(cold_server)], [other_run.id, self.model_run.id])
+		other_run.delete()
+		self.assertEqual([run.id for run in dispatcher._get_runs(cold_server)], [self.model_run.id])  # better than sitting idle
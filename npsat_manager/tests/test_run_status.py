@@ -0,0 +1,75 @@
+import asyncio
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from rest_framework.authtoken.models import Token
+
+from npsat_manager import models, run_status
+
+
+class TestRunStatusWatcher(SimpleTestCase):
+	def test_waiters_settle_when_status_changes(self):
+		watcher = run_status.RunStatusWatcher()
+
+		async def wait_and_change():
+			waiting = asyncio.ensure_future(watcher.wait(7, models.ModelRun.RUNNING, timeout=5))
+			await asyncio.sleep(0)
+			self.assertEqual(watcher.waiting_runs(), {7})
+			watcher.resolve({7: models.ModelRun.RUNNING, 8: models.ModelRun.COMPLETED})  # 7 hasn't changed yet
+			await asyncio.sleep(0.01)
+			self.assertFalse(waiting.done())
+			watcher.resolve({7: models.ModelRun.COMPLETED})
+			return await waiting
+
+		self.assertEqual(asyncio.run(wait_and_change()), models.ModelRun.COMPLETED)
+		self.assertEqual(watcher.waiting_runs(), set())
+
+	def test_wait_times_out(self):
+		watcher = run_status.RunStatusWatcher()
+		self.assertIsNone(asyncio.run(watcher.wait(7, models.ModelRun.READY, timeout=0.01)))
+
+	def test_notifications_are_received(self):
+		watcher = run_status.RunStatusWatcher(listen_address=("127.0.0.1", 0))
+		self.assertTrue(watcher.listening)
+		run_status.notify(12, addresses=[watcher._socket.getsockname()])
+		run_status.notify(13, addresses=[watcher._socket.getsockname()])
+		self.assertEqual(watcher._receive(timeout=5), {12, 13})
+
+
+class TestModelRunStatus(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user("waiter", "waiter@example.com", "waiter")
+		self.token = Token.objects.get_or_create(user=self.user)[0]
+		scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+					 for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.model_run = models.ModelRun.objects.create(name="finished", user=self.user, status=models.ModelRun.COMPLETED,
+														flow_scenario=scenarios[0], load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+		self.url = "/api/model_run/{}/status/".format(self.model_run.id)
+
+	def get(self, url, **headers):
+		return self.client.get(url, HTTP_AUTHORIZATION="Token {}".format(self.token.key), **headers)
+
+	def test_returns_at_once_when_status_differs(self):
+		response = self.get(self.url + "?since={}".format(models.ModelRun.RUNNING))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.json()["status"], models.ModelRun.COMPLETED)
+
+	def test_holds_until_timeout_when_status_unchanged(self):
+		response = self.get(self.url + "?since={}&timeout=0.05".format(models.ModelRun.COMPLETED))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.json()["status"], models.ModelRun.COMPLETED)
+
+	def test_timeout_is_checked(self):
+		for timeout in ("soon", "nan", "inf"):
+			response = self.get(self.url + "?since={}&timeout={}".format(models.ModelRun.COMPLETED, timeout))
+			self.assertEqual(response.status_code, 400, timeout)
+			self.assertIn("timeout", response.json())
+
+		response = self.get(self.url + "?since={}&timeout=-5".format(models.ModelRun.COMPLETED))  # held for no time at all
+		self.assertEqual(response.status_code, 200)
+
+	def test_requires_access(self):
+		self.assertEqual(self.client.get(self.url).status_code, 401)
+		other = User.objects.create_user("other", "other@example.com", "other")
+		self.token = Token.objects.get_or_create(user=other)[0]
+		self.assertEqual(self.get(self.url).status_code, 404)
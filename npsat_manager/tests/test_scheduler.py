@@ -0,0 +1,76 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from npsat_backend import settings
+from npsat_manager import models, scheduler
+
+NOW = timezone.now()
+
+
+def candidate(run_id, user_id, minutes_ago=0, is_staff=False, is_base=False):
+	return scheduler.Candidate(run_id, user_id, is_staff, is_base, NOW - datetime.timedelta(minutes=minutes_ago))
+
+
+class TestOrderRuns(SimpleTestCase):
+	def test_users_take_turns(self):
+		batch = [candidate(run_id, user_id=1, minutes_ago=60 - run_id) for run_id in range(1, 21)]
+		interactive = candidate(100, user_id=2)
+		order = scheduler.order_runs(batch + [interactive], usage={}, running={}, now=NOW)
+		self.assertEqual(order[:3], [1, 100, 2])  # the batch user's oldest run has aged ahead, then it's the other user's turn
+
+		order = scheduler.order_runs(batch + [interactive], usage={1: 10}, running={1: 1}, now=NOW)
+		self.assertEqual(order[0], 100)
+
+	def test_staff_and_base_runs_go_first(self):
+		candidates = [candidate(1, user_id=1), candidate(2, user_id=2, is_staff=True)]
+		self.assertEqual(scheduler.order_runs(candidates, usage={1: 1, 2: 1}, running={}, now=NOW), [2, 1])
+
+		candidates = [candidate(1, user_id=1, minutes_ago=5), candidate(2, user_id=1, is_base=True)]
+		self.assertEqual(scheduler.order_runs(candidates, usage={}, running={}, now=NOW), [2, 1])
+
+	@mock.patch.object(settings, "SCHEDULER_MAX_RUNNING_PER_USER", 1)
+	def test_running_cap(self):
+		candidates = [candidate(1, user_id=1), candidate(2, user_id=2)]
+		self.assertEqual(scheduler.order_runs(candidates, usage={}, running={1: 1}, now=NOW), [2])
+
+
+class TestSubmissionLimits(TestCase):
+	def setUp(self):
+		caches["throttle"].clear()  # user ids are reused between tests
+		self.user = User.objects.create_user("submitter")
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+
+	def test_queue_bound_and_rate(self):
+		scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+					 for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		models.ModelRun.objects.create(name="waiting", user=self.user, status=models.ModelRun.READY,
+									   flow_scenario=scenarios[0], load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+		with mock.patch.object(settings, "MODEL_RUN_MAX_QUEUED", 1), mock.patch.object(settings, "MODEL_RUN_SUBMIT_RATE", "1/hour"):
+			response = self.client.post("/api/model_run/", {}, format="json")
+			self.assertEqual(response.status_code, 429)
+			self.assertIn("waiting", response.json()["detail"])
+
+			response = self.client.post("/api/model_run/", {}, format="json")
+			self.assertEqual(response.status_code, 429)
+			self.assertNotIn("waiting", response.json()["detail"])  # the rate limit this time
+
+		self.assertEqual(self.client.get("/api/model_run/", format="json").status_code, 200)  # only submissions are limited
+
+
+class TestPreferWarm(SimpleTestCase):
+	def test_warm_runs_first_within_window(self):
+		scenarios = {1: (1, 1, 1), 2: (2, 2, 2), 3: (3, 3, 3), 4: (2, 2, 2), 5: (2, 2, 2)}
+		self.assertEqual(scheduler.prefer_warm([1, 2, 3, 4, 5], scenarios, warm=[(2, 2, 2)], loaded_elsewhere=set(), window=4),
+						 [2, 4, 1, 3, 5])  # 5 is outside the window, so it waits its turn
+
+	def test_leaves_runs_for_servers_that_have_them_loaded(self):
+		scenarios = {1: (1, 1, 1), 2: (2, 2, 2)}
+		self.assertEqual(scheduler.prefer_warm([1, 2], scenarios, warm=[], loaded_elsewhere={(1, 1, 1)}, window=10), [2, 1])
+		self.assertEqual(scheduler.prefer_warm([1], {1: (1, 1, 1)}, warm=[], loaded_elsewhere={(1, 1, 1)}, window=10), [1])
@@ -0,0 +1,124 @@
+import os
+import signal
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from npsat_backend import server
+from npsat_manager import models
+from npsat_manager.support import metrics
+
+
+class TestServer(SimpleTestCase):
+	def test_parse_address(self):
+		self.assertEqual(server.parse_address("*:8010"), ("0.0.0.0", 8010))
+		self.assertEqual(server.parse_address("127.0.0.1:80"), ("127.0.0.1", 80))
+		self.assertEqual(server.parse_address("[::1]:8010"), ("::1", 8010))
+
+	def test_worker_count(self):
+		self.assertEqual(server.worker_count(3), 3)
+		self.assertGreaterEqual(server.worker_count(None), 1)
+
+
+class TestSupervisor(SimpleTestCase):
+	"""
+		Serves the real app from two worker processes, then reloads them and replaces one that dies
+	"""
+
+	def setUp(self):
+		# spawned rather than forked - other tests load Numba's thread pool into this process, and forking it hangs
+		# the test run on exit. The server itself forks before anything like that is loaded
+		metrics_folder = tempfile.TemporaryDirectory()
+		self.addCleanup(metrics_folder.cleanup)
+		self.supervisor = server.Supervisor("127.0.0.1:0", workers=2, threads=2, drain_seconds=1, preload=False,
+											metrics_folder=metrics_folder.name)
+		self.supervisor.start()
+		self.addCleanup(self.supervisor.stop)
+		self.url = "http://127.0.0.1:{}/metrics".format(self.supervisor.listener.getsockname()[1])
+
+	def get(self):
+		"""
+			Requests /metrics (served to localhost without touching the database), waiting for workers to come up
+		:return: the response's status. Reloaded workers load local_settings afresh, whose ALLOWED_HOSTS may turn
+				the request away with a 400 - that's still the app answering
+		"""
+		deadline = time.monotonic() + 60  # spawned workers load the app from scratch
+		while True:
+			try:
+				with urllib.request.urlopen(self.url, timeout=10) as response:
+					return response.status
+			except urllib.error.HTTPError as error:
+				return error.code
+			except OSError:
+				if time.monotonic() > deadline:
+					raise
+				time.sleep(0.2)
+
+	def pids(self):
+		return sorted(worker.pid for worker in self.supervisor.generation.workers)
+
+	def test_serves_reloads_and_replaces_workers(self):
+		self.assertLess(self.get(), 500)
+		first_pids = self.pids()
+		self.assertEqual(len(first_pids), 2)
+
+		supervising = threading.Thread(target=self.supervisor.supervise, daemon=True)
+		supervising.start()
+		self.supervisor.request_reload()
+		deadline = time.monotonic() + 60
+		while set(self.pids()) & set(first_pids) and time.monotonic() < deadline:
+			time.sleep(0.1)
+		self.assertFalse(set(self.pids()) & set(first_pids))
+		self.assertLess(self.get(), 500)
+
+		reloaded_pids = self.pids()
+		os.kill(reloaded_pids[0], signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM)
+		while reloaded_pids[0] in self.pids() and time.monotonic() < deadline:
+			time.sleep(0.1)
+		self.assertEqual(len(self.pids()), 2)
+		self.assertNotIn(reloaded_pids[0], self.pids())
+		self.assertLess(self.get(), 500)
+
+		self.supervisor.request_stop()
+		supervising.join(30)
+		self.assertFalse(supervising.is_alive())
+		self.assertFalse(any(worker.is_alive() for worker in self.supervisor.generation.workers))
+
+		# every worker's requests were kept once it exited, including the ones from before the reload. The killed
+		# worker may have answered the second request after its last write, which is lost with it
+		self.assertEqual(os.listdir(self.supervisor.metrics_folder), [metrics.DEAD_FILE])
+		with mock.patch.object(metrics, "MULTIPROCESS_FOLDER", self.supervisor.metrics_folder):
+			text = metrics.render(metrics.Registry())
+		self.assertRegex(text, r'npsat_http_requests_total\{view="[^"]+",action="get",status="\d+"\} [23]\n')
+
+
+class TestReferenceCache(TestCase):
+	def setUp(self):
+		self.client = APIClient()
+		self.client.force_authenticate(User.objects.create_user("reader", "reader@example.com", "reader"))
+		models.Region.objects.create(name="Kern", mantis_id=15, region_type="County", active_in_mantis=True,
+									 geometry={"type": "Point", "coordinates": [-119, 35.3]})
+
+	def test_runs_against_local_caches(self):
+		for alias in ("reference", "throttle", "results"):
+			self.assertIsInstance(caches[alias], LocMemCache, alias)
+
+	def test_cached_until_changed(self):
+		first = self.client.get("/api/region/", format="json")
+		self.assertEqual(first.status_code, 200)
+		with self.assertNumQueries(0):
+			second = self.client.get("/api/region/", format="json")
+		self.assertEqual(first.content, second.content)
+
+		models.Region.objects.create(name="Tulare", mantis_id=16, region_type="County", active_in_mantis=True)
+		names = [region["name"] for region in self.client.get("/api/region/", format="json").json()["results"]]
+		self.assertEqual(names, ["Kern", "Tulare"])
@@ -0,0 +1,75 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from npsat_manager import models, sweeps
+
+
+class TestPoints(SimpleTestCase):
+	def test_cross_product_without_duplicates(self):
+		self.assertEqual(sweeps.points([(1, [0, 1]), (2, [0.5, 0.5])]),
+						 [{1: 0, 2: 0.5}, {1: 1, 2: 0.5}])
+
+
+class TestRunSweepAPI(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user("analyst")
+		self.client = APIClient()
+		self.client.force_authenticate(self.user)
+		self.scenarios = [models.Scenario.objects.create(name="scenario {}".format(scenario_type), scenario_type=scenario_type)
+						  for scenario_type in (models.Scenario.TYPE_FLOW, models.Scenario.TYPE_LOAD, models.Scenario.TYPE_UNSAT)]
+		self.regions = [models.Region.objects.create(name="Region {}".format(index), region_type="County", mantis_id=index) for index in range(3)]
+		self.corn = models.Crop.objects.create(name="Corn", caml_code=606)
+		self.grapes = models.Crop.objects.create(name="Grapes", caml_code=1451)
+		self.almonds = models.Crop.objects.create(name="Almonds", caml_code=201)
+
+	def sweep_request(self, corn_values, grape_values):
+		return {
+			"name": "corn and grapes",
+			"base": {"flow_scenario": self.scenarios[0].id, "load_scenario": self.scenarios[1].id, "unsat_scenario": self.scenarios[2].id,
+					 "n_years": 50, "water_content": 0, "regions": [region.id for region in self.regions],
+					 "modifications": [{"crop": self.almonds.id, "proportion": 0.8}, {"crop": self.corn.id, "proportion": 1}]},
+			"axes": [{"crop": self.corn.id, "values": corn_values}, {"crop": self.grapes.id, "values": grape_values}],
+		}
+
+	def test_creates_runs_in_a_few_queries(self):
+		values = [step / 10 for step in range(10)]
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post("/api/run_sweep/", self.sweep_request(values, values), format="json")
+		self.assertEqual(response.status_code, 201, response.content)
+		self.assertLess(len(queries), 20, [query["sql"] for query in queries])
+
+		sweep = models.RunSweep.objects.get(id=response.json()["id"])
+		self.assertEqual(len(response.json()["runs"]), 100)
+		runs = sweep.runs.filter(modifications__crop=self.corn, modifications__proportion=0.3)\
+			.filter(modifications__crop=self.grapes, modifications__proportion=0.7)
+		self.assertEqual(runs.count(), 1)
+		run = runs.get()
+		self.assertEqual(run.status, models.ModelRun.READY)
+		self.assertEqual(run.n_years, 50)
+		self.assertEqual(run.modifications.count(), 3)  # almonds from the base, corn and grapes from the axes
+		self.assertEqual(run.regions.count(), 3)
+
+		progress = self.client.get("/api/run_sweep/{}/".format(sweep.id), format="json").json()["progress"]
+		self.assertEqual((progress["ready"], progress["total"], progress["finished"]), (100, 100, False))
+
+	def test_rejects_unknown_crops(self):
+		request = self.sweep_request([0, 1], [0, 1])
+		request["axes"].append({"crop": 9999, "values": [0]})
+		response = self.client.post("/api/run_sweep/", request, format="json")
+		self.assertEqual(response.status_code, 400)
+		self.assertEqual(models.ModelRun.objects.count(), 0)
+
+	def test_rejects_duplicate_crops_and_proportions_above_one(self):
+		request = self.sweep_request([0, 1], [0, 1])
+		request["base"]["modifications"].append({"crop": self.almonds.id, "proportion": 0.5})
+		response = self.client.post("/api/run_sweep/", request, format="json")
+		self.assertEqual(response.status_code, 400, response.content)
+		self.assertIn("modifications", response.json()["base"])
+
+		response = self.client.post("/api/run_sweep/", self.sweep_request([0, 1.5], [0, 1]), format="json")
+		self.assertEqual(response.status_code, 400, response.content)
+		self.assertIn("axes", response.json())
+		self.assertEqual(models.ModelRun.objects.count(), 0)
@@ -0,0 +1,54 @@
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from npsat_manager import models
+from npsat_manager.support import timing
+
+
+class TestTiming(SimpleTestCase):
+	def test_stages_accumulate(self):
+		timer = timing.StageTimer()
+		timer.record("parsing", 1.5)
+		with timer.stage("parsing"):
+			pass
+		timer.record("db_write", 0.5)
+		self.assertGreaterEqual(timer.durations["parsing"], 1.5)
+		self.assertAlmostEqual(timer.total, timer.durations["parsing"] + 0.5)
+
+	def test_summarize_skips_missing_stages(self):
+		rows = [{"parsing": float(value), "mantis_compute": None} for value in range(1, 101)]
+		summary = timing.summarize(rows, ("parsing", "mantis_compute"))
+		self.assertEqual(summary["n_runs"], 100)
+		self.assertAlmostEqual(summary["parsing"]["p50"], 50.5)
+		self.assertAlmostEqual(summary["parsing"]["p95"], 95.05)
+		self.assertIsNone(summary["mantis_compute"])
+
+
+class TestRunTimingSummary(TestCase):
+	def test_grouped_by_region_type_and_scenario(self):
+		admin = User.objects.create_superuser("admin", "admin@example.com", "admin")
+		scenarios = [models.Scenario.objects.create(name=name, scenario_type=scenario_type) for name, scenario_type in
+					 (("flow", models.Scenario.TYPE_FLOW), ("load", models.Scenario.TYPE_LOAD), ("unsat", models.Scenario.TYPE_UNSAT))]
+		counties = [models.Region.objects.create(name=name, region_type="County", mantis_id=index) for index, name in enumerate(("Fresno", "Kern"))]
+		for seconds in (1.0, 3.0):
+			model_run = models.ModelRun.objects.create(name="run", user=admin, flow_scenario=scenarios[0],
+													   load_scenario=scenarios[1], unsat_scenario=scenarios[2])
+			model_run.regions.add(*counties)
+			timer = timing.StageTimer()
+			timer.record("mantis_compute", seconds)
+			models.RunTiming.record(model_run, timer)
+
+		client = APIClient()
+		client.force_authenticate(admin)
+		summary = client.get("/api/run_timing_summary/").json()
+		self.assertEqual(summary["region_type"]["County"]["n_runs"], 2)
+		self.assertAlmostEqual(summary["region_type"]["County"]["mantis_compute"]["p50"], 2.0)
+		self.assertEqual(summary["scenario"]["flow / load / unsat"]["n_runs"], 2)
+		self.assertIsNone(summary["scenario"]["flow / load / unsat"]["parsing"])
+
+		for days in ("month", "-1", "2.5"):
+			response = client.get("/api/run_timing_summary/?days={}".format(days))
+			self.assertEqual(response.status_code, 400, days)
+			self.assertIn("days", response.json())
+		self.assertEqual(client.get("/api/run_timing_summary/?days=0").json()["region_type"], {})
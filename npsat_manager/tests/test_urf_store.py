@@ -0,0 +1,38 @@
+import tempfile
+
+import numpy
+from django.test import SimpleTestCase
+
+from npsat_manager import kernels, urf_store
+
+
+class TestURFStore(SimpleTestCase):
+	def setUp(self) -> None:
+		# 50 lags on a 4x5 grid - exponentially decaying URFs, with half of the cells having no wells
+		lags = numpy.arange(50)[:, None, None]
+		rates = numpy.linspace(0.2, 1.0, 20).reshape(4, 5)
+		self.cube = numpy.exp(-lags * rates[None, :, :])
+		self.cube[:, :2, :] = 0
+
+	def test_truncation_and_round_trip(self):
+		store = urf_store.URFStore.from_dense(self.cube, tolerance=1e-3)
+		self.assertEqual(len(store.cell_index), 10)
+		self.assertLess(store.nbytes, store.dense_nbytes / 4)
+		numpy.testing.assert_array_equal(store.urf(0), 0)
+
+		with tempfile.TemporaryDirectory() as folder:
+			store.save(folder)
+			loaded = urf_store.URFStore.load(folder)
+			numpy.testing.assert_array_equal(loaded.values, store.values)
+			urf = loaded.urf(10)
+			self.assertAlmostEqual(float(urf[0]), 1.0)
+			self.assertTrue(numpy.all(urf[urf > 0] >= 1e-3 * 0.999))
+
+	def test_sparse_convolution_matches_dense(self):
+		store = urf_store.URFStore.from_dense(self.cube, tolerance=0)
+		loadings = numpy.random.default_rng(3).random((20, 30))
+		dense_urfs = self.cube.reshape(50, 20).T
+		expected = kernels.convolve_and_sum(loadings, dense_urfs)
+		rows = store.rows_for(numpy.arange(20))
+		results = kernels.convolve_sparse_and_sum(loadings, rows, store.offsets, store.values)
+		numpy.testing.assert_allclose(results, expected, rtol=1e-5)
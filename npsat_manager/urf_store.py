@@ -0,0 +1,146 @@
+"""
+	Storage for unit response functions (URFs). A dense URF cube is (years into the future, y, x) per scenario,
+	but most URFs decay to nearly nothing after a few decades and many cells have no wells at all, so almost
+	all of that cube is zeros.
+
+	A URFStore keeps only the cells that have a response, and for each of them only the lags up to the point
+	where the response drops below a tolerance. The layout is CSR-style:
+
+		cell_index - (cells,) int64, offset of each stored cell into the grid flattened row-major, ascending
+		offsets - (cells + 1,) int64, values[offsets[i]:offsets[i + 1]] is cell i's URF starting at lag 0
+		values - (total stored lags,) float32
+
+	Each array is saved as its own .npy file in a folder with a small JSON metadata file, so a store can be
+	memory mapped and handed straight to kernels.convolve_sparse_and_sum without loading it all into memory.
+"""
+
+import json
+import logging
+import os
+
+import numpy
+
+from npsat_backend import settings
+
+log = logging.getLogger("npsat.urf_store")
+
+METADATA_FILE = "urf_store.json"
+ARRAYS = ("cell_index", "offsets", "values")
+
+
+class URFStore(object):
+
+	def __init__(self, cell_index, offsets, values, grid_shape, n_lags, tolerance=0.0):
+		"""
+		:param cell_index: see module docstring
+		:param offsets: see module docstring
+		:param values: see module docstring
+		:param grid_shape: (rows, cols) of the model grid
+		:param n_lags: length of the untruncated URFs
+		:param tolerance: relative tolerance the URFs were truncated at
+		"""
+		self.cell_index = cell_index
+		self.offsets = offsets
+		self.values = values
+		self.grid_shape = tuple(int(value) for value in grid_shape)
+		self.n_lags = int(n_lags)
+		self.tolerance = float(tolerance)
+
+	@classmethod
+	def from_dense(cls, cube, tolerance=1e-4, dtype=numpy.float32):
+		"""
+			Builds a store from a dense URF cube. Each cell's URF is cut off after the last lag whose magnitude is
+			at least tolerance times that cell's peak, and cells whose URF is zero everywhere are dropped.
+		:param cube: 3D array of (years into the future, y, x). NaNs are treated as 0
+		:param tolerance: relative cutoff - 0 keeps everything up to the last nonzero lag
+		:param dtype: dtype to store the values in
+		:return: URFStore
+		"""
+		n_lags, rows, cols = cube.shape
+		by_cell = numpy.nan_to_num(numpy.asarray(cube).reshape(n_lags, rows * cols).T)  # (cells, lags)
+		magnitude = numpy.abs(by_cell)
+		peaks = magnitude.max(axis=1)
+
+		significant = (magnitude >= tolerance * peaks[:, None]) & (magnitude > 0)
+		has_response = significant.any(axis=1)
+		# length runs through the last significant lag - argmax on the reversed rows finds it
+		lengths = numpy.where(has_response, n_lags - numpy.argmax(significant[:, ::-1], axis=1), 0)
+
+		cell_index = numpy.flatnonzero(has_response).astype(numpy.int64)
+		lengths = lengths[cell_index]
+		kept = numpy.arange(n_lags)[None, :] < lengths[:, None]
+		values = by_cell[cell_index][kept].astype(dtype)
+		offsets = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+
+		return cls(cell_index, offsets, values, (rows, cols), n_lags, tolerance)
+
+	@classmethod
+	def load(cls, folder, mmap=True):
+		"""
+		:param folder: folder the store was saved to
+		:param mmap: memory map the arrays rather than reading them into memory
+		:return: URFStore
+		"""
+		with open(os.path.join(folder, METADATA_FILE), 'r') as metadata_file:
+			metadata = json.load(metadata_file)
+
+		arrays = {name: numpy.load(os.path.join(folder, "{}.npy".format(name)), mmap_mode="r" if mmap else None) for name in ARRAYS}
+		return cls(grid_shape=metadata["grid_shape"], n_lags=metadata["n_lags"], tolerance=metadata["tolerance"], **arrays)
+
+	def save(self, folder):
+		os.makedirs(folder, exist_ok=True)
+		for name in ARRAYS:
+			numpy.save(os.path.join(folder, "{}.npy".format(name)), numpy.ascontiguousarray(getattr(self, name)))
+
+		with open(os.path.join(folder, METADATA_FILE), 'w') as metadata_file:
+			json.dump({
+				"grid_shape": self.grid_shape,
+				"n_lags": self.n_lags,
+				"tolerance": self.tolerance,
+				"dtype": str(self.values.dtype),
+			}, metadata_file)
+
+	@property
+	def nbytes(self):
+		return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+	@property
+	def dense_nbytes(self):
+		"""
+			What the same URFs would take up as a dense cube of the same dtype - for reporting the savings
+		"""
+		return self.n_lags * self.grid_shape[0] * self.grid_shape[1] * self.values.dtype.itemsize
+
+	def rows_for(self, grid_cells):
+		"""
+			Looks up where each grid cell's URF is in the store, for handing to kernels.convolve_sparse_and_sum
+		:param grid_cells: 1D array of offsets into the grid flattened row-major
+		:return: 1D int64 array of rows in the store, -1 for cells without a URF
+		"""
+		grid_cells = numpy.asarray(grid_cells, dtype=numpy.int64)
+		rows = numpy.searchsorted(self.cell_index, grid_cells)
+		found = rows < len(self.cell_index)
+		found[found] = self.cell_index[rows[found]] == grid_cells[found]
+		return numpy.where(found, rows, -1).astype(numpy.int64)
+
+	def urf(self, grid_cell):
+		"""
+		:param grid_cell: offset of a cell into the grid flattened row-major
+		:return: the cell's URF as a dense array of n_lags values (zeros past the truncation point)
+		"""
+		output = numpy.zeros(self.n_lags, dtype=self.values.dtype)
+		row = self.rows_for([grid_cell])[0]
+		if row >= 0:
+			values = self.values[self.offsets[row]:self.offsets[row + 1]]
+			output[:len(values)] = values
+		return output
+
+
+def load_scenario(name, mmap=True):
+	"""
+		Loads the URF store for a flow/unsat scenario from settings.URF_STORE_FOLDER
+	:param name: scenario name - the store lives in a folder with this name
+	:param mmap: memory map the arrays rather than reading them into memory
+	:return: URFStore
+	"""
+	return URFStore.load(os.path.join(settings.URF_STORE_FOLDER, name), mmap=mmap)
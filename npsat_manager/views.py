@@ -1,21 +1,35 @@
+import datetime
+import math
+import os
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
 
 from rest_framework import viewsets
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
-from rest_framework.authentication import SessionAuthentication, BasicAuthentication
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.authentication import SessionAuthentication, BasicAuthentication, TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed, Throttled, ValidationError
 from rest_framework.permissions import BasePermission, IsAuthenticated, IsAdminUser, SAFE_METHODS
 from rest_framework import generics
+from rest_framework.throttling import UserRateThrottle
+from django.core.cache import caches
 from django.contrib.auth.decorators import login_required
 
 from npsat_manager import serializers
 from npsat_manager import models
 from npsat_manager.support import tokens  # token code makes sure that all users have tokens - needs to be imported somewhere
+from npsat_manager import downsampling, middleware, run_status
+from npsat_manager.reference_cache import CachedReferenceMixin
+from npsat_manager.support import metrics, timing
+from npsat_backend import settings
 
 from rest_framework.views import APIView
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
-from django.db.models import Q
+from django.db.models import Count, Prefetch, Q
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
 
 
 class CustomAuthToken(ObtainAuthToken):
@@ -54,6 +68,9 @@ class FeedOnDashboard(APIView):
 	2. recent 10 published model not created by the authenticated user
 	3. meta info: total number of models created, etc...
 	4. updates/notifications
+
+	plot_models_data's series have every year unless the request sends points and downsample, as on
+	ResultPercentileViewSet
 	"""
 	permission_classes = [IsAuthenticated]
 	http_method_names = ["get"]
@@ -91,12 +108,162 @@ class FeedOnDashboard(APIView):
 			'total_completed_number': total_completed_number,
 			'total_published_number': total_published_number,
 			'plot_models_data': serializers.CompletedRunResultWithValuesSerializer(
-				instance=plot_models_data[:20], many=True, percentiles=[50]
+				instance=plot_models_data[:20], many=True, percentiles=[50],
+				context={"downsample": downsample_param(request)}
 			).data
 		})
 
 
-class ScenarioViewSet(viewsets.ModelViewSet):
+class RunTimingSummary(APIView):
+	"""
+	p50/p95 of how long each stage of recent model runs took, in seconds, grouped by region type and by scenario
+	so we can see which stage to scale.
+
+	Permissions: IsAdminUser
+
+	Optional params:
+		days: 30(default), only include runs processed in this many days
+	"""
+	permission_classes = [IsAdminUser]
+	http_method_names = ["get"]
+
+	def get(self, request):
+		days = whole_number_param(self.request, "days", 30)
+		rows = models.RunTiming.objects\
+			.filter(date_recorded__gte=timezone.now() - datetime.timedelta(days=days))\
+			.values("model_run_id", "model_run__regions__region_type", "model_run__flow_scenario__name",
+					"model_run__load_scenario__name", "model_run__unsat_scenario__name", *models.RunTiming.STAGES)
+
+		by_region_type = {}
+		by_scenario = {}
+		seen_scenario_runs = set()
+		for row in rows:  # a run with several regions comes back once per region
+			region_type = row["model_run__regions__region_type"]
+			by_region_type.setdefault(region_type, {})[row["model_run_id"]] = row
+			if row["model_run_id"] not in seen_scenario_runs:
+				seen_scenario_runs.add(row["model_run_id"])
+				scenario = " / ".join(str(row[field]) for field in ("model_run__flow_scenario__name", "model_run__load_scenario__name",
+																	"model_run__unsat_scenario__name"))
+				by_scenario.setdefault(scenario, []).append(row)
+
+		return Response({
+			"days": days,
+			"region_type": {region_type: timing.summarize(runs.values(), models.RunTiming.STAGES)
+							for region_type, runs in by_region_type.items()},
+			"scenario": {scenario: timing.summarize(runs, models.RunTiming.STAGES) for scenario, runs in by_scenario.items()},
+		})
+
+
+class QueryProfiles(APIView):
+	"""
+	The most recent SQL profiles of sampled requests in this web server process, newest first. Only collected
+	when settings.QUERY_PROFILING_ENABLED is on. DELETE clears them. Under the multi-process server each worker
+	keeps its own profiles and a request sees the ones of whichever worker answers it - pid says which.
+
+	Permissions: IsAdminUser
+
+	Optional params:
+		sort: false(default) or n_queries, sql_seconds or seconds - sorts descending on that value
+		limit: 50(default), how many profiles to return
+	"""
+	permission_classes = [IsAdminUser]
+	http_method_names = ["get", "delete"]
+	SORT_FIELDS = ("n_queries", "sql_seconds", "seconds")
+
+	def get(self, request):
+		profiles = middleware.PROFILES.snapshot()
+		sort = self.request.query_params.get("sort", False)
+		if sort in self.SORT_FIELDS:
+			profiles.sort(key=lambda profile: profile[sort], reverse=True)
+		limit = whole_number_param(self.request, "limit", 50)
+		return Response({
+			"enabled": settings.QUERY_PROFILING_ENABLED,
+			"sample_rate": settings.QUERY_PROFILING_SAMPLE_RATE,
+			"pid": os.getpid(),
+			"profiles": profiles[:limit],
+		})
+
+	def delete(self, request):
+		middleware.PROFILES.clear()
+		return Response(status=204)
+
+
+def prometheus_metrics(request):
+	"""
+	Metrics for this web server in the Prometheus text format - for every worker of the multi-process server, see
+	support.metrics. Only served to the addresses in settings.METRICS_ALLOWED_ADDRESSES (the scraper) and to staff
+	who are logged in.
+	"""
+	if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_ADDRESSES and not request.user.is_staff:
+		return HttpResponseForbidden()
+	return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def _model_run_status(request, run_id):
+	"""
+		Authenticates the request and reads a run's status for model_run_status. DRF authentication and the ORM are
+		both sync, so this runs on a thread
+	:return: (HTTP status code, response dict)
+	"""
+	user = None
+	for authenticator in (TokenAuthentication(), BasicAuthentication()):
+		try:
+			authenticated = authenticator.authenticate(request)
+		except AuthenticationFailed as error:
+			return 401, {"detail": str(error.detail)}
+		if authenticated:
+			user = authenticated[0]
+			break
+	if user is None and request.user.is_authenticated:  # logged in to the site
+		user = request.user
+	if user is None:
+		return 401, {"detail": "Authentication credentials were not provided."}
+
+	run = models.ModelRun.objects\
+		.filter(Q(user=user) | Q(public=True) | Q(is_base=True), id=run_id)\
+		.values("id", "status", "status_message", "date_completed")\
+		.first()
+	if run is None:
+		return 404, {"detail": "Not found."}
+	return 200, run
+
+
+async def model_run_status(request, run_id):
+	"""
+	A model run's status, as a cheap alternative to polling the whole model run. With `since`, the request is held
+	until the run's status is something else, or until the timeout - the response is the same either way, so
+	compare its status to `since`. Served best over ASGI (npsat_backend/asgi.py), where a held request doesn't
+	use up a server thread.
+
+	Permissions: Must be authenticated (token, basic or session), and the run must be yours, public or a base model
+
+	Optional params:
+		since: false(default) or the status the client last saw
+		timeout: 25(default), seconds to hold the request for at most, up to settings.RUN_STATUS_MAX_WAIT
+	"""
+	if request.method != "GET":
+		return JsonResponse({"detail": "Method \"{}\" not allowed.".format(request.method)}, status=405)
+
+	status_code, body = await sync_to_async(_model_run_status)(request, run_id)
+	if status_code != 200:
+		return JsonResponse(body, status=status_code)
+
+	try:
+		timeout = float(request.GET.get("timeout", 25))
+	except ValueError:
+		timeout = math.nan
+	if not math.isfinite(timeout):
+		return JsonResponse({"timeout": ["Expected a number of seconds"]}, status=400)
+	timeout = max(0, min(timeout, settings.RUN_STATUS_MAX_WAIT))
+
+	since = request.GET.get("since", False)
+	if since is not False and str(body["status"]) == since:
+		if await run_status.get_watcher().wait(run_id, body["status"], timeout) is not None:
+			status_code, body = await sync_to_async(_model_run_status)(request, run_id)
+	return JsonResponse(body, status=status_code)
+
+
+class ScenarioViewSet(CachedReferenceMixin, viewsets.ModelViewSet):
 	"""
 	scenario name
 
@@ -104,10 +271,11 @@ class ScenarioViewSet(viewsets.ModelViewSet):
 	"""
 	permission_classes = [IsAdminUser | ReadOnly]
 	serializer_class = serializers.ScenarioSerializer
+	reference_model = models.Scenario
 	queryset = models.Scenario.objects.filter(active_in_mantis=True).order_by('name')
 
 
-class CropViewSet(viewsets.ModelViewSet):
+class CropViewSet(CachedReferenceMixin, viewsets.ModelViewSet):
 	"""
 	Crop Names and Codes
 
@@ -116,27 +284,142 @@ class CropViewSet(viewsets.ModelViewSet):
 	permission_classes = [IsAdminUser | ReadOnly]  # Admin users can do any operation, others, can read from the API, but not write
 
 	serializer_class = serializers.CropSerializer
+	reference_model = models.Crop
 	queryset = models.Crop.objects.order_by('name')
 
 
-class RegionViewSet(viewsets.ModelViewSet):
+def whole_number_param(request, name, default):
+	"""
+		Reads a query param that has to be a whole number, 0 or more
+	:return: the number, or default if the param wasn't sent
+	"""
+	value = request.query_params.get(name, None)
+	if value is None:
+		return default
+	try:
+		number = int(value)
+	except ValueError:
+		number = -1
+	if number < 0:
+		raise ValidationError({name: "Expected a whole number, 0 or more"})
+	return number
+
+
+def coordinates_param(request, name, count):
+	"""
+		Reads a query param of comma separated numbers, such as a lon,lat point
+	:return: tuple of count floats, or None if the param wasn't sent
+	"""
+	value = request.query_params.get(name, None)
+	if value is None:
+		return None
+	try:
+		numbers = tuple(float(number) for number in value.split(','))
+	except ValueError:
+		numbers = ()
+	if len(numbers) != count:
+		raise ValidationError({name: "Expected {} comma separated numbers".format(count)})
+	return numbers
+
+
+def downsample_param(request):
+	"""
+		Reads the points and downsample query params for downsampling result series - see npsat_manager/downsampling.py
+	:return: (method, points) for the serializer context, or None to send every year - when points isn't sent or is 0
+	"""
+	points = request.query_params.get("points")
+	method = request.query_params.get("downsample", downsampling.METHODS[0])
+	if method not in downsampling.METHODS:
+		raise ValidationError({"downsample": "Expected one of {}".format(", ".join(downsampling.METHODS))})
+	if points is None:
+		return None
+	try:
+		points = int(points)
+	except ValueError:
+		raise ValidationError({"points": "Expected a whole number"})
+	if points == 0:
+		return None
+	if points < downsampling.MIN_POINTS:
+		raise ValidationError({"points": "Expected 0 or at least {}".format(downsampling.MIN_POINTS)})
+	return method, points
+
+
+class RegionViewSet(CachedReferenceMixin, viewsets.ModelViewSet):
 	"""
 		API endpoint that allows listing of Region
 
 		Permissions: IsAdminUser | ReadOnly (Admin users can do all operations, others can use HEAD and GET)
+
+		Optional params:
+			region_type: only regions of this type
+			contains: lon,lat - only regions whose geometry contains the point
+			bbox: min_lon,min_lat,max_lon,max_lat - only regions whose bounding box overlaps the box, such as a map view
 	"""
 	permission_classes = [IsAdminUser | ReadOnly]  # Admin users can do any operation, others, can read from the API, but not write
 
 	serializer_class = serializers.RegionSerializer
+	reference_model = models.Region
 
 	def get_queryset(self):
 		queryset = models.Region.objects.filter(active_in_mantis=True).order_by('name')
 		region_type = self.request.query_params.get('region_type', None)
 		if region_type:
 			queryset = queryset.filter(region_type=region_type)
+
+		point = coordinates_param(self.request, 'contains', 2)
+		box = coordinates_param(self.request, 'bbox', 4)
+		if point is not None or box is not None:
+			from npsat_manager import region_index  # numpy - only loaded once someone searches by location
+			index = region_index.get()
+			if point is not None:
+				queryset = queryset.filter(id__in=index.containing(*point))
+			if box is not None:
+				queryset = queryset.filter(id__in=index.intersecting(box))
 		return queryset
 
 
+class RegionOverlapViewSet(CachedReferenceMixin, viewsets.ReadOnlyModelViewSet):
+	"""
+		How much of each region lies inside regions of other types, as the fraction of the region's area -
+		precomputed by `python manage.py build_region_overlaps`
+
+		Optional params:
+			region: region ids joined by comma - only the overlaps of these regions
+			region_type: only overlaps with regions of this type
+	"""
+	serializer_class = serializers.RegionOverlapSerializer
+	reference_model = models.RegionOverlap
+
+	def get_queryset(self):
+		queryset = models.RegionOverlap.objects.select_related('other_region').defer('other_region__geometry') \
+			.order_by('region_id', '-fraction', 'other_region_id')
+		region_ids = self.request.query_params.get('region', None)
+		if region_ids:
+			try:
+				queryset = queryset.filter(region_id__in=[int(region_id) for region_id in region_ids.split(',')])
+			except ValueError:
+				raise ValidationError({'region': "Expected region ids joined by comma"})
+		region_type = self.request.query_params.get('region_type', None)
+		if region_type:
+			queryset = queryset.filter(other_region__region_type=region_type)
+		return queryset
+
+
+class SubmissionRateThrottle(UserRateThrottle):
+	"""
+		Limits how many model runs each user can submit, to settings.MODEL_RUN_SUBMIT_RATE. Counted in the
+		"throttle" cache so that every server worker shares the counts
+	"""
+	scope = "model_run_submit"
+
+	def __init__(self):
+		self.cache = caches["throttle"]
+		super().__init__()
+
+	def get_rate(self):
+		return settings.MODEL_RUN_SUBMIT_RATE
+
+
 class ModelRunViewSet(viewsets.ModelViewSet):
 	"""
 	Create, List, and Modify Model Runs
@@ -160,11 +443,33 @@ class ModelRunViewSet(viewsets.ModelViewSet):
 		includeBase(only on retrieve request):
 			false(default) or true, this will include base model info
 	These params are additional filter to sift models to return the model list
+
+	export/ streams the results of the completed runs the list would return (see npsat_manager/exports.py), with
+	the same params plus:
+		ids: false(default) or run ids joined by comma, to export only these runs
+		type: csv(default) or parquet
+		layout: long(default) or wide
+		data: percentiles(default) or wells
 	"""
 	permission_classes = [IsAuthenticated]
 
 	serializer_class = serializers.RunResultSerializer
 
+	def get_throttles(self):
+		if self.action == "create":
+			return [SubmissionRateThrottle()]
+		return super().get_throttles()
+
+	def create(self, request, *args, **kwargs):
+		# keep the queue bounded - each user can only have so many runs waiting at once
+		queued = models.ModelRun.objects.filter(user=request.user, status__in=(models.ModelRun.READY, models.ModelRun.RUNNING)).count()
+		if queued >= settings.MODEL_RUN_MAX_QUEUED:
+			raise Throttled(detail="You have {} model runs waiting - wait for some of them to finish before submitting more".format(queued))
+		return super().create(request, *args, **kwargs)
+
+	def perform_create(self, serializer):
+		serializer.save(user=self.request.user)  # so the queue limit and fair share count the run against its submitter
+
 	def retrieve(self, request, *args, **kwargs):
 		serializer = None
 		instance = self.get_object()
@@ -173,8 +478,9 @@ class ModelRunViewSet(viewsets.ModelViewSet):
 		base_model = None
 		if include_base and not instance.is_base:
 			try:
-				base_model = models.ModelRun.objects.get(scenario=instance.scenario, is_base=True)
-			except models.ModelRun.DoesNotExist:
+				base_model = models.ModelRun.objects.get(flow_scenario=instance.flow_scenario_id, load_scenario=instance.load_scenario_id,
+														 unsat_scenario=instance.unsat_scenario_id, is_base=True)
+			except (models.ModelRun.DoesNotExist, models.ModelRun.MultipleObjectsReturned):
 				base_model = None
 		if base_model:
 			serializer = self.get_serializer([instance, base_model], many=True)
@@ -182,6 +488,33 @@ class ModelRunViewSet(viewsets.ModelViewSet):
 			serializer = self.get_serializer(instance)
 		return Response(serializer.data)
 
+	@action(detail=False, methods=["get"])
+	def export(self, request):
+		from npsat_manager import exports
+		from npsat_manager.support import compatibility  # numpy - imported here to keep it out of the site's startup
+
+		options = {}
+		for param, name, choices in (("type", "file_format", exports.FORMATS), ("layout", "layout", exports.LAYOUTS), ("data", "data", exports.DATA)):
+			options[name] = request.query_params.get(param, choices[0])
+			if options[name] not in choices:
+				raise ValidationError({param: "Expected one of {}".format(", ".join(choices))})
+		if options["file_format"] == "parquet" and not compatibility.PYARROW:
+			raise ValidationError({"type": "Parquet exports need pyarrow, which isn't installed on this server"})
+
+		runs = self.get_queryset()
+		if isinstance(runs, list):  # every tag was switched off
+			runs = models.ModelRun.objects.none()
+		run_ids = request.query_params.get("ids", None)
+		if run_ids:
+			try:
+				runs = runs.filter(id__in=[int(run_id) for run_id in run_ids.split(',')])
+			except ValueError:
+				raise ValidationError({"ids": "Expected run ids joined by comma"})
+
+		response = StreamingHttpResponse(exports.export(runs, **options), content_type=exports.CONTENT_TYPES[options["file_format"]])
+		response["Content-Disposition"] = 'attachment; filename="npsat_{}.{}"'.format(options["data"], options["file_format"])
+		return response
+
 	def get_queryset(self):
 		# tags
 		include_public = self.request.query_params.get("public", "true")
@@ -215,7 +548,7 @@ class ModelRunViewSet(viewsets.ModelViewSet):
 
 		if not query:
 			return []
-		results = models.ModelRun.objects.filter(query)
+		results = models.ModelRun.objects.filter(query).select_related('flow_scenario', 'load_scenario', 'unsat_scenario')
 		if status:
 			results = results.filter(status__in=status.split(','))
 
@@ -224,7 +557,8 @@ class ModelRunViewSet(viewsets.ModelViewSet):
 			results = results.filter(query)
 
 		if scenarios:
-			results = results.filter(scenario__in=scenarios.split(','))
+			scenarios = scenarios.split(',')
+			results = results.filter(Q(flow_scenario__in=scenarios) | Q(load_scenario__in=scenarios) | Q(unsat_scenario__in=scenarios))
 
 		if sorter:
 			sorter_field, order = sorter.split(',')
@@ -238,6 +572,47 @@ class ModelRunViewSet(viewsets.ModelViewSet):
 		return results.order_by('id')
 
 
+class RunSweepViewSet(viewsets.ModelViewSet):
+	"""
+	Submit a parameter sweep - a run for every combination of crop proportions along the axes, all sharing the
+	base's regions, scenarios and settings - and follow its progress
+
+	Permissions: Must be authenticated
+
+	POST body:
+		name: name of the sweep, and the start of each run's name
+		description: optional
+		base: the runs' shared fields, as for a model run, with flow_scenario, load_scenario and unsat_scenario as
+			ids, regions as a list of ids and modifications as a list of {"crop": id, "proportion": 0-1} that every
+			run has unless an axis sets that crop
+		axes: list of {"crop": id, "values": [proportions]}
+	The response includes the ids of the sweep's runs, and progress - how many of them have each status
+	"""
+	permission_classes = [IsAuthenticated]
+	http_method_names = ["get", "post"]
+
+	serializer_class = serializers.RunSweepSerializer
+
+	def get_throttles(self):
+		if self.action == "create":
+			return [SubmissionRateThrottle()]  # a whole sweep counts as one submission
+		return super().get_throttles()
+
+	def get_queryset(self):
+		progress = {"runs_" + name: Count('runs', filter=Q(runs__status=status)) for status, name in models.ModelRun.STATUS_NAMES.items()}
+		return models.RunSweep.objects.filter(user=self.request.user)\
+			.annotate(**progress)\
+			.prefetch_related(Prefetch('runs', queryset=models.ModelRun.objects.only('id', 'sweep_id').order_by('id')))\
+			.order_by('id')
+
+	def perform_create(self, serializer):
+		queued = models.ModelRun.objects.filter(user=self.request.user, status__in=(models.ModelRun.READY, models.ModelRun.RUNNING)).count()
+		if queued + len(serializer.validated_data["points"]) > settings.MODEL_RUN_MAX_QUEUED:
+			raise Throttled(detail="This sweep would put you over {} model runs waiting - wait for some of your {} waiting runs to finish".format(
+				settings.MODEL_RUN_MAX_QUEUED, queued))
+		serializer.save(user=self.request.user)
+
+
 class ModificationViewSet(viewsets.ModelViewSet):
 	"""
 	API endpoint that allows listing of Modifications
@@ -258,12 +633,22 @@ class ResultPercentileViewSet(viewsets.ModelViewSet):
 	restricted to only allow GET request
 
 	Permission: same as the model run, must be authenticated
+
+	Optional params:
+		points: downsample each series to this many years (at least 4), for plotting. Each result then has a
+				years list with the index of the year each value is from
+		downsample: lttb(default) or minmax - how to pick the years to keep. See npsat_manager/downsampling.py
 	"""
 	permission_classes = [IsAuthenticated]
 	http_method_names = ["get"]
 
 	serializer_class = serializers.ResultPercentileSerializer
 
+	def get_serializer_context(self):
+		context = super().get_serializer_context()
+		context["downsample"] = downsample_param(self.request)
+		return context
+
 	def get_queryset(self):
 		return models.ResultPercentile.objects\
 			.filter(
@@ -1,45 +1,50 @@
-import time
-
 import requests
 
-apidemo_token = "e0a132761aa8d1168542b53648ee044f33c7bf65"  # replace this with a valid API token - this one only works in my local sqlite.
+SERVER = "http://localhost:8000"
+apidemo_token = "e0a132761aa8d1168542b53648ee044f33c7bf65"  # replace this with a valid API token - get one by POSTing a username and password to /api-token-auth/
 auth_header = {"Authorization": "Token {}".format(apidemo_token)}
 
-# Step 1: Create the Model Run
-create_run = requests.post("http://localhost:8000/api/model_run/",  headers=auth_header, data={'user': 4, 'name': "API Test"})
-print(create_run.json())
-
-model_run_id = create_run.json()['id']  # get the ID of the newly created model run
-
-# set the IDs in the DB for corn and grapes, as used in the demo
+# set the IDs in the DB for the region, scenarios, corn and grapes, as used in the demo - see /api/region/, /api/scenario/ and /api/crops/
+central_valley = 1
+flow_scenario = 1  # a run needs one scenario of each type - flow, load and unsat
+load_scenario = 2
+unsat_scenario = 3
 corn = 1
 grapes = 2
 
-corn_modification = requests.post("http://localhost:8000/api/modification/",  headers=auth_header, data={'model_run': model_run_id, 'crop': corn, 'proportion': 0.5})
-print(corn_modification.text)
-grapes_modification = requests.post("http://localhost:8000/api/modification/",  headers=auth_header, data={'model_run': model_run_id, 'crop': grapes, 'proportion': 0.25})
-print(grapes_modification.text)
-
-# This next one should fail because only one record can be attached for a crop/model_run combo. If you need to change it, patch the existing one.
-grapes_modification_SHOULD_FAIL = requests.post("http://localhost:8000/api/modification/",  headers=auth_header, data={'model_run': model_run_id, 'crop': grapes, 'proportion': 0.2})
-print(grapes_modification_SHOULD_FAIL)
-
-# This one should fail because the user isn't authorized to attach modifications to model runs that aren't theirs
-grapes_modification_AUTH_FAIL = requests.post("http://localhost:8000/api/modification/",  headers=auth_header, data={'model_run': 2, 'crop': grapes, 'proportion': 0.2})
-print(grapes_modification_AUTH_FAIL)
+# Step 1: Create the Model Run, with its regions and modifications. It's marked ready to run as soon as it's created
+create_run = requests.post("{}/api/model_run/".format(SERVER), headers=auth_header, json={
+	'name': "API Test",
+	'regions': [{'id': central_valley}],
+	'flow_scenario': {'id': flow_scenario},
+	'load_scenario': {'id': load_scenario},
+	'unsat_scenario': {'id': unsat_scenario},
+	'modifications': [
+		{'crop': {'id': corn}, 'proportion': 0.5},
+		{'crop': {'id': grapes}, 'proportion': 0.25},
+	],
+	'n_years': 100,
+	'reduction_start_year': 2020,
+	'reduction_end_year': 2025,
+})
+print(create_run.json())
 
-set_ready = requests.patch("http://localhost:8000/api/model_run/{}/".format(model_run_id),  headers=auth_header, data={'ready': 1})
-print(set_ready.text)
+model_run_id = create_run.json()['id']  # get the ID of the newly created model run
 
-# Now check for results occasionally
-results = None
-while not results:
-	time.sleep(2)
-	print("Checking for results")
-	model_info = requests.get("http://localhost:8000/api/model_run/{}/".format(model_run_id), headers=auth_header)
-	if model_info.json()['complete'] is True:
-		results = model_info.json()['result_values']
-		print("Got results!")
-		print(results)
-	else:
-		print("No results yet. Ctrl-C to cancel checking and quit.")
+# Now wait for the status to change - the status endpoint holds each request until the run's status is different
+# from `since` (or for up to `timeout` seconds). 3 is completed and 4 is an error (see ModelRun.STATUS_CHOICE)
+status = create_run.json()['status']
+while status not in (3, 4):
+	print("Waiting for results. Ctrl-C to cancel checking and quit.")
+	status = requests.get("{}/api/model_run/{}/status/".format(SERVER, model_run_id), headers=auth_header,
+						  params={'since': status, 'timeout': 30}, timeout=60).json()['status']
+
+model_info = requests.get("{}/api/model_run/{}/".format(SERVER, model_run_id), headers=auth_header).json()
+
+if model_info['status'] == 4:
+	print("Model run failed: {}".format(model_info['status_message']))
+else:
+	print("Got results for {} wells!".format(model_info['n_wells']))
+	for result in model_info['results']:  # each result is one percentile across wells - fetch its values by ID
+		percentile = requests.get("{}/api/model_results/{}/".format(SERVER, result['id']), headers=auth_header).json()
+		print(percentile['percentile'], percentile['values'])